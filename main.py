@@ -1,15 +1,44 @@
-from flask import Flask, render_template, request, jsonify, redirect, url_for, session
+from flask import Flask, render_template, request, jsonify, redirect, url_for, session, send_from_directory, send_file, Response, abort
 import os
 from werkzeug.utils import secure_filename
+from werkzeug.security import safe_join
+from werkzeug.wsgi import FileWrapper
+from flask.sessions import SecureCookieSessionInterface
+from flask.json.provider import DefaultJSONProvider
 from werkzeug.security import generate_password_hash, check_password_hash
 import uuid
+import hashlib
+import math
+import struct
+import zlib
+import gzip
+import mimetypes
+import shutil
+import glob
+import json
+import re
+import importlib.util
+import secrets
 import mysql.connector
 from mysql.connector import Error
-from datetime import datetime
+from datetime import datetime, timedelta
+from collections import deque, OrderedDict
+from urllib.parse import parse_qs, quote
 from functools import wraps
 import sys
+import threading
+import atexit
+import time
+import cProfile
+import tracemalloc
+import asyncio
+import tempfile
+import argparse
+import multiprocessing
+import fcntl
+import queue
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 print("Running with:", sys.executable)
-import fitz  
 
 app = Flask(__name__)
 
@@ -17,6 +46,116 @@ app = Flask(__name__)
 UPLOAD_FOLDER = 'uploads'
 ALLOWED_EXTENSIONS = {'pdf'}
 MAX_CONTENT_LENGTH = 100 * 1024 * 1024  # 100MB max file size
+BULK_MAX_FILES = 500  # max files per bulk upload/delete/select request
+RENDER_ZOOM = 2.0  # 2x zoom for better quality
+
+# Render budget: zoom is lowered for pages that would exceed these limits
+RENDER_MAX_PIXELS = 25 * 1000 * 1000  # output pixels per page
+RENDER_MAX_BYTES = 64 * 1024 * 1024  # uncompressed RGB pixmap per page
+RENDER_BAND_BYTES = 16 * 1024 * 1024  # bigger pixmaps are rendered in bands of this size
+RENDER_MEMORY_CEILING = 256 * 1024 * 1024  # pixmap bytes of concurrent renders per process
+RENDER_MEMORY_WAIT = 30  # seconds a render may wait for memory before failing
+RENDER_SLOTS_PER_USER = 2  # renders one user may run at once in request threads
+RENDER_SLOT_WAIT = 5  # seconds a request waits for one of its user's slots
+
+# Render sandbox: reader renders run in worker processes with these limits
+RENDER_SANDBOX_ENABLED = True
+RENDER_SANDBOX_WORKERS = 2
+RENDER_TIMEOUT = 20  # seconds per job before the worker is killed
+RENDER_WORKER_MEMORY_LIMIT = 1536 * 1024 * 1024  # address space per worker (RLIMIT_AS)
+RENDER_WORKER_MAX_JOBS = 500  # recycle workers after this many jobs
+QUARANTINE_AFTER_FAILURES = 3  # failed renders before a document is quarantined
+# A timed out worker that got less than this share of a CPU was starved by an
+# overloaded server, not stuck on the document, so the file is not blamed
+RENDER_OVERLOAD_CPU_SHARE = 0.5
+
+# When the app runs behind nginx, set this to an internal location that maps to
+# UPLOAD_FOLDER (e.g. '/protected-uploads/') and /raw downloads are handed to
+# nginx with X-Accel-Redirect instead of being streamed by Python
+RAW_ACCEL_REDIRECT_PREFIX = None
+
+# Ingest: optionally rewrite uploads (garbage collected, deflated, linearized)
+# in a worker process so later opens and range streaming are faster
+OPTIMIZE_PDF_ON_UPLOAD = False
+INGEST_WORKERS = 2
+
+# Ingest validation: uploads are 'pending' until checked in a render worker,
+# then 'ok', 'invalid' or 'encrypted'. Readers never render UNREADABLE_STATUSES.
+PDF_HEADER_SEARCH_BYTES = 1024  # the %PDF- header may follow some leading junk
+UNREADABLE_STATUSES = {'quarantined', 'invalid', 'encrypted'}
+
+# Page thumbnails, packed into sprite sheets per document
+THUMBNAIL_FOLDER = 'thumbnails'
+THUMBNAIL_WIDTH = 96  # px per thumbnail
+THUMBNAIL_SHEET_MAX_SIDE = 16383  # px, WebP's limit (sheets are also kept under RENDER_MAX_BYTES)
+THUMBNAIL_QUALITY = 70
+THUMBNAILS_ON_UPLOAD = False  # otherwise built on first request
+THUMBNAIL_TIMEOUT = 300  # seconds a sheet build may take in a render worker
+
+# Blob storage for uploaded PDFs: 'local' (UPLOAD_FOLDER) or 's3'
+BLOB_STORAGE_BACKEND = 'local'
+BLOB_SHARD_UPLOADS = True  # store new uploads under ab/cd/ hash directories
+UPLOAD_MIGRATION_BATCH_SIZE = 500  # rows per batch for --migrate-uploads
+S3_BUCKET = None
+S3_PREFIX = ''
+S3_ENDPOINT_URL = None  # e.g. 'http://localhost:9000' for MinIO or a moto server
+BLOB_CACHE_FOLDER = 'blob_cache'  # local read-through copies of remote blobs
+BLOB_CACHE_MAX_BYTES = 2 * 1024 * 1024 * 1024
+
+# Compression of JSON responses (brotli is used when installed)
+COMPRESSIBLE_MIMETYPES = {'application/json'}
+COMPRESS_MIN_BYTES = 1024
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+# Static assets: precompressed copies for these types, a year of caching for
+# fingerprinted URLs (see asset_url)
+PRECOMPRESSED_MIMETYPES = {'text/css', 'text/javascript', 'application/javascript', 'image/svg+xml'}
+STATIC_MAX_AGE = 365 * 24 * 3600
+
+# Admin accounts (by email) allowed to use the /admin endpoints
+ADMIN_EMAILS = set()
+
+# Admin diagnostics (/test-db, /debug-user-files), off unless enabled
+DIAGNOSTICS_ENABLED = False
+DIAGNOSTICS_MAX_ROWS = 100  # hard cap on sample rows per table
+DIAGNOSTICS_QUERY_TIMEOUT_MS = 2000
+
+# Render profiling (opt-in) - records the slowest page renders
+RENDER_PROFILING_ENABLED = False
+RENDER_PROFILE_TOP_N = 50
+PROFILE_FOLDER = 'profiles'  # cProfile dumps for single render requests
+
+# Rendered pages kept on disk (see render_cached_page, --prerender)
+PAGE_CACHE_FOLDER = 'page_cache'
+PAGE_CACHE_MAX_BYTES = 4 * 1024 * 1024 * 1024  # least recently used pages are pruned beyond this
+PAGE_CACHE_PRUNE_TO = 0.9  # share of the budget a prune leaves in use
+PAGE_CACHE_TOUCH_INTERVAL = 60 * 60  # seconds before a cache hit refreshes the page's mtime
+PRERENDER_MAX_PAGES = 50  # pages per book --prerender warms (None for all)
+
+# Open books per user; beyond these the least recently used pages/books are dropped
+MAX_READER_SESSIONS_PER_USER = 8
+READER_MEMORY_BUDGET_PER_USER = 256 * 1024 * 1024  # bytes of rendered pages kept
+
+# Annotations: operations per batch write and stored bytes per annotation
+ANNOTATION_KINDS = {'highlight', 'note', 'bookmark'}
+ANNOTATION_BATCH_MAX = 200
+ANNOTATION_MAX_BYTES = 8 * 1024
+
+# Reading analytics: events are appended to segment files in EVENT_LOG_FOLDER
+# and rolled up into summary tables every EVENT_ROLLUP_INTERVAL seconds
+EVENT_LOG_FOLDER = 'event_log'
+EVENT_LOG_FLUSH_INTERVAL = 2  # seconds
+EVENT_LOG_BUFFER_EVENTS = 1000  # flush early once this many events are queued
+EVENT_ROLLUP_INTERVAL = 300  # seconds, also the length of a segment
+EVENT_DWELL_CAP = 600  # longest time counted between two events of a reader
+EVENT_ROLLUP_RETRIES = 3  # attempts per segment when the summary update deadlocks
+
+# Reader prefetch: read-ahead grows up to PREFETCH_MAX_PAGES for sequential
+# readers; readers who jump around get table of contents targets instead
+NAVIGATION_HISTORY_SIZE = 16
+PREFETCH_MAX_PAGES = 6
+PREFETCH_TOC_TARGETS = 3
 
 # MySQL Database Configuration
 DB_CONFIG = {
@@ -31,6 +170,22 @@ DB_CONFIG = {
 
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = MAX_CONTENT_LENGTH
+app.config['OPTIMIZE_PDF_ON_UPLOAD'] = OPTIMIZE_PDF_ON_UPLOAD
+app.config['THUMBNAIL_FOLDER'] = THUMBNAIL_FOLDER
+app.config['THUMBNAILS_ON_UPLOAD'] = THUMBNAILS_ON_UPLOAD
+app.config['ADMIN_EMAILS'] = ADMIN_EMAILS
+app.config['BLOB_STORAGE_BACKEND'] = BLOB_STORAGE_BACKEND
+app.config['BLOB_SHARD_UPLOADS'] = BLOB_SHARD_UPLOADS
+app.config['RAW_ACCEL_REDIRECT_PREFIX'] = RAW_ACCEL_REDIRECT_PREFIX
+app.config['DIAGNOSTICS_ENABLED'] = DIAGNOSTICS_ENABLED
+app.config['RENDER_PROFILING_ENABLED'] = RENDER_PROFILING_ENABLED
+app.config['RENDER_PROFILE_TOP_N'] = RENDER_PROFILE_TOP_N
+app.config['PROFILE_FOLDER'] = PROFILE_FOLDER
+app.config['PAGE_CACHE_FOLDER'] = PAGE_CACHE_FOLDER
+app.config['EVENT_LOG_FOLDER'] = EVENT_LOG_FOLDER
+app.config['RENDER_SANDBOX_ENABLED'] = RENDER_SANDBOX_ENABLED
+app.config['MAX_READER_SESSIONS_PER_USER'] = MAX_READER_SESSIONS_PER_USER
+app.config['READER_MEMORY_BUDGET_PER_USER'] = READER_MEMORY_BUDGET_PER_USER
 app.secret_key = 'your-secret-key-change-this-in-production'  # Change this in production!
 
 # Database connection helper
@@ -43,6 +198,29 @@ def get_db_connection():
         print(f"Error connecting to MySQL: {e}")
         return None
 
+# Columns added to the files table after it was first created
+FILES_EXTRA_COLUMNS = [
+    ('source_filename', 'VARCHAR(255) DEFAULT NULL'),  # original upload when stored_filename is an optimized copy
+    ('original_file_size', 'BIGINT DEFAULT NULL'),
+    ('status', "VARCHAR(20) NOT NULL DEFAULT 'ok'"),  # see UNREADABLE_STATUSES and record_render_failure
+    ('render_failures', 'INT NOT NULL DEFAULT 0'),
+    ('page_count', 'INT DEFAULT NULL'),  # set by ingest validation
+    ('status_detail', 'VARCHAR(255) DEFAULT NULL')  # why validation rejected (or repaired) a file
+]
+
+# Columns added to the render_profiles table after it was first created
+RENDER_PROFILES_EXTRA_COLUMNS = [
+    ('peak_memory_measured', 'BOOLEAN NOT NULL DEFAULT FALSE')  # FALSE: the pixmap reservation only
+]
+
+def add_missing_columns(cursor, table_name, columns):
+    """Add columns introduced after a table was first created"""
+    for column_name, definition in columns:
+        try:
+            cursor.execute(f"ALTER TABLE {table_name} ADD COLUMN {column_name} {definition}")
+        except Error:
+            pass  # Column already exists
+
 def init_db():
     """Initialize the database with required tables"""
     try:
@@ -98,27 +276,12 @@ def init_db():
             except Error:
                 # Foreign key might already exist or users table might not exist
                 pass
+            
+            add_missing_columns(cursor, 'files', FILES_EXTRA_COLUMNS)
                 
         except Error as e:
             print(f"⚠️  Warning: Could not create files table: {e}")
         
-        # Keep existing book table for backward compatibility, but modify it
-        try:
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS book (
-                    id INT AUTO_INCREMENT PRIMARY KEY,
-                    username VARCHAR(120) NOT NULL,
-                    book_title VARCHAR(255) NOT NULL,
-                    size VARCHAR(20) NOT NULL,
-                    last_read DATE DEFAULT NULL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    INDEX idx_username (username)
-                ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
-            ''')
-            print("✅ Book table created/verified")
-        except Error as e:
-            print(f"⚠️  Warning: Could not create book table: {e}")
-        
         # Also ensure the original 'user' table exists for backward compatibility
         try:
             cursor.execute('''
@@ -131,95 +294,109 @@ def init_db():
         except Error as e:
             print(f"⚠️  Warning: Could not create user table: {e}")
         
-        connection.commit()
-        cursor.close()
-        connection.close()
-        print("✅ Database tables initialization completed!")
-        return True
-        
-    except Error as e:
-        print(f"❌ Database initialization failed: {e}")
-        return False
-
-def ensure_table_exists(table_name):
-    """Ensure a specific table exists, create if missing"""
-    try:
-        connection = get_db_connection()
-        if connection is None:
-            return False
+        # Single row holding the version of the migrations applied so far
+        try:
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS schema_version (
+                    id TINYINT PRIMARY KEY,
+                    version INT NOT NULL,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+                ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+            ''')
+            print("✅ Schema version table created/verified")
+        except Error as e:
+            print(f"⚠️  Warning: Could not create schema_version table: {e}")
         
-        cursor = connection.cursor()
+        # Last page read per user and book (written in batches, see ReadingProgressBuffer)
+        try:
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS reading_progress (
+                    user_id INT NOT NULL,
+                    file_id VARCHAR(50) NOT NULL,
+                    page_number INT NOT NULL,
+                    updated_at DATETIME NOT NULL,
+                    PRIMARY KEY (user_id, file_id)
+                ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+            ''')
+            print("✅ Reading progress table created/verified")
+        except Error as e:
+            print(f"⚠️  Warning: Could not create reading_progress table: {e}")
         
-        if table_name == 'users':
+        # Slowest page renders recorded by the render profiler
+        try:
             cursor.execute('''
-                CREATE TABLE IF NOT EXISTS users (
-                    id INT AUTO_INCREMENT PRIMARY KEY,
-                    username VARCHAR(80) UNIQUE NOT NULL,
-                    email VARCHAR(120) UNIQUE NOT NULL,
-                    password_hash VARCHAR(255) NOT NULL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                CREATE TABLE IF NOT EXISTS render_profiles (
+                    file_id VARCHAR(50) NOT NULL,
+                    page_num INT NOT NULL,
+                    render_ms DOUBLE NOT NULL,
+                    width INT NOT NULL,
+                    height INT NOT NULL,
+                    encoded_bytes BIGINT NOT NULL,
+                    peak_memory_bytes BIGINT NOT NULL,
+                    recorded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (file_id, page_num)
                 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
             ''')
-            print(f"✅ Table '{table_name}' ensured to exist")
-            
-        elif table_name == 'files':
+            add_missing_columns(cursor, 'render_profiles', RENDER_PROFILES_EXTRA_COLUMNS)
+            print("✅ Render profiles table created/verified")
+        except Error as e:
+            print(f"⚠️  Warning: Could not create render_profiles table: {e}")
+        
+        # Highlights, notes and bookmarks (ids are generated by the client)
+        try:
             cursor.execute('''
-                CREATE TABLE IF NOT EXISTS files (
-                    id INT AUTO_INCREMENT PRIMARY KEY,
+                CREATE TABLE IF NOT EXISTS annotations (
                     user_id INT NOT NULL,
-                    file_id VARCHAR(50) UNIQUE NOT NULL,
-                    original_filename VARCHAR(255) NOT NULL,
-                    stored_filename VARCHAR(255) NOT NULL,
-                    file_size BIGINT NOT NULL,
-                    file_size_display VARCHAR(20) NOT NULL,
-                    upload_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    last_read DATE DEFAULT NULL,
-                    INDEX idx_user_files (user_id),
-                    INDEX idx_file_id (file_id)
+                    annotation_id VARCHAR(36) NOT NULL,
+                    file_id VARCHAR(50) NOT NULL,
+                    page_number INT NOT NULL,
+                    kind VARCHAR(20) NOT NULL,
+                    data TEXT,
+                    created_at DATETIME NOT NULL,
+                    updated_at DATETIME NOT NULL,
+                    PRIMARY KEY (user_id, annotation_id),
+                    INDEX idx_annotations_page (user_id, file_id, page_number)
                 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
             ''')
-            # Try to add foreign key constraint if users table exists
-            try:
-                cursor.execute('SELECT 1 FROM users LIMIT 1')
-                cursor.execute('''
-                    ALTER TABLE files 
-                    ADD CONSTRAINT fk_files_user 
-                    FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
-                ''')
-            except Error:
-                pass  # Foreign key might already exist or users table might not exist
-            print(f"✅ Table '{table_name}' ensured to exist")
-            
-        elif table_name == 'book':
+            print("✅ Annotations table created/verified")
+        except Error as e:
+            print(f"⚠️  Warning: Could not create annotations table: {e}")
+        
+        # Reading analytics rolled up from the event log (see ReadingEventLog)
+        try:
             cursor.execute('''
-                CREATE TABLE IF NOT EXISTS book (
-                    id INT AUTO_INCREMENT PRIMARY KEY,
-                    username VARCHAR(120) NOT NULL,
-                    book_title VARCHAR(255) NOT NULL,
-                    size VARCHAR(20) NOT NULL,
-                    last_read DATE DEFAULT NULL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    INDEX idx_username (username)
+                CREATE TABLE IF NOT EXISTS reading_stats_daily (
+                    user_id INT NOT NULL,
+                    file_id VARCHAR(50) NOT NULL,
+                    day DATE NOT NULL,
+                    opens INT NOT NULL DEFAULT 0,
+                    flips INT NOT NULL DEFAULT 0,
+                    gotos INT NOT NULL DEFAULT 0,
+                    pages_viewed INT NOT NULL DEFAULT 0,
+                    seconds_read DOUBLE NOT NULL DEFAULT 0,
+                    PRIMARY KEY (user_id, file_id, day),
+                    INDEX idx_reading_stats_day (day, file_id)
                 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
             ''')
-            print(f"✅ Table '{table_name}' ensured to exist")
-            
-        elif table_name == 'user':
             cursor.execute('''
-                CREATE TABLE IF NOT EXISTS user (
-                    username VARCHAR(120) PRIMARY KEY,
-                    password VARCHAR(255) NOT NULL
+                CREATE TABLE IF NOT EXISTS event_log_segments (
+                    segment VARCHAR(100) PRIMARY KEY,
+                    events INT NOT NULL,
+                    rolled_up_at DATETIME NOT NULL
                 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
             ''')
-            print(f"✅ Table '{table_name}' ensured to exist")
+            print("✅ Reading stats tables created/verified")
+        except Error as e:
+            print(f"⚠️  Warning: Could not create reading stats tables: {e}")
         
         connection.commit()
         cursor.close()
         connection.close()
+        print("✅ Database tables initialization completed!")
         return True
         
     except Error as e:
-        print(f"❌ Failed to ensure table '{table_name}' exists: {e}")
+        print(f"❌ Database initialization failed: {e}")
         return False
 
 def test_database_connection():
@@ -275,7 +452,12 @@ def test_database_connection():
         return False
 
 def migrate_user_table():
-    """Migrate from old 'user' table to new 'users' table if needed"""
+    """Migrate every account of the old 'user' table into the 'users' table
+    
+    Accounts already in users (same email) are skipped, so the pass can be
+    re-run. Once it completes the schema version is bumped and login only
+    looks at 'users'.
+    """
     try:
         connection = get_db_connection()
         if connection is None:
@@ -283,202 +465,1503 @@ def migrate_user_table():
         
         cursor = connection.cursor()
         
-        # Check if old user table exists and new users table is empty
+        if get_schema_version(cursor) >= SCHEMA_VERSION_USERS_MIGRATED:
+            cursor.close()
+            connection.close()
+            return True
+        
+        failed = 0
         cursor.execute("SHOW TABLES LIKE 'user'")
         old_table_exists = cursor.fetchone() is not None
         
         if old_table_exists:
-            cursor.execute("SELECT COUNT(*) FROM users")
-            users_count = cursor.fetchone()[0]
+            cursor.execute(
+                '''SELECT o.username, o.password FROM user o
+                   LEFT JOIN users u ON u.email = o.username WHERE u.id IS NULL'''
+            )
+            old_users = cursor.fetchall()
             
-            if users_count == 0:
+            if old_users:
                 print("🔄 Migrating from 'user' table to 'users' table...")
-                # Migrate data from user to users table
-                cursor.execute("SELECT username, password FROM user")
-                old_users = cursor.fetchall()
+                # Hash the passwords (old table had plain text passwords) on the auth pool
+                password_hashes = list(auth_executor.map(generate_password_hash, [u[1] for u in old_users]))
                 
-                for old_user in old_users:
+                for old_user, password_hash in zip(old_users, password_hashes):
                     email = old_user[0]  # username was email in old table
                     username = email.split('@')[0]  # use part before @ as username
-                    # Hash the password (old table had plain text passwords)
-                    password_hash = generate_password_hash(old_user[1])
-                    
-                    try:
-                        cursor.execute(
-                            'INSERT INTO users (username, email, password_hash) VALUES (%s, %s, %s)',
-                            (username, email, password_hash)
-                        )
-                    except Error as e:
-                        print(f"Warning: Could not migrate user {email}: {e}")
+                    # Fall back to a suffixed username if the plain one is taken
+                    for candidate in (username, f"{username[:70]}_{uuid.uuid4().hex[:6]}"):
+                        try:
+                            cursor.execute(
+                                'INSERT INTO users (username, email, password_hash) VALUES (%s, %s, %s)',
+                                (candidate, email, password_hash)
+                            )
+                            break
+                        except Error as e:
+                            last_error = e
+                    else:
+                        print(f"Warning: Could not migrate user {email}: {last_error}")
+                        failed += 1
                 
                 connection.commit()
-                print(f"✅ Migrated {len(old_users)} users to new table structure")
+                print(f"✅ Migrated {len(old_users) - failed} users to new table structure")
+        
+        if not failed:
+            set_schema_version(cursor, SCHEMA_VERSION_USERS_MIGRATED)
+            connection.commit()
         
         cursor.close()
         connection.close()
-        return True
+        return not failed
         
     except Error as e:
         print(f"❌ Migration failed: {e}")
         return False
 
-# Create uploads folder if it doesn't exist
-def create_upload_folder():
-    if not os.path.exists(UPLOAD_FOLDER):
-        os.makedirs(UPLOAD_FOLDER)
-        print(f"Created uploads folder: {UPLOAD_FOLDER}")
+# Schema versions, recorded in the schema_version table once a migration is done
+SCHEMA_VERSION_USERS_MIGRATED = 1  # every legacy 'user' account copied into users
+SCHEMA_VERSION_BOOK_RETIRED = 2  # legacy book rows backfilled into files, book is a view
+SCHEMA_VERSION_RENDER_QUARANTINE = 3  # files.status and files.render_failures
+SCHEMA_VERSION_ANNOTATIONS = 4  # annotations table
+SCHEMA_VERSION_READING_STATS = 5  # reading_stats_daily and event_log_segments
+SCHEMA_VERSION_INGEST_VALIDATION = 6  # files.page_count and files.status_detail
+SCHEMA_VERSION_RENDER_PROFILE_MEMORY = 7  # render_profiles.peak_memory_measured
+SCHEMA_VERSION = SCHEMA_VERSION_RENDER_PROFILE_MEMORY
+BOOK_BACKFILL_BATCH_SIZE = 500
 
-def allowed_file(filename):
-    """Check if the uploaded file is a PDF"""
-    return '.' in filename and \
-           filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+def get_schema_version(cursor):
+    """Version of the last completed migration (0 if none)"""
+    try:
+        cursor.execute('SELECT version FROM schema_version WHERE id = 1')
+        row = cursor.fetchone()
+        return row[0] if row else 0
+    except Error:
+        return 0
 
-# Authentication decorator
-def login_required(f):
-    @wraps(f)
-    def decorated_function(*args, **kwargs):
-        if 'user_id' not in session:
-            return jsonify({'error': 'Authentication required', 'login_required': True}), 401
-        return f(*args, **kwargs)
-    return decorated_function
+def set_schema_version(cursor, version):
+    cursor.execute(
+        'INSERT INTO schema_version (id, version) VALUES (1, %s) ON DUPLICATE KEY UPDATE version = %s',
+        (version, version)
+    )
 
-@app.route('/')
-def index():
-    """Render the main page"""
-    return render_template('index.html')
+def parse_file_size_display(size_display):
+    """Turn a size string like '2.35 MB' back into bytes"""
+    try:
+        return int(float(str(size_display).split()[0]) * 1024 * 1024)
+    except (ValueError, IndexError):
+        return 0
 
-@app.route('/register', methods=['POST'])
-def register():
-    """Handle user registration with enhanced validation and password hashing"""
+def migrate_book_table(batch_size=BOOK_BACKFILL_BATCH_SIZE):
+    """Backfill legacy 'book' rows into 'files' and replace 'book' with a compatibility view
+    
+    Rows are copied in batches and rows already present in files (same user and
+    filename) are skipped, so an interrupted run can simply be started again.
+    """
     try:
-        data = request.get_json()
-        username = data.get('username', '').strip()
-        email = data.get('email', '').strip()
-        password = data.get('password', '')
-        
-        # Enhanced validation
-        if not username or not email or not password:
-            return jsonify({'error': 'All fields are required'}), 400
-        
-        if len(username) < 3:
-            return jsonify({'error': 'Username must be at least 3 characters long'}), 400
-        
-        if len(password) < 6:
-            return jsonify({'error': 'Password must be at least 6 characters long'}), 400
-        
-        if len(password) > 50:
-            return jsonify({'error': 'Password must be 50 characters or less'}), 400
-        
-        if len(email) > 120:
-            return jsonify({'error': 'Email must be 120 characters or less'}), 400
-        
-        if len(username) > 80:
-            return jsonify({'error': 'Username must be 80 characters or less'}), 400
-        
-        # Connect to database
         connection = get_db_connection()
         if connection is None:
-            return jsonify({'error': 'Database connection failed'}), 500
+            return False
         
         cursor = connection.cursor()
         
-        # Check if user already exists
-        cursor.execute('SELECT id FROM users WHERE username = %s OR email = %s', (username, email))
-        existing_user = cursor.fetchone()
-        
-        if existing_user:
+        schema_version = get_schema_version(cursor)
+        if schema_version >= SCHEMA_VERSION_BOOK_RETIRED:
             cursor.close()
             connection.close()
-            return jsonify({'error': 'Username or email already exists'}), 400
+            return True
+        if schema_version < SCHEMA_VERSION_USERS_MIGRATED:
+            # Books are matched to accounts by email, so users must be migrated first
+            print("⚠️  Skipping book migration until the user migration has completed")
+            cursor.close()
+            connection.close()
+            return False
         
-        # Create new user with hashed password
-        password_hash = generate_password_hash(password)
-        cursor.execute(
-            'INSERT INTO users (username, email, password_hash) VALUES (%s, %s, %s)',
-            (username, email, password_hash)
-        )
-        user_id = cursor.lastrowid
+        cursor.execute("SHOW FULL TABLES LIKE 'book'")
+        book_table = cursor.fetchone()
+        if book_table and book_table[1] == 'BASE TABLE':
+            print("🔄 Backfilling 'book' table into 'files' table...")
+            
+            # Legacy rows only know the title, find the uploaded file it came from
+            # (in either layout, see blob storage below)
+            stored_by_title = {}
+            for key, size in sorted(blob_storage.list_blobs()):
+                name = key.rsplit('/', 1)[-1]
+                if '_' in name:
+                    stored_by_title.setdefault(name.split('_', 1)[1], (key, size))
+            
+            last_id = 0
+            migrated = 0
+            while True:
+                cursor.execute(
+                    '''SELECT b.id, b.book_title, b.size, b.last_read, b.created_at, u.id
+                       FROM book b LEFT JOIN users u ON u.email = b.username
+                       WHERE b.id > %s ORDER BY b.id LIMIT %s''',
+                    (last_id, batch_size)
+                )
+                rows = cursor.fetchall()
+                if not rows:
+                    break
+                last_id = rows[-1][0]
+                
+                user_ids = list({row[5] for row in rows if row[5] is not None})
+                existing = set()
+                if user_ids:
+                    placeholders = ', '.join(['%s'] * len(user_ids))
+                    cursor.execute(
+                        f'SELECT user_id, original_filename FROM files WHERE user_id IN ({placeholders})',
+                        user_ids
+                    )
+                    existing = set(cursor.fetchall())
+                
+                new_files = []
+                for book_id, title, size, last_read, created_at, user_id in rows:
+                    if user_id is None or (user_id, title) in existing:
+                        continue  # Unknown user, or already in files
+                    existing.add((user_id, title))
+                    if title in stored_by_title:
+                        stored_filename, file_size = stored_by_title[title]
+                        file_id = stored_filename.rsplit('/', 1)[-1].split('_', 1)[0]
+                    else:
+                        file_id = str(uuid.uuid4())
+                        stored_filename = ''  # The PDF itself was never kept
+                        file_size = parse_file_size_display(size)
+                    new_files.append((user_id, file_id, title, stored_filename, file_size, size,
+                                      created_at, last_read))
+                
+                if new_files:
+                    cursor.executemany(
+                        '''INSERT IGNORE INTO files (user_id, file_id, original_filename, stored_filename,
+                           file_size, file_size_display, upload_date, last_read)
+                           VALUES (%s, %s, %s, %s, %s, %s, %s, %s)''',
+                        new_files
+                    )
+                    migrated += cursor.rowcount
+                connection.commit()
+            
+            print(f"✅ Backfilled {migrated} book rows into files table")
+            
+            # Keep the old rows around and serve 'book' from files from now on
+            cursor.execute('RENAME TABLE book TO book_legacy')
+        
+        cursor.execute('''
+            CREATE OR REPLACE VIEW book AS
+            SELECT f.id, u.email AS username, f.original_filename AS book_title,
+                   f.file_size_display AS size, f.last_read, f.upload_date AS created_at
+            FROM files f JOIN users u ON u.id = f.user_id
+        ''')
+        set_schema_version(cursor, SCHEMA_VERSION_BOOK_RETIRED)
         connection.commit()
+        print("✅ 'book' is now a view over 'files'")
+        
         cursor.close()
         connection.close()
-        
-        # Log in the user
-        session['user_id'] = user_id
-        session['username'] = username
-        session['email'] = email
-        
-        return jsonify({
-            'success': True,
-            'message': 'Registration successful',
-            'user': {'id': user_id, 'username': username, 'email': email}
-        }), 201
+        return True
         
     except Error as e:
-        return jsonify({'error': f'Database error: {str(e)}'}), 500
-    except Exception as e:
-        return jsonify({'error': f'Registration failed: {str(e)}'}), 500
+        print(f"❌ Book table migration failed: {e}")
+        return False
 
-@app.route('/login', methods=['POST'])
-def login():
-    """Handle user login with password hash verification"""
+def schema_is_current():
+    """Cheap startup check: a single read of the schema_version row"""
+    connection = get_db_connection()
+    if connection is None:
+        return False
     try:
-        data = request.get_json()
-        email = data.get('email', '').strip()
-        password = data.get('password', '')
-        
-        if not email or not password:
-            return jsonify({'error': 'Email and password are required'}), 400
-        
-        # Connect to database
-        connection = get_db_connection()
-        if connection is None:
-            return jsonify({'error': 'Database connection failed'}), 500
-        
         cursor = connection.cursor()
-        
-        # Check user credentials in new users table
-        cursor.execute(
-            'SELECT id, username, email, password_hash FROM users WHERE email = %s',
-            (email,)
-        )
-        user = cursor.fetchone()
-        
-        # Fallback to old user table if new table doesn't have the user
-        if not user:
-            cursor.execute(
-                'SELECT username, password FROM user WHERE username = %s',
-                (email,)
-            )
-            old_user = cursor.fetchone()
-            if old_user and old_user[1] == password:  # Plain text password in old table
-                # Migrate this user to new table
-                username = email.split('@')[0]
-                password_hash = generate_password_hash(password)
-                cursor.execute(
-                    'INSERT INTO users (username, email, password_hash) VALUES (%s, %s, %s)',
-                    (username, email, password_hash)
-                )
-                user_id = cursor.lastrowid
-                connection.commit()
-                user = (user_id, username, email, password_hash)
-        
+        current = get_schema_version(cursor) >= SCHEMA_VERSION
         cursor.close()
+        return current
+    finally:
         connection.close()
-        
-        if user and check_password_hash(user[3], password):
-            # Login successful
-            session['user_id'] = user[0]
-            session['username'] = user[1]
-            session['email'] = user[2]
-            
-            return jsonify({
-                'success': True,
-                'message': 'Login successful',
-                'user': {'id': user[0], 'username': user[1], 'email': user[2]}
-            }), 200
-        else:
+
+def setup_database():
+    """Create tables and run migrations, then mark the schema as current"""
+    print("🔄 Initializing database...")
+    if not init_db():
+        print("❌ Database initialization failed.")
+        print("Update the DB_CONFIG dictionary with your MySQL credentials.")
+        return False
+    
+    print("🔄 Running migration check...")
+    if not (migrate_user_table() and migrate_book_table()):
+        print("⚠️  Migrations incomplete, they will be retried on the next start")
+        return False
+    
+    connection = get_db_connection()
+    if connection is None:
+        return False
+    cursor = connection.cursor()
+    if get_schema_version(cursor) < SCHEMA_VERSION:
+        set_schema_version(cursor, SCHEMA_VERSION)
+        connection.commit()
+    cursor.close()
+    connection.close()
+    return True
+
+startup_done = False
+
+def startup():
+    """Prepare the database and upload folder (fast when the schema is current)"""
+    global startup_done
+    if startup_done:
+        return
+    startup_done = True
+    
+    if schema_is_current():
+        print("✅ Database schema is current, skipping table setup (use --check for diagnostics)")
+    elif setup_database():
+        print("✅ Database ready!")
+    
+    # Create upload folder on startup
+    create_upload_folder()
+
+def run_startup_checks():
+    """Full setup plus the expensive diagnostics (python main.py --check)"""
+    ok = setup_database()
+    print("🔄 Testing database connection...")
+    ok = test_database_connection() and ok
+    ok = check_json_provider() and ok
+    print("✅ All checks passed" if ok else "❌ Some checks failed")
+    return ok
+
+# Create uploads folder if it doesn't exist
+def create_upload_folder():
+    if not os.path.exists(UPLOAD_FOLDER):
+        os.makedirs(UPLOAD_FOLDER)
+        print(f"Created uploads folder: {UPLOAD_FOLDER}")
+
+def allowed_file(filename):
+    """Check if the uploaded file is a PDF"""
+    return '.' in filename and \
+           filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+
+def format_file_size(file_size):
+    """Size string shown in the library, e.g. '2.35 MB'"""
+    return f"{round(file_size / (1024*1024), 2)} MB"
+
+# Blob storage
+#
+# Uploaded PDFs are addressed by their stored_filename, used as a blob key.
+# Keys may contain '/' (sharded layout). Readers always get a local path
+# because fitz and send_file need real files; the S3 backend keeps a local
+# read-through cache for that.
+#
+# New uploads use the sharded layout; older rows keep flat keys until
+# `python main.py --migrate-uploads` moves them. While that runs a file may
+# already be moved before its row is updated, so lookups fall back to the
+# other layout (alternate_key).
+
+def shard_key(name):
+    """Two-level hashed key for a new blob, e.g. '3f/a2/<name>'"""
+    digest = hashlib.md5(name.encode('utf-8')).hexdigest()
+    return f"{digest[:2]}/{digest[2:4]}/{name}"
+
+def alternate_key(key):
+    """The same blob's key in the other layout (flat <-> sharded)"""
+    if '/' in key:
+        return key.rsplit('/', 1)[1]
+    return shard_key(key)
+
+class LocalBlobStorage:
+    """Blobs stored as files under a root directory"""
+    is_local = True
+    
+    def __init__(self, root, shard=False):
+        self.root = root
+        self.shard = shard
+    
+    def new_key(self, name):
+        """Key for a new upload"""
+        return shard_key(name) if self.shard else name
+    
+    def path(self, key):
+        return os.path.join(self.root, *key.split('/'))
+    
+    def local_path(self, key):
+        """Local file holding the blob, in either layout (may not exist)"""
+        path = self.path(key)
+        if not os.path.isfile(path):
+            other_path = self.path(alternate_key(key))
+            if os.path.isfile(other_path):
+                return other_path
+        return path
+    
+    def staging_path(self, key):
+        """Where to write a new blob before commit()"""
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        return path
+    
+    def commit(self, key):
+        """Publish a blob written to staging_path (nothing to do locally)"""
+    
+    def save(self, fileobj, key):
+        """Store an uploaded file (werkzeug FileStorage) and return its local path"""
+        path = self.staging_path(key)
+        fileobj.save(path)
+        self.commit(key)
+        return path
+    
+    def exists(self, key):
+        return os.path.isfile(self.path(key))
+    
+    def list_blobs(self):
+        """(key, size) of every stored blob, in either layout"""
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    size = os.path.getsize(path)
+                except OSError:
+                    continue  # removed while listing
+                yield os.path.relpath(path, self.root).replace(os.sep, '/'), size
+    
+    def delete(self, key):
+        path = self.local_path(key)
+        if os.path.exists(path):
+            os.remove(path)
+            print(f"✅ Physical file deleted: {path}")
+    
+    def move(self, src_key, dst_key):
+        """Rename a blob (atomic on the same filesystem)"""
+        src_path = self.path(src_key)
+        if not os.path.isfile(src_path):
+            raise FileNotFoundError(src_path)
+        os.replace(src_path, self.staging_path(dst_key))
+
+class S3BlobStorage:
+    """Blobs in an S3-compatible bucket with a local read-through cache.
+    
+    endpoint_url points the client at MinIO, a moto server or any other
+    S3 stand-in. Requires boto3.
+    """
+    is_local = False
+    
+    def __init__(self, bucket, prefix='', endpoint_url=None, cache_dir=BLOB_CACHE_FOLDER,
+                 cache_max_bytes=BLOB_CACHE_MAX_BYTES, shard=False):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.endpoint_url = endpoint_url
+        self.cache = LocalBlobStorage(cache_dir)
+        self.cache_max_bytes = cache_max_bytes
+        self.shard = shard
+        self._client = None
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+    
+    @property
+    def client(self):
+        if self._client is None:
+            import boto3
+            self._client = boto3.client('s3', endpoint_url=self.endpoint_url)
+        return self._client
+    
+    def new_key(self, name):
+        return shard_key(name) if self.shard else name
+    
+    def _object_key(self, key):
+        return f"{self.prefix}{key}"
+    
+    def _key_lock(self, key):
+        with self._locks_lock:
+            return self._locks.setdefault(key, threading.Lock())
+    
+    def local_path(self, key):
+        """Cached copy of the blob, downloaded on first use (may not exist if the blob doesn't)"""
+        path = self.cache.path(key)
+        if os.path.isfile(path):
+            os.utime(path)  # recently used, kept by trim_cache()
+            return path
+        
+        with self._key_lock(key):
+            if not os.path.isfile(path):
+                tmp_path = f"{self.cache.staging_path(key)}.{uuid.uuid4().hex}.part"
+                try:
+                    try:
+                        self.client.download_file(self.bucket, self._object_key(key), tmp_path)
+                    except Exception:
+                        # Possibly moved by --migrate-uploads before its row was updated
+                        self.client.download_file(self.bucket, self._object_key(alternate_key(key)), tmp_path)
+                    os.replace(tmp_path, path)
+                except Exception as e:
+                    print(f"⚠️  Warning: Could not fetch blob {key}: {e}")
+                    if os.path.exists(tmp_path):
+                        os.remove(tmp_path)
+                    return path
+        self.trim_cache()
+        return path
+    
+    def staging_path(self, key):
+        return self.cache.staging_path(key)
+    
+    def commit(self, key):
+        """Upload a blob written to staging_path (it stays cached)"""
+        self.client.upload_file(self.cache.path(key), self.bucket, self._object_key(key))
+    
+    def save(self, fileobj, key):
+        path = self.staging_path(key)
+        fileobj.save(path)
+        try:
+            self.commit(key)
+        except Exception:
+            os.remove(path)
+            raise
+        return path
+    
+    def exists(self, key):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self._object_key(key))
+            return True
+        except Exception:
+            return False
+    
+    def list_blobs(self):
+        """(key, size) of every blob under the prefix"""
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix):
+            for item in page.get('Contents', []):
+                yield item['Key'][len(self.prefix):], item['Size']
+    
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=self._object_key(key))
+        self.cache.delete(key)
+    
+    def move(self, src_key, dst_key):
+        """Copy a blob to a new key, then remove the old one"""
+        self.client.copy_object(
+            Bucket=self.bucket, Key=self._object_key(dst_key),
+            CopySource={'Bucket': self.bucket, 'Key': self._object_key(src_key)}
+        )
+        self.client.delete_object(Bucket=self.bucket, Key=self._object_key(src_key))
+        if os.path.isfile(self.cache.path(src_key)):
+            self.cache.move(src_key, dst_key)
+    
+    def trim_cache(self):
+        """Drop the least recently used cached blobs beyond cache_max_bytes"""
+        entries = []
+        for dirpath, _, filenames in os.walk(self.cache.root):
+            for filename in filenames:
+                if filename.endswith('.part'):
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.cache_max_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+
+def create_blob_storage(backend, shard, upload_folder):
+    """Storage backend for BLOB_STORAGE_BACKEND"""
+    if backend == 's3':
+        if not importlib.util.find_spec('boto3'):
+            raise RuntimeError("BLOB_STORAGE_BACKEND = 's3' requires boto3 (pip install boto3)")
+        return S3BlobStorage(S3_BUCKET, S3_PREFIX, S3_ENDPOINT_URL, shard=shard)
+    return LocalBlobStorage(upload_folder, shard=shard)
+
+class ConfiguredBlobStorage:
+    """The backend selected by app.config (BLOB_STORAGE_BACKEND, BLOB_SHARD_UPLOADS,
+    UPLOAD_FOLDER), built on first use and rebuilt if those settings change"""
+    def __init__(self):
+        self._settings = None
+        self._backend = None
+        self._lock = threading.Lock()
+    
+    def backend(self):
+        settings = (app.config['BLOB_STORAGE_BACKEND'], app.config['BLOB_SHARD_UPLOADS'],
+                    app.config['UPLOAD_FOLDER'])
+        with self._lock:
+            if settings != self._settings:
+                self._backend = create_blob_storage(*settings)
+                self._settings = settings
+            return self._backend
+    
+    def __getattr__(self, name):
+        return getattr(self.backend(), name)
+
+blob_storage = ConfiguredBlobStorage()
+
+def migrate_uploads_to_sharded_layout(batch_size=UPLOAD_MIGRATION_BATCH_SIZE, pause=0.0):
+    """Move flat-layout uploads to sharded keys (python main.py --migrate-uploads)
+    
+    Safe to run while the app is serving: each file is moved first and its row
+    updated right after, and lookups in between find it through alternate_key.
+    Rows already migrated are skipped, so an interrupted run can be restarted.
+    """
+    connection = get_db_connection()
+    if connection is None:
+        print("❌ Database connection failed")
+        return False
+    
+    try:
+        cursor = connection.cursor()
+        last_id = 0
+        moved = 0
+        missing = 0
+        while True:
+            cursor.execute(
+                '''SELECT id, stored_filename, source_filename FROM files
+                   WHERE id > %s AND (stored_filename NOT LIKE %s OR source_filename NOT LIKE %s)
+                   ORDER BY id LIMIT %s''',
+                (last_id, '%/%', '%/%', batch_size)
+            )
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            
+            updates = []
+            for row_id, stored_filename, source_filename in rows:
+                new_names = []
+                for name in (stored_filename, source_filename):
+                    if not name or '/' in name:
+                        new_names.append(name)
+                        continue
+                    new_name = shard_key(name)
+                    try:
+                        blob_storage.move(name, new_name)
+                        moved += 1
+                    except Exception as e:
+                        if not blob_storage.exists(new_name):
+                            print(f"⚠️  Warning: Could not move {name}: {e}")
+                            missing += 1
+                            new_name = name
+                    new_names.append(new_name)
+                if new_names != [stored_filename, source_filename]:
+                    updates.append((new_names[0], new_names[1], row_id, stored_filename))
+            
+            if updates:
+                cursor.executemany(
+                    'UPDATE files SET stored_filename = %s, source_filename = %s WHERE id = %s AND stored_filename = %s',
+                    updates
+                )
+                connection.commit()
+            print(f"🔄 Migrated uploads up to row {last_id}: {moved} files moved, {missing} missing")
+            if pause:
+                time.sleep(pause)
+        
+        cursor.close()
+        print(f"✅ Upload migration complete: {moved} files moved, {missing} missing")
+        return True
+    except Error as e:
+        print(f"❌ Upload migration failed (run it again to resume): {e}")
+        return False
+    finally:
+        connection.close()
+
+# Ingest worker pool (processes, so a heavy rewrite never blocks request threads)
+ingest_executor = None
+ingest_executor_lock = threading.Lock()
+
+def get_ingest_executor():
+    """Create the ingest process pool on first use"""
+    global ingest_executor
+    with ingest_executor_lock:
+        if ingest_executor is None:
+            ingest_executor = ProcessPoolExecutor(max_workers=INGEST_WORKERS)
+        return ingest_executor
+
+def optimize_pdf(src_path, dst_path):
+    """Write a garbage collected, deflated and linearized copy of a PDF, returns its size"""
+    import fitz
+    
+    pdf_doc = fitz.open(src_path)
+    try:
+        pdf_doc.save(dst_path, garbage=3, deflate=True, linear=True)
+    finally:
+        pdf_doc.close()
+    return os.path.getsize(dst_path)
+
+def schedule_pdf_optimization(file_id, stored_filename):
+    """Optimize an uploaded PDF in the background, keeping the original file"""
+    src_path = blob_storage.local_path(stored_filename)
+    optimized_filename = stored_filename.replace(f"{file_id}_", f"{file_id}_optimized_", 1)
+    dst_path = blob_storage.staging_path(optimized_filename)
+    original_size = os.path.getsize(src_path)
+    
+    future = get_ingest_executor().submit(optimize_pdf, src_path, dst_path)
+    future.add_done_callback(
+        lambda f: _finish_pdf_optimization(f, file_id, stored_filename, optimized_filename, original_size)
+    )
+    return future
+
+def _finish_pdf_optimization(future, file_id, stored_filename, optimized_filename, original_size):
+    """Point the files row at the optimized copy if it turned out smaller"""
+    dst_path = blob_storage.staging_path(optimized_filename)
+    try:
+        optimized_size = future.result()
+        if optimized_size < original_size:
+            blob_storage.commit(optimized_filename)
+    except Exception as e:
+        print(f"⚠️  Warning: Could not optimize {stored_filename}: {e}")
+        if os.path.exists(dst_path):
+            os.remove(dst_path)
+        return
+    
+    if optimized_size >= original_size:
+        os.remove(dst_path)
+        print(f"ℹ️  {stored_filename} is already optimal, keeping it as is")
+        return
+    
+    updated = False
+    connection = get_db_connection()
+    if connection is not None:
+        try:
+            cursor = connection.cursor()
+            cursor.execute(
+                '''UPDATE files SET stored_filename = %s, source_filename = %s, original_file_size = %s,
+                   file_size = %s, file_size_display = %s WHERE file_id = %s AND stored_filename = %s''',
+                (optimized_filename, stored_filename, original_size, optimized_size,
+                 format_file_size(optimized_size), file_id, stored_filename)
+            )
+            updated = cursor.rowcount > 0
+            connection.commit()
+            cursor.close()
+        except Error as e:
+            print(f"⚠️  Warning: Could not record optimized file: {e}")
+        finally:
+            connection.close()
+    
+    if updated:
+        saved = original_size - optimized_size
+        print(f"✅ Optimized {stored_filename}: saved {saved} bytes ({saved * 100 // original_size}%)")
+    else:
+        remove_blobs_later([optimized_filename])  # File was deleted (or the DB is unavailable) meanwhile
+
+# Ingest validation
+#
+# Every upload is checked once in a render sandbox worker (magic bytes,
+# encryption, page count, every page object loadable). Files MuPDF had to
+# repair are replaced by the repaired copy, and the outcome is recorded in
+# files.status, so readers never send known-bad documents to the renderers.
+# Optimization and upload thumbnails run after a document passes.
+validation_executor = ThreadPoolExecutor(max_workers=INGEST_WORKERS, thread_name_prefix='pdf-validate')
+
+def has_pdf_header(file):
+    """Whether an uploaded file (werkzeug FileStorage) starts with a PDF header"""
+    head = file.stream.read(PDF_HEADER_SEARCH_BYTES)
+    file.stream.seek(0)
+    return b'%PDF-' in head
+
+def schedule_pdf_validation(file_id, stored_filename):
+    """Validate an uploaded PDF in the background"""
+    return validation_executor.submit(validate_upload, file_id, stored_filename)
+
+def validate_upload(file_id, stored_filename):
+    """Check a stored PDF, keep a repaired copy if needed and record the outcome, returns the status"""
+    repaired_filename = stored_filename.replace(f"{file_id}_", f"{file_id}_repaired_", 1)
+    repaired_path = blob_storage.staging_path(repaired_filename)
+    try:
+        status, detail, page_count, repaired = run_render_job(
+            'validate', None, blob_storage.local_path(stored_filename), repaired_path
+        )
+    except RenderBusyError as e:
+        print(f"⚠️  Warning: Could not validate {stored_filename} now ({e}), it stays pending")
+        return 'pending'
+    except RenderFailedError as e:
+        status, detail, page_count, repaired = 'invalid', f'Validation failed ({e.reason}): {e}', None, False
+    
+    columns = {'status': status, 'status_detail': (detail or '')[:255] or None, 'page_count': page_count}
+    if repaired:
+        try:
+            blob_storage.commit(repaired_filename)
+            repaired_size = os.path.getsize(repaired_path)
+            columns.update(stored_filename=repaired_filename, source_filename=stored_filename,
+                           file_size=repaired_size, file_size_display=format_file_size(repaired_size))
+        except Exception as e:
+            print(f"⚠️  Warning: Could not store repaired copy of {stored_filename}: {e}")
+            repaired = False
+    if not repaired and os.path.exists(repaired_path):
+        os.remove(repaired_path)
+    
+    updated = False
+    connection = get_db_connection()
+    if connection is not None:
+        try:
+            cursor = connection.cursor()
+            assignments = ', '.join(f'{column} = %s' for column in columns)
+            cursor.execute(
+                f'UPDATE files SET {assignments} WHERE file_id = %s AND stored_filename = %s',
+                (*columns.values(), file_id, stored_filename)
+            )
+            updated = cursor.rowcount > 0
+            connection.commit()
+            cursor.close()
+        except Error as e:
+            print(f"⚠️  Warning: Could not record validation of {stored_filename}: {e}")
+        finally:
+            connection.close()
+    
+    if not updated:
+        if repaired:
+            remove_blobs_later([repaired_filename])  # File was deleted (or the DB is unavailable) meanwhile
+        return status
+    
+    if status in UNREADABLE_STATUSES:
+        quarantined_files.add(file_id)
+        print(f"⚠️  Rejected {stored_filename} ({status}): {detail}")
+        return status
+    
+    stored_filename = columns.get('stored_filename', stored_filename)
+    print(f"✅ Validated {stored_filename}: {page_count} pages{', repaired' if repaired else ''}")
+    # A repaired copy is already garbage collected and deflated
+    if app.config['OPTIMIZE_PDF_ON_UPLOAD'] and not repaired:
+        schedule_pdf_optimization(file_id, stored_filename)
+    if app.config['THUMBNAILS_ON_UPLOAD']:
+        schedule_thumbnail_sheet(file_id, blob_storage.local_path(stored_filename))
+    return status
+
+def validate_library(batch_size=UPLOAD_MIGRATION_BATCH_SIZE, pause=0.0):
+    """Validate stored PDFs that were never checked (uploaded before validation existed)"""
+    connection = get_db_connection()
+    if connection is None:
+        print("❌ Validation failed: no database connection")
+        return False
+    try:
+        cursor = connection.cursor()
+        last_id = 0
+        counts = {}
+        while True:
+            cursor.execute(
+                '''SELECT id, file_id, stored_filename FROM files
+                   WHERE id > %s AND page_count IS NULL AND status IN ('ok', 'pending')
+                   ORDER BY id LIMIT %s''',
+                (last_id, batch_size)
+            )
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            for _, file_id, stored_filename in rows:
+                status = validate_upload(file_id, stored_filename)
+                counts[status] = counts.get(status, 0) + 1
+            print(f"🔄 Validated files up to row {last_id}: {counts}")
+            if pause:
+                time.sleep(pause)
+        cursor.close()
+        print(f"✅ Validation complete: {counts}")
+        return True
+    except Error as e:
+        print(f"❌ Validation failed (run it again to resume): {e}")
+        return False
+    finally:
+        connection.close()
+
+def save_uploaded_pdf(file):
+    """Save an uploaded PDF under a unique name and return its details"""
+    # Create uploads folder if it doesn't exist
+    create_upload_folder()
+    
+    file_id = str(uuid.uuid4())
+    original_filename = secure_filename(file.filename)
+    stored_filename = blob_storage.new_key(f"{file_id}_{original_filename}")
+    
+    filepath = blob_storage.save(file, stored_filename)
+    
+    file_size = os.path.getsize(filepath)
+    return {
+        'file_id': file_id,
+        'original_filename': original_filename,
+        'stored_filename': stored_filename,
+        'filepath': filepath,
+        'file_size': file_size,
+        'file_size_mb': format_file_size(file_size)
+    }
+
+# Physical files are removed off the request path, after the DB commit
+file_cleanup_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='file-cleanup')
+
+def remove_files_later(paths):
+    """Delete files from disk in the background"""
+    if paths:
+        file_cleanup_executor.submit(_remove_physical_files, list(paths))
+
+def remove_blobs_later(keys):
+    """Delete stored PDFs (by stored_filename) in the background"""
+    keys = [key for key in keys if key]
+    if keys:
+        file_cleanup_executor.submit(_remove_blobs, keys)
+
+def _remove_blobs(keys):
+    for key in keys:
+        try:
+            blob_storage.delete(key)
+        except Exception as e:
+            print(f"⚠️  Warning: Could not delete stored file {key}: {e}")
+
+def _remove_physical_files(paths):
+    for physical_file_path in paths:
+        if os.path.exists(physical_file_path):
+            try:
+                if os.path.isdir(physical_file_path):
+                    shutil.rmtree(physical_file_path)
+                else:
+                    os.remove(physical_file_path)
+                print(f"✅ Physical file deleted: {physical_file_path}")
+            except Exception as e:
+                print(f"⚠️  Warning: Could not delete physical file: {e}")
+
+# Password hashing and login throttling
+#
+# Hashes are computed on a small dedicated pool (hashlib releases the GIL) and
+# at most AUTH_MAX_PENDING may be queued; beyond that requests are turned away
+# at once, so a credential-stuffing burst cannot tie up every worker.
+AUTH_HASH_WORKERS = 4
+AUTH_MAX_PENDING = 16
+LOGIN_ATTEMPTS_PER_MINUTE = 10  # per client address and per account
+LOGIN_BURST = 10
+
+# Rate limits. Buckets live in this process ('memory') or are shared by every
+# worker through Redis ('redis', needs the redis package).
+RATE_LIMIT_STORE = 'memory'
+RATE_LIMIT_REDIS_URL = 'redis://localhost:6379/0'
+# Reader endpoints: (requests per second, burst) per user and endpoint
+ENDPOINT_RATE_LIMITS = {
+    'initialize': (1, 10),
+    'navigate': (8, 30),  # next/prev/goto, also stream intents
+    'page': (8, 30),
+    'pages': (2, 10),
+    'annotations': (5, 20),
+}
+
+auth_executor = ThreadPoolExecutor(max_workers=AUTH_HASH_WORKERS, thread_name_prefix='auth-hash')
+auth_slots = threading.BoundedSemaphore(AUTH_MAX_PENDING)
+
+class AuthBusyError(Exception):
+    """Raised when the password hashing pool is saturated"""
+
+def run_password_hashing(hash_function, *args):
+    """Run generate_password_hash/check_password_hash on the auth pool"""
+    if not auth_slots.acquire(blocking=False):
+        raise AuthBusyError()
+    try:
+        return auth_executor.submit(hash_function, *args).result()
+    finally:
+        auth_slots.release()
+
+def auth_busy_response():
+    response = jsonify({'error': 'Server is busy. Please try again in a moment.'})
+    response.headers['Retry-After'] = '1'
+    return response, 503
+
+class TokenBucket:
+    """Token bucket refilled continuously at `rate` tokens per second"""
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+    
+    def consume(self, tokens=1):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= tokens:
+            self.tokens -= tokens
+            return True
+        return False
+
+class MemoryRateLimitStore:
+    """Token buckets held in this process (one set per worker process)"""
+    def __init__(self, max_keys=10000):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def consume(self, key, rate, capacity, tokens=1):
+        """Take tokens from a bucket, returns 0 or the seconds until they are available"""
+        with self._lock:
+            bucket = self._buckets.pop(key, None) or TokenBucket(rate, capacity)
+            self._buckets[key] = bucket  # most recently used last
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+            if bucket.consume(tokens):
+                return 0
+            return (tokens - bucket.tokens) / rate
+
+class RedisRateLimitStore:
+    """Token buckets shared by every worker and host through Redis.
+    
+    Each bucket is a hash updated by one Lua script, so concurrent requests
+    cannot both take the last token. When Redis is unreachable the limits are
+    enforced per process instead.
+    """
+    SCRIPT = '''
+        local rate, capacity = tonumber(ARGV[1]), tonumber(ARGV[2])
+        local tokens, now = tonumber(ARGV[3]), tonumber(ARGV[4])
+        local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+        local available = tonumber(bucket[1]) or capacity
+        local updated = tonumber(bucket[2]) or now
+        available = math.min(capacity, available + math.max(0, now - updated) * rate)
+        local wait = 0
+        if available >= tokens then
+            available = available - tokens
+        else
+            wait = (tokens - available) / rate
+        end
+        redis.call('HSET', KEYS[1], 'tokens', available, 'updated', now)
+        redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+        return tostring(wait)
+    '''
+    
+    def __init__(self, url, prefix='bookflip:ratelimit:'):
+        self.url = url
+        self.prefix = prefix
+        self.fallback = MemoryRateLimitStore()
+        self._script = None
+        self._retry_at = 0
+    
+    @property
+    def script(self):
+        if self._script is None:
+            import redis
+            client = redis.Redis.from_url(self.url, socket_timeout=0.5, socket_connect_timeout=0.5)
+            self._script = client.register_script(self.SCRIPT)
+        return self._script
+    
+    def consume(self, key, rate, capacity, tokens=1):
+        if time.monotonic() >= self._retry_at:
+            try:
+                return float(self.script(keys=[self.prefix + key], args=[rate, capacity, tokens, time.time()]))
+            except Exception as e:
+                print(f"⚠️  Warning: Redis rate limit store unavailable, limiting per process: {e}")
+                self._retry_at = time.monotonic() + 30
+        return self.fallback.consume(key, rate, capacity, tokens)
+
+def create_rate_limit_store():
+    """Rate limit store selected by RATE_LIMIT_STORE"""
+    if RATE_LIMIT_STORE == 'redis':
+        if not importlib.util.find_spec('redis'):
+            raise RuntimeError("RATE_LIMIT_STORE = 'redis' requires redis (pip install redis)")
+        return RedisRateLimitStore(RATE_LIMIT_REDIS_URL)
+    return MemoryRateLimitStore()
+
+rate_limit_store = create_rate_limit_store()
+
+class RateLimiter:
+    """Token buckets keyed by client or account, kept in a rate limit store"""
+    def __init__(self, rate, capacity, store=None):
+        self.rate = rate
+        self.capacity = capacity
+        self.store = store or rate_limit_store
+    
+    def check(self, key, tokens=1):
+        """Take tokens for key, returns 0 or the seconds to wait before retrying"""
+        return self.store.consume(key, self.rate, self.capacity, tokens)
+    
+    def allow(self, key):
+        return self.check(key) == 0
+
+login_rate_limiter = RateLimiter(LOGIN_ATTEMPTS_PER_MINUTE / 60, LOGIN_BURST)
+endpoint_rate_limiters = {name: RateLimiter(rate, burst) for name, (rate, burst) in ENDPOINT_RATE_LIMITS.items()}
+
+def rate_limited(name):
+    """Limit a view per user (per client address when logged out) with ENDPOINT_RATE_LIMITS[name]"""
+    limiter = endpoint_rate_limiters[name]
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            client = f"user:{session['user_id']}" if 'user_id' in session else f"ip:{request.remote_addr}"
+            wait = limiter.check(f"{name}:{client}")
+            if wait:
+                response = jsonify({'error': 'Too many requests. Please slow down.', 'retry_after': round(wait, 1)})
+                response.headers['Retry-After'] = str(math.ceil(wait))
+                return response, 429
+            return f(*args, **kwargs)
+        return decorated_function
+    return decorator
+
+# Session identity cache
+SESSION_CACHE_SIZE = 10000
+SESSION_CACHE_TTL = 60  # seconds
+
+class CachedSessionInterface(SecureCookieSessionInterface):
+    """Cookie sessions that remember recently verified cookies
+    
+    Every request used to re-verify the signature and decode the session
+    cookie. Verified cookies are cached briefly, keyed by their exact value,
+    so a reader flipping pages only pays for that once per SESSION_CACHE_TTL.
+    """
+    def __init__(self, max_entries=SESSION_CACHE_SIZE, ttl=SESSION_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._cache = OrderedDict()  # cookie value -> (session data, expires)
+        self._lock = threading.Lock()
+    
+    def open_session(self, app, request):
+        cookie = request.cookies.get(self.get_cookie_name(app))
+        if not cookie:
+            return self.session_class()
+        
+        now = time.monotonic()
+        with self._lock:
+            cached = self._cache.get(cookie)
+            if cached and cached[1] > now:
+                self._cache.move_to_end(cookie)
+                return self.session_class(cached[0])
+        
+        session_data = super().open_session(app, request)
+        if session_data:
+            with self._lock:
+                self._cache[cookie] = (dict(session_data), now + self.ttl)
+                while len(self._cache) > self.max_entries:
+                    self._cache.popitem(last=False)
+        return session_data
+
+app.session_interface = CachedSessionInterface()
+
+def benchmark_credential_checks(rounds=20):
+    """Print password check and session decoding throughput (python main.py --bench-auth)"""
+    password = 'benchmark-password'
+    password_hash = generate_password_hash(password)
+    
+    started = time.perf_counter()
+    for _ in range(rounds):
+        check_password_hash(password_hash, password)
+    inline_rate = rounds / (time.perf_counter() - started)
+    
+    started = time.perf_counter()
+    list(auth_executor.map(lambda _: check_password_hash(password_hash, password), range(rounds)))
+    pooled_rate = rounds / (time.perf_counter() - started)
+    
+    print(f"🔐 Password checks: {inline_rate:.1f}/s inline, "
+          f"{pooled_rate:.1f}/s on the auth pool ({AUTH_HASH_WORKERS} workers)")
+    
+    # Session cookie decoding, plain vs cached
+    cookie = app.session_interface.get_signing_serializer(app).dumps(
+        {'user_id': 1, 'username': 'benchmark', 'email': 'benchmark@example.com'}
+    )
+    session_rounds = rounds * 500
+    with app.test_request_context(headers={'Cookie': f"{app.config['SESSION_COOKIE_NAME']}={cookie}"}):
+        for label, interface in (('plain', SecureCookieSessionInterface()), ('cached', CachedSessionInterface())):
+            started = time.perf_counter()
+            for _ in range(session_rounds):
+                interface.open_session(app, request)
+            rate = session_rounds / (time.perf_counter() - started)
+            print(f"🍪 Session decoding ({label}): {rate:,.0f}/s")
+
+# Response compression and JSON encoding
+#
+# JSON responses are compressed with brotli or gzip (whatever the client
+# accepts, brotli preferred when installed). Images, PDFs and event streams
+# are left alone: they are already compressed or must not be buffered.
+# When orjson is installed it does the JSON encoding, with the same output
+# as Flask's default provider. Both are optional and looked up once, here.
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def negotiate_encoding(accept_encodings):
+    """'br', 'gzip' or None for a request's Accept-Encoding"""
+    offered = ['br', 'gzip'] if brotli else ['gzip']
+    return accept_encodings.best_match(offered)
+
+def compress_body(data, encoding):
+    if encoding == 'br':
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    return gzip.compress(data, compresslevel=GZIP_LEVEL)
+
+@app.after_request
+def compress_response(response):
+    """Compress JSON bodies when the client accepts it"""
+    if (response.mimetype not in COMPRESSIBLE_MIMETYPES or response.direct_passthrough
+            or response.is_streamed or 'Content-Encoding' in response.headers
+            or response.status_code in (204, 206, 304)):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = negotiate_encoding(request.accept_encodings)
+    data = response.get_data()
+    if not encoding or len(data) < COMPRESS_MIN_BYTES:
+        return response
+    response.set_data(compress_body(data, encoding))
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+class OrjsonProvider(DefaultJSONProvider):
+    """Flask's JSON provider with orjson doing the work (dates still use Flask's format)"""
+    def __init__(self, app):
+        super().__init__(app)
+        self.fallbacks = 0  # dumps() calls orjson could not handle
+    
+    def dumps(self, obj, **kwargs):
+        option = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+        # response() passes compact separators, or indent=2 in debug mode
+        sort_keys = kwargs.pop('sort_keys', self.sort_keys)
+        ensure_ascii = kwargs.pop('ensure_ascii', None)  # orjson writes UTF-8, valid JSON either way
+        indent = kwargs.get('indent')
+        separators = kwargs.get('separators', (',', ':'))
+        if set(kwargs) - {'indent', 'separators'} or indent not in (None, 2) or \
+                (indent is None and tuple(separators) != (',', ':')):
+            self.fallbacks += 1
+            if ensure_ascii is not None:
+                kwargs['ensure_ascii'] = ensure_ascii
+            return super().dumps(obj, sort_keys=sort_keys, **kwargs)
+        if indent == 2:
+            option |= orjson.OPT_INDENT_2
+        if sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(obj, default=self.default, option=option).decode()
+    
+    def loads(self, s, **kwargs):
+        if kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+if orjson:
+    app.json = OrjsonProvider(app)
+
+def check_json_provider():
+    """Whether jsonify() responses are encoded by orjson (when it is installed)"""
+    if not isinstance(app.json, OrjsonProvider):
+        print("ℹ️  orjson is not installed, responses use the standard json module")
+        return True
+    fallbacks = app.json.fallbacks
+    with app.app_context():
+        jsonify({'check': [1, 2, 3], 'when': datetime.now()})
+    if app.json.fallbacks != fallbacks:
+        print("❌ jsonify() is not going through orjson")
+        return False
+    print("✅ jsonify() responses are encoded by orjson")
+    return True
+
+def benchmark_json_payloads(rounds=200):
+    """Print serialization time and bytes on the wire for typical payloads (python main.py --bench-json)"""
+    import base64
+    
+    today = datetime.now()
+    library = {'files': [{
+        'file_id': str(uuid.uuid4()),
+        'filename': f"book_{i}.pdf",
+        'stored_filename': shard_key(f"book_{i}.pdf"),
+        'size': 1048576 + i,
+        'size_display': format_file_size(1048576 + i),
+        'size_mb': 1.0,
+        'upload_date': today.strftime('%Y-%m-%d'),
+        'last_read': today.strftime('%Y-%m-%d')
+    } for i in range(500)]}
+    # PNG bytes barely compress, random bytes are a fair stand-in
+    page = f"data:image/png;base64,{base64.b64encode(os.urandom(300 * 1024)).decode()}"
+    full_spread = {
+        'success': True, 'current_page_num': 11, 'total_pages': 240,
+        'left_page': {'page_number': 11, 'image_data': page},
+        'right_page': {'page_number': 12, 'image_data': page}
+    }
+    lean_spread = {
+        'success': True, 'current_page_num': 11,
+        'left_page': {'page_number': 11, 'image_data': None, 'cached': True},
+        'right_page': {'page_number': 12, 'image_data': page, 'cached': False}
+    }
+    
+    providers = [('json', DefaultJSONProvider(app))]
+    if orjson:
+        providers.append(('orjson', OrjsonProvider(app)))
+    encodings = ['gzip'] + (['br'] if brotli else [])
+    
+    for name, payload in (('library (500 files)', library), ('spread (2 pages)', full_spread),
+                          ('spread, one page cached', lean_spread)):
+        timings = []
+        for label, provider in providers:
+            started = time.perf_counter()
+            for _ in range(rounds):
+                body = provider.dumps(payload, separators=(',', ':'))  # as jsonify() calls it
+            timings.append(f"{label} {(time.perf_counter() - started) * 1000 / rounds:.3f} ms")
+        data = body.encode()
+        sizes = [f"raw {len(data):,} B"]
+        for encoding in encodings:
+            started = time.perf_counter()
+            compressed = compress_body(data, encoding)
+            sizes.append(f"{encoding} {len(compressed):,} B ({(time.perf_counter() - started) * 1000:.1f} ms)")
+        print(f"📦 {name}: {', '.join(timings)}; {', '.join(sizes)}")
+    check_json_provider()
+
+# Static assets
+#
+# Templates link assets through asset_url(), which adds a content hash
+# (?v=...). Fingerprinted URLs are cached by browsers for a year as
+# immutable; anything else must revalidate. Text assets are served from
+# .br/.gz copies written next to the file the first time they are needed,
+# and rewritten when the file changes. The copies are only reachable through
+# Accept-Encoding negotiation; requesting one directly is a 404.
+
+asset_hashes = {}  # filename -> (mtime, content hash)
+
+def asset_fingerprint(filename):
+    """Short content hash of a static file"""
+    path = os.path.join(app.static_folder, filename)
+    mtime = os.path.getmtime(path)
+    cached = asset_hashes.get(filename)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    with open(path, 'rb') as f:
+        digest = hashlib.sha256(f.read()).hexdigest()[:12]
+    asset_hashes[filename] = (mtime, digest)
+    return digest
+
+@app.template_global()
+def asset_url(filename):
+    """url_for('static') with a content hash, so the URL changes whenever the file does"""
+    try:
+        return url_for('static', filename=filename, v=asset_fingerprint(filename))
+    except OSError:
+        return url_for('static', filename=filename)
+
+def precompressed_asset(path, encoding):
+    """Path of the .br/.gz copy of a static file, written if missing or stale (None if it can't be)"""
+    variant = f"{path}.{'br' if encoding == 'br' else 'gz'}"
+    try:
+        if os.path.getmtime(variant) >= os.path.getmtime(path):
+            return variant
+    except OSError:
+        pass
+    with open(path, 'rb') as f:
+        data = f.read()
+    if encoding == 'br':
+        write_cache_file(variant, brotli.compress(data, quality=11))
+    else:
+        write_cache_file(variant, gzip.compress(data, compresslevel=9))
+    return variant if os.path.isfile(variant) else None
+
+def serve_static(filename):
+    """Static files with far-future caching for fingerprinted URLs and precompressed bodies"""
+    path = safe_join(app.static_folder, filename)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+    if filename.endswith(('.br', '.gz')) and os.path.isfile(path[:-3]):
+        abort(404)  # a precompressed copy written by precompressed_asset
+    
+    mimetype, file_encoding = mimetypes.guess_type(filename)
+    if file_encoding:
+        # A compressed file in its own right, sent as-is without Content-Encoding
+        mimetype = 'application/gzip' if file_encoding == 'gzip' else 'application/octet-stream'
+    mimetype = mimetype or 'application/octet-stream'
+    encoding = None
+    if mimetype in PRECOMPRESSED_MIMETYPES and os.path.getsize(path) >= COMPRESS_MIN_BYTES:
+        encoding = negotiate_encoding(request.accept_encodings)
+    served_path = precompressed_asset(path, encoding) if encoding else None
+    
+    response = send_file(os.path.abspath(served_path or path), mimetype=mimetype, conditional=True)
+    if served_path:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    
+    version = request.args.get('v')
+    if version and version == asset_fingerprint(filename):
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = STATIC_MAX_AGE
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+    return response
+
+app.view_functions['static'] = serve_static
+
+# Authentication decorator
+def login_required(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if 'user_id' not in session:
+            return jsonify({'error': 'Authentication required', 'login_required': True}), 401
+        return f(*args, **kwargs)
+    return decorated_function
+
+def is_admin():
+    """Check if the logged in user is listed in ADMIN_EMAILS"""
+    return 'user_id' in session and session.get('email') in app.config['ADMIN_EMAILS']
+
+# Admin decorator
+def admin_required(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if 'user_id' not in session:
+            return jsonify({'error': 'Authentication required', 'login_required': True}), 401
+        if not is_admin():
+            return jsonify({'error': 'Admin access required'}), 403
+        return f(*args, **kwargs)
+    return decorated_function
+
+# Diagnostics decorator (hidden unless DIAGNOSTICS_ENABLED, admins only)
+def diagnostics_endpoint(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if not app.config['DIAGNOSTICS_ENABLED']:
+            return jsonify({'error': 'Not found'}), 404
+        return admin_required(f)(*args, **kwargs)
+    return decorated_function
+
+def diagnostics_page():
+    """limit/offset query parameters, capped at DIAGNOSTICS_MAX_ROWS"""
+    limit = min(max(request.args.get('limit', 10, type=int), 0), DIAGNOSTICS_MAX_ROWS)
+    offset = max(request.args.get('offset', 0, type=int), 0)
+    return limit, offset
+
+def timed_probe(timings, name, probe):
+    """Run a probe and record how long it took in milliseconds"""
+    started = time.perf_counter()
+    try:
+        return probe()
+    finally:
+        timings[name] = round((time.perf_counter() - started) * 1000, 2)
+
+def limit_query_time(cursor):
+    """Abort diagnostic SELECTs that run longer than DIAGNOSTICS_QUERY_TIMEOUT_MS"""
+    try:
+        cursor.execute('SET SESSION MAX_EXECUTION_TIME = %s', (DIAGNOSTICS_QUERY_TIMEOUT_MS,))
+    except Error:
+        pass  # Not supported by this server
+
+def estimated_row_counts(cursor, table_names):
+    """Row counts from information_schema statistics, without scanning the tables"""
+    if not table_names:
+        return {}
+    placeholders = ', '.join(['%s'] * len(table_names))
+    cursor.execute(
+        f'''SELECT TABLE_NAME, TABLE_ROWS FROM information_schema.TABLES
+           WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME IN ({placeholders})''',
+        list(table_names)
+    )
+    return {name: rows for name, rows in cursor.fetchall()}
+
+@app.route('/')
+def index():
+    """Render the main page"""
+    return render_template('index.html')
+
+@app.route('/register', methods=['POST'])
+def register():
+    """Handle user registration with enhanced validation and password hashing"""
+    try:
+        data = request.get_json()
+        username = data.get('username', '').strip()
+        email = data.get('email', '').strip()
+        password = data.get('password', '')
+        
+        # Enhanced validation
+        if not username or not email or not password:
+            return jsonify({'error': 'All fields are required'}), 400
+        
+        if len(username) < 3:
+            return jsonify({'error': 'Username must be at least 3 characters long'}), 400
+        
+        if len(password) < 6:
+            return jsonify({'error': 'Password must be at least 6 characters long'}), 400
+        
+        if len(password) > 50:
+            return jsonify({'error': 'Password must be 50 characters or less'}), 400
+        
+        if len(email) > 120:
+            return jsonify({'error': 'Email must be 120 characters or less'}), 400
+        
+        if len(username) > 80:
+            return jsonify({'error': 'Username must be 80 characters or less'}), 400
+        
+        # Connect to database
+        connection = get_db_connection()
+        if connection is None:
+            return jsonify({'error': 'Database connection failed'}), 500
+        
+        cursor = connection.cursor()
+        
+        # Check if user already exists
+        cursor.execute('SELECT id FROM users WHERE username = %s OR email = %s', (username, email))
+        existing_user = cursor.fetchone()
+        
+        if existing_user:
+            cursor.close()
+            connection.close()
+            return jsonify({'error': 'Username or email already exists'}), 400
+        
+        # Create new user with hashed password (hashed on the auth pool)
+        password_hash = run_password_hashing(generate_password_hash, password)
+        cursor.execute(
+            'INSERT INTO users (username, email, password_hash) VALUES (%s, %s, %s)',
+            (username, email, password_hash)
+        )
+        user_id = cursor.lastrowid
+        connection.commit()
+        cursor.close()
+        connection.close()
+        
+        # Log in the user
+        session['user_id'] = user_id
+        session['username'] = username
+        session['email'] = email
+        
+        return jsonify({
+            'success': True,
+            'message': 'Registration successful',
+            'user': {'id': user_id, 'username': username, 'email': email}
+        }), 201
+        
+    except AuthBusyError:
+        return auth_busy_response()
+    except Error as e:
+        return jsonify({'error': f'Database error: {str(e)}'}), 500
+    except Exception as e:
+        return jsonify({'error': f'Registration failed: {str(e)}'}), 500
+
+@app.route('/login', methods=['POST'])
+def login():
+    """Handle user login with password hash verification"""
+    try:
+        data = request.get_json()
+        email = data.get('email', '').strip()
+        password = data.get('password', '')
+        
+        if not email or not password:
+            return jsonify({'error': 'Email and password are required'}), 400
+        
+        # Throttle attempts per client and per account before doing any work
+        if not (login_rate_limiter.allow(f"ip:{request.remote_addr}")
+                and login_rate_limiter.allow(f"email:{email.lower()}")):
+            return jsonify({'error': 'Too many login attempts. Please try again later.'}), 429
+        
+        # Connect to database
+        connection = get_db_connection()
+        if connection is None:
+            return jsonify({'error': 'Database connection failed'}), 500
+        
+        cursor = connection.cursor()
+        
+        # Check user credentials (legacy 'user' accounts are moved over by migrate_user_table)
+        cursor.execute(
+            'SELECT id, username, email, password_hash FROM users WHERE email = %s',
+            (email,)
+        )
+        user = cursor.fetchone()
+        
+        cursor.close()
+        connection.close()
+        
+        if user and run_password_hashing(check_password_hash, user[3], password):
+            # Login successful
+            session['user_id'] = user[0]
+            session['username'] = user[1]
+            session['email'] = user[2]
+            
+            return jsonify({
+                'success': True,
+                'message': 'Login successful',
+                'user': {'id': user[0], 'username': user[1], 'email': user[2]}
+            }), 200
+        else:
             return jsonify({'error': 'Invalid email or password'}), 401
             
+    except AuthBusyError:
+        return auth_busy_response()
     except Error as e:
         return jsonify({'error': f'Database error: {str(e)}'}), 500
     except Exception as e:
@@ -523,23 +2006,18 @@ def upload_file():
         # Check if file is allowed
         if not allowed_file(file.filename):
             return jsonify({'error': 'Only PDF files are allowed'}), 400
+        if not has_pdf_header(file):
+            return jsonify({'error': 'The file is not a valid PDF'}), 400
         
         if file:
-            # Create uploads folder if it doesn't exist
-            create_upload_folder()
-            
-            # Generate unique filename to avoid conflicts
-            file_id = str(uuid.uuid4())
-            original_filename = secure_filename(file.filename)
-            stored_filename = f"{file_id}_{original_filename}"
-            
-            # Save file
-            filepath = os.path.join(app.config['UPLOAD_FOLDER'], stored_filename)
-            file.save(filepath)
-            
-            # Get file size
-            file_size = os.path.getsize(filepath)
-            file_size_mb = f"{round(file_size / (1024*1024), 2)} MB"
+            # Save under a unique filename to avoid conflicts
+            saved = save_uploaded_pdf(file)
+            file_id = saved['file_id']
+            original_filename = saved['original_filename']
+            stored_filename = saved['stored_filename']
+            filepath = saved['filepath']
+            file_size = saved['file_size']
+            file_size_mb = saved['file_size_mb']
             
             # Connect to database
             connection = get_db_connection()
@@ -548,48 +2026,30 @@ def upload_file():
             
             cursor = connection.cursor()
             
-            # Ensure files table exists before inserting
-            cursor.execute("SHOW TABLES LIKE 'files'")
-            files_table_exists = cursor.fetchone() is not None
-            
-            if not files_table_exists:
-                print("🔧 Files table missing, creating it...")
-                ensure_table_exists('files')
-            
             # Save to enhanced files table
             try:
                 cursor.execute(
                     '''INSERT INTO files (user_id, file_id, original_filename, stored_filename, 
-                       file_size, file_size_display, last_read) VALUES (%s, %s, %s, %s, %s, %s, %s)''',
+                       file_size, file_size_display, last_read, status) VALUES (%s, %s, %s, %s, %s, %s, %s, %s)''',
                     (session['user_id'], file_id, original_filename, stored_filename, 
-                     file_size, file_size_mb, datetime.now().date())
+                     file_size, file_size_mb, datetime.now().date(), 'pending')
                 )
                 print("✅ File saved to files table")
-            except Error as e:
-                print(f"⚠️  Warning: Could not save to files table: {e}")
-            
-            # Ensure book table exists before inserting
-            cursor.execute("SHOW TABLES LIKE 'book'")
-            book_table_exists = cursor.fetchone() is not None
-            
-            if not book_table_exists:
-                print("🔧 Book table missing, creating it...")
-                ensure_table_exists('book')
-            
-            # Also save to book table for backward compatibility
-            try:
-                cursor.execute(
-                    'INSERT INTO book (username, book_title, size, last_read) VALUES (%s, %s, %s, %s)',
-                    (session.get('email', session['username']), original_filename, file_size_mb, datetime.now().date())
-                )
-                print("✅ File saved to book table")
-            except Error as e:
-                print(f"⚠️  Warning: Could not save to book table: {e}")
+            except Error:
+                # The files table is the only record now, don't keep an orphaned upload
+                cursor.close()
+                connection.close()
+                remove_blobs_later([stored_filename])
+                raise
             
             connection.commit()
             cursor.close()
             connection.close()
             
+            # Validation (then the optional linearization pass) in the background
+            optimizing = app.config['OPTIMIZE_PDF_ON_UPLOAD']
+            schedule_pdf_validation(file_id, stored_filename)
+            
             return jsonify({
                 'success': True,
                 'message': 'File uploaded successfully',
@@ -598,7 +2058,9 @@ def upload_file():
                 'filename': stored_filename,
                 'file_size': file_size,
                 'file_size_mb': file_size_mb,
-                'filepath': filepath
+                'filepath': filepath,
+                'optimizing': optimizing,
+                'status': 'pending'
             }), 200
             
     except Error as e:
@@ -615,73 +2077,30 @@ def list_files():
             return jsonify({'error': 'Database connection failed'}), 500
         
         cursor = connection.cursor()
-        file_list = []
         
-        # Check if files table exists
-        cursor.execute("SHOW TABLES LIKE 'files'")
-        files_table_exists = cursor.fetchone() is not None
+        cursor.execute(
+            '''SELECT file_id, original_filename, stored_filename, file_size, 
+               file_size_display, upload_date, last_read, status 
+               FROM files WHERE user_id = %s ORDER BY upload_date DESC''',
+            (session['user_id'],)
+        )
         
-        if files_table_exists:
-            # Try to get files from enhanced files table first
-            try:
-                cursor.execute(
-                    '''SELECT file_id, original_filename, stored_filename, file_size, 
-                       file_size_display, upload_date, last_read 
-                       FROM files WHERE user_id = %s ORDER BY upload_date DESC''',
-                    (session['user_id'],)
-                )
-                files = cursor.fetchall()
-                
-                print(f"Found {len(files)} files for user {session['user_id']}")  # Debug
-                
-                if files:
-                    # Files from enhanced table
-                    for file in files:
-                        file_data = {
-                            'file_id': file[0],
-                            'filename': file[1],  # This should match JavaScript expectation
-                            'stored_filename': file[2],
-                            'size': file[3],
-                            'size_display': file[4],
-                            'size_mb': round(file[3] / (1024*1024), 2) if file[3] else 0,
-                            'upload_date': file[5].strftime('%Y-%m-%d') if file[5] else None,
-                            'last_read': file[6].strftime('%Y-%m-%d') if file[6] else None
-                        }
-                        file_list.append(file_data)
-                        print(f"Added file: {file_data['filename']}")  # Debug
-                        
-            except Error as e:
-                print(f"Warning: Could not read from files table: {e}")
-        
-        # If no files found in files table or table doesn't exist, check book table
-        if not file_list:
-            print("No files in files table, checking book table...")
-            # Check book table
-            cursor.execute("SHOW TABLES LIKE 'book'")
-            book_table_exists = cursor.fetchone() is not None
-            if book_table_exists:
-                cursor.execute(
-                    'SELECT book_title, size, last_read, created_at FROM book WHERE username = %s ORDER BY last_read DESC',
-                    (session.get('email', session['username']),)
-                )
-                books = cursor.fetchall()
-                for book in books:
-                    file_data = {
-                        'file_id': book,                # book_title
-                        'filename': book,               # book_title
-                        'stored_filename': book,        # Just for frontend expectations; not the actual file path
-                        'size': None,                      # Could use book[1] if stored as bytes
-                        'size_display': book[1],           # string like "2.35 MB"
-                        'upload_date': str(book) if book else None,   # created_at
-                        'last_read': str(book[2]) if book[2] else None      # last_read
-                    }
-                    file_list.append(file_data)
-
+        file_list = [{
+            'file_id': file_id,
+            'filename': original_filename,  # This should match JavaScript expectation
+            'stored_filename': stored_filename,
+            'size': file_size,
+            'size_display': file_size_display,
+            'size_mb': round(file_size / (1024*1024), 2) if file_size else 0,
+            'upload_date': upload_date.strftime('%Y-%m-%d') if upload_date else None,
+            'last_read': last_read.strftime('%Y-%m-%d') if last_read else None,
+            'status': status
+        } for file_id, original_filename, stored_filename, file_size, file_size_display, upload_date, last_read,
+            status in cursor.fetchall()]
         
         cursor.close()
         connection.close()
         
-        print(f"Returning {len(file_list)} files")  # Debug
         return jsonify({'files': file_list})
         
     except Error as e:
@@ -691,222 +2110,346 @@ def list_files():
         print(f"General error in list_files: {e}")  # Debug
         return jsonify({'error': f'Failed to list files: {str(e)}'}), 500
 @app.route('/debug-user-files')
+@diagnostics_endpoint
+def debug_user_files():
+    """Debug endpoint to check the current user's files and session data"""
+    try:
+        limit, offset = diagnostics_page()
+        timings = {}
+        connection = timed_probe(timings, 'connect', get_db_connection)
+        if connection is None:
+            return jsonify({'error': 'Database connection failed'}), 500
+        
+        cursor = connection.cursor()
+        limit_query_time(cursor)
+        debug_info = {
+            'session_data': {
+                'user_id': session.get('user_id'),
+                'username': session.get('username'),
+                'email': session.get('email')
+            },
+            'tables': {},
+            'limit': limit,
+            'offset': offset,
+            'timing_ms': timings
+        }
+        
+        try:
+            def user_files():
+                cursor.execute(
+                    '''SELECT file_id, original_filename, user_id FROM files WHERE user_id = %s
+                       ORDER BY id LIMIT %s OFFSET %s''',
+                    (session['user_id'], limit, offset)
+                )
+                return cursor.fetchall()
+            
+            files = timed_probe(timings, 'files_data', user_files)
+            debug_info['tables']['files_data'] = [
+                {'file_id': f[0], 'filename': f[1], 'user_id': f[2]} for f in files
+            ]
+            
+            # Total from table statistics instead of a COUNT(*) scan
+            counts = timed_probe(timings, 'table_stats', lambda: estimated_row_counts(cursor, ['files']))
+            debug_info['tables']['total_files_in_db'] = counts.get('files')
+            debug_info['tables']['count_source'] = 'table_statistics'
+        except Error as e:
+            debug_info['tables']['files_error'] = str(e)
+        
+        cursor.close()
+        connection.close()
+        
+        return jsonify(debug_info)
+        
+    except Exception as e:
+        return jsonify({'error': f'Debug failed: {str(e)}'}), 500
+
+@app.route('/delete-file/<file_identifier>', methods=['DELETE'])
+@login_required
+def delete_file(file_identifier):
+    """Delete a file by its file_id"""
+    try:
+        connection = get_db_connection()
+        if connection is None:
+            return jsonify({'error': 'Database connection failed'}), 500
+        
+        cursor = connection.cursor()
+        
+        cursor.execute(
+            'SELECT stored_filename, source_filename FROM files WHERE file_id = %s AND user_id = %s',
+            (file_identifier, session['user_id'])
+        )
+        file_info = cursor.fetchone()
+        
+        if not file_info:
+            cursor.close()
+            connection.close()
+            return jsonify({'error': 'File not found or access denied'}), 404
+        
+        cursor.execute(
+            'DELETE FROM files WHERE file_id = %s AND user_id = %s',
+            (file_identifier, session['user_id'])
+        )
+        cursor.execute(
+            'DELETE FROM reading_progress WHERE file_id = %s AND user_id = %s',
+            (file_identifier, session['user_id'])
+        )
+        cursor.execute(
+            'DELETE FROM annotations WHERE file_id = %s AND user_id = %s',
+            (file_identifier, session['user_id'])
+        )
+        
+        connection.commit()
+        cursor.close()
+        connection.close()
+        
+        close_reader_session(session['user_id'], file_identifier)
+        
+        # Delete physical files (optimized uploads also keep their original) and thumbnails
+        remove_blobs_later(file_info)
+        remove_files_later(thumbnail_paths(file_identifier) + [page_cache_dir(file_identifier)])
+        
+        return jsonify({'success': True, 'message': 'File deleted successfully'}), 200
+        
+    except Error as e:
+        return jsonify({'error': f'Database error: {str(e)}'}), 500
+    except Exception as e:
+        return jsonify({'error': f'Failed to delete file: {str(e)}'}), 500
+
+def parse_file_ids():
+    """Read a JSON {'file_ids': [...]} body, returns (file_ids, error_response)"""
+    data = request.get_json(silent=True) or {}
+    file_ids = data.get('file_ids')
+    if not isinstance(file_ids, list) or not file_ids or not all(isinstance(f, str) for f in file_ids):
+        return None, (jsonify({'error': 'file_ids must be a non-empty list'}), 400)
+    if len(file_ids) > BULK_MAX_FILES:
+        return None, (jsonify({'error': f'At most {BULK_MAX_FILES} files per request'}), 400)
+    return list(dict.fromkeys(file_ids)), None
+
+@app.route('/upload-multiple', methods=['POST'])
+@login_required
+def upload_files():
+    """Upload several PDFs in one request, recorded in a single transaction"""
+    try:
+        files = request.files.getlist('files')
+        if not files:
+            return jsonify({'error': 'No files part in the request'}), 400
+        if len(files) > BULK_MAX_FILES:
+            return jsonify({'error': f'At most {BULK_MAX_FILES} files per request'}), 400
+        
+        rejected = [file.filename for file in files
+                    if file.filename == '' or not allowed_file(file.filename) or not has_pdf_header(file)]
+        if rejected:
+            return jsonify({'error': 'Only valid PDF files are allowed', 'rejected': rejected}), 400
+        
+        connection = get_db_connection()
+        if connection is None:
+            return jsonify({'error': 'Database connection failed'}), 500
+        
+        saved_files = []
+        try:
+            connection.start_transaction()
+            for file in files:
+                saved_files.append(save_uploaded_pdf(file))
+            
+            cursor = connection.cursor()
+            today = datetime.now().date()
+            cursor.executemany(
+                '''INSERT INTO files (user_id, file_id, original_filename, stored_filename, 
+                   file_size, file_size_display, last_read, status) VALUES (%s, %s, %s, %s, %s, %s, %s, %s)''',
+                [(session['user_id'], f['file_id'], f['original_filename'], f['stored_filename'],
+                  f['file_size'], f['file_size_mb'], today, 'pending') for f in saved_files]
+            )
+            connection.commit()
+            cursor.close()
+        except Exception:
+            connection.rollback()
+            remove_blobs_later(f['stored_filename'] for f in saved_files)
+            raise
+        finally:
+            connection.close()
+        
+        for f in saved_files:
+            schedule_pdf_validation(f['file_id'], f['stored_filename'])
+        
+        return jsonify({
+            'success': True,
+            'message': f'{len(saved_files)} files uploaded successfully',
+            'files': [{
+                'file_id': f['file_id'],
+                'original_filename': f['original_filename'],
+                'filename': f['stored_filename'],
+                'file_size': f['file_size'],
+                'file_size_mb': f['file_size_mb'],
+                'status': 'pending'
+            } for f in saved_files]
+        }), 200
+        
+    except Error as e:
+        return jsonify({'error': f'Database error: {str(e)}'}), 500
+    except Exception as e:
+        return jsonify({'error': f'Upload failed: {str(e)}'}), 500
+
+@app.route('/delete-files', methods=['POST'])
 @login_required
-def debug_user_files():
-    """Debug endpoint to check user files and session data"""
+def delete_files():
+    """Delete several files in one transaction, physical files are removed afterwards"""
     try:
+        file_ids, error_response = parse_file_ids()
+        if error_response:
+            return error_response
+        
         connection = get_db_connection()
         if connection is None:
             return jsonify({'error': 'Database connection failed'}), 500
         
-        cursor = connection.cursor()
-        debug_info = {
-            'session_data': {
-                'user_id': session.get('user_id'),
-                'username': session.get('username'),
-                'email': session.get('email')
-            },
-            'tables': {}
-        }
-        
-        # Check files table
+        placeholders = ', '.join(['%s'] * len(file_ids))
+        params = [session['user_id']] + file_ids
         try:
-            cursor.execute("SHOW TABLES LIKE 'files'")
-            files_table_exists = cursor.fetchone() is not None
-            debug_info['tables']['files_exists'] = files_table_exists
-            
-            if files_table_exists:
-                # Get all files for this user
+            connection.start_transaction()
+            cursor = connection.cursor()
+            cursor.execute(
+                f'''SELECT file_id, stored_filename, source_filename FROM files
+                   WHERE user_id = %s AND file_id IN ({placeholders}) FOR UPDATE''',
+                params
+            )
+            rows = cursor.fetchall()
+            if rows:
+                cursor.execute(f'DELETE FROM files WHERE user_id = %s AND file_id IN ({placeholders})', params)
                 cursor.execute(
-                    'SELECT file_id, original_filename, user_id FROM files WHERE user_id = %s',
-                    (session['user_id'],)
+                    f'DELETE FROM reading_progress WHERE user_id = %s AND file_id IN ({placeholders})', params
                 )
-                files = cursor.fetchall()
-                debug_info['tables']['files_data'] = [
-                    {'file_id': f[0], 'filename': f[1], 'user_id': f[2]} for f in files
-                ]
-                
-                # Get total files count
-                cursor.execute('SELECT COUNT(*) FROM files')
-                total_files = cursor.fetchone()[0]
-                debug_info['tables']['total_files_in_db'] = total_files
-                
-        except Error as e:
-            debug_info['tables']['files_error'] = str(e)
-        
-        # Check book table
-        try:
-            cursor.execute("SHOW TABLES LIKE 'book'")
-            book_table_exists = cursor.fetchone() is not None
-            debug_info['tables']['book_exists'] = book_table_exists
-            
-            if book_table_exists:
-                # Get all books for this user
                 cursor.execute(
-                    'SELECT book_title, username FROM book WHERE username = %s',
-                    (session.get('email', session['username']),)
+                    f'DELETE FROM annotations WHERE user_id = %s AND file_id IN ({placeholders})', params
                 )
-                books = cursor.fetchall()
-                debug_info['tables']['book_data'] = [
-                    {'title': b[0], 'username': b[1]} for b in books
-                ]
-                
-                # Get total books count
-                cursor.execute('SELECT COUNT(*) FROM book')
-                total_books = cursor.fetchone()[0]
-                debug_info['tables']['total_books_in_db'] = total_books
-                
-        except Error as e:
-            debug_info['tables']['book_error'] = str(e)
+            connection.commit()
+            cursor.close()
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            connection.close()
         
-        cursor.close()
-        connection.close()
+        for row in rows:
+            close_reader_session(session['user_id'], row[0])
+        remove_blobs_later(name for row in rows for name in row[1:])
+        remove_files_later(path for row in rows for path in thumbnail_paths(row[0]) + [page_cache_dir(row[0])])
         
-        return jsonify(debug_info)
+        deleted = [row[0] for row in rows]
+        return jsonify({
+            'success': True,
+            'message': f'{len(deleted)} files deleted successfully',
+            'deleted': deleted,
+            'not_found': [file_id for file_id in file_ids if file_id not in deleted]
+        }), 200
         
+    except Error as e:
+        return jsonify({'error': f'Database error: {str(e)}'}), 500
     except Exception as e:
-        return jsonify({'error': f'Debug failed: {str(e)}'}), 500
+        return jsonify({'error': f'Failed to delete files: {str(e)}'}), 500
 
-@app.route('/delete-file/<file_identifier>', methods=['DELETE'])
+@app.route('/select-files', methods=['POST'])
 @login_required
-def delete_file(file_identifier):
-    """Delete a file - supports both file_id and book_title for backward compatibility"""
+def select_files():
+    """Select several files from the library at once (marks them read)"""
     try:
+        file_ids, error_response = parse_file_ids()
+        if error_response:
+            return error_response
+        
         connection = get_db_connection()
         if connection is None:
             return jsonify({'error': 'Database connection failed'}), 500
         
         cursor = connection.cursor()
-        deleted = False
-        physical_file_path = None
-        
-        # Check if files table exists
-        cursor.execute("SHOW TABLES LIKE 'files'")
-        files_table_exists = cursor.fetchone() is not None
-        
-        if files_table_exists:
-            # Try to delete from files table first (by file_id)
-            try:
-                cursor.execute(
-                    'SELECT stored_filename FROM files WHERE file_id = %s AND user_id = %s',
-                    (file_identifier, session['user_id'])
-                )
-                file_info = cursor.fetchone()
-                
-                if file_info:
-                    # Delete from files table
-                    cursor.execute(
-                        'DELETE FROM files WHERE file_id = %s AND user_id = %s',
-                        (file_identifier, session['user_id'])
-                    )
-                    physical_file_path = os.path.join(app.config['UPLOAD_FOLDER'], file_info[0])
-                    deleted = True
-            except Error as e:
-                print(f"⚠️  Warning: Could not delete from files table: {e}")
-        
-        # If not deleted from files table, try book table
-        if not deleted:
-            # Check if book table exists
-            cursor.execute("SHOW TABLES LIKE 'book'")
-            book_table_exists = cursor.fetchone() is not None
-            
-            if not book_table_exists:
-                print("🔧 Book table missing, creating it...")
-                ensure_table_exists('book')
-            
-            # Fallback to book table (by book_title for backward compatibility)
-            try:
-                cursor.execute(
-                    'DELETE FROM book WHERE book_title = %s AND username = %s',
-                    (file_identifier, session.get('email', session['username']))
-                )
-                if cursor.rowcount > 0:
-                    deleted = True
-            except Error as e:
-                print(f"⚠️  Warning: Could not delete from book table: {e}")
-        
-        if not deleted:
-            cursor.close()
-            connection.close()
-            return jsonify({'error': 'File not found or access denied'}), 404
-        
-        connection.commit()
+        placeholders = ', '.join(['%s'] * len(file_ids))
+        cursor.execute(
+            f'''SELECT file_id, original_filename FROM files
+               WHERE user_id = %s AND file_id IN ({placeholders})''',
+            [session['user_id']] + file_ids
+        )
+        rows = cursor.fetchall()
         cursor.close()
         connection.close()
         
-        # Delete physical file if path is available
-        if physical_file_path and os.path.exists(physical_file_path):
-            try:
-                os.remove(physical_file_path)
-                print(f"✅ Physical file deleted: {physical_file_path}")
-            except Exception as e:
-                print(f"⚠️  Warning: Could not delete physical file: {e}")
+        for row in rows:
+            reading_progress.mark_read(row[0])
         
-        return jsonify({'success': True, 'message': 'File deleted successfully'}), 200
+        found = {row[0]: row[1] for row in rows}
+        return jsonify({
+            'success': True,
+            'files': [{'file_id': file_id, 'filename': found[file_id], 'redirect_url': f'/book/{file_id}'}
+                      for file_id in file_ids if file_id in found],
+            'not_found': [file_id for file_id in file_ids if file_id not in found]
+        })
         
-    except Error as e:
-        return jsonify({'error': f'Database error: {str(e)}'}), 500
     except Exception as e:
-        return jsonify({'error': f'Failed to delete file: {str(e)}'}), 500
+        return jsonify({'error': f'Failed to select files: {str(e)}'}), 500
+
+# Sample query and row formatter per table shown by /test-db
+DIAGNOSTIC_SAMPLES = {
+    'users': (
+        'SELECT id, username, email, created_at FROM users ORDER BY id LIMIT %s OFFSET %s',
+        lambda user: {'id': user[0], 'username': user[1], 'email': user[2], 'created_at': str(user[3])}
+    ),
+    'user': (
+        'SELECT username FROM user ORDER BY username LIMIT %s OFFSET %s',
+        lambda user: {'username': user[0]}
+    ),
+    'files': (
+        '''SELECT user_id, file_id, original_filename, file_size_display, upload_date
+           FROM files ORDER BY id LIMIT %s OFFSET %s''',
+        lambda f: {'user_id': f[0], 'file_id': f[1], 'filename': f[2], 'size': f[3], 'upload_date': str(f[4])}
+    ),
+    'book': (
+        'SELECT username, book_title, size, last_read FROM book ORDER BY id LIMIT %s OFFSET %s',
+        lambda b: {'username': b[0], 'title': b[1], 'size': b[2], 'last_read': str(b[3])}
+    )
+}
 
 @app.route('/test-db')
+@diagnostics_endpoint
 def test_database():
-    """Enhanced test endpoint to check database connection and show all tables (for web requests)"""
+    """Check the database connection and show row estimates and paginated samples per table"""
     try:
-        connection = get_db_connection()
+        limit, offset = diagnostics_page()
+        tables = request.args.get('table', type=str)
+        table_names = [t for t in tables.split(',') if t in DIAGNOSTIC_SAMPLES] if tables else list(DIAGNOSTIC_SAMPLES)
+        
+        timings = {}
+        connection = timed_probe(timings, 'connect', get_db_connection)
         if connection is None:
             return jsonify({'error': 'Database connection failed'}), 500
         
         cursor = connection.cursor()
+        limit_query_time(cursor)
         result = {
             'success': True,
             'message': 'Database connected successfully',
-            'tables': {}
+            'limit': limit,
+            'offset': offset,
+            'tables': {},
+            'timing_ms': timings
         }
         
-        # Check users table
-        try:
-            cursor.execute("SELECT id, username, email, created_at FROM users")
-            users = cursor.fetchall()
-            result['tables']['users'] = {
-                'count': len(users),
-                'records': [{'id': user[0], 'username': user[1], 'email': user[2], 'created_at': str(user[3])} for user in users]
-            }
-        except Error:
-            result['tables']['users'] = {'count': 0, 'records': [], 'error': 'Table not found or inaccessible'}
-        
-        # Check old user table
-        try:
-            cursor.execute("SELECT username FROM user")
-            old_users = cursor.fetchall()
-            result['tables']['user'] = {
-                'count': len(old_users),
-                'records': [{'username': user[0]} for user in old_users]
-            }
-        except Error:
-            result['tables']['user'] = {'count': 0, 'records': [], 'error': 'Table not found'}
-        
-        # Check files table
-        try:
-            cursor.execute("SELECT user_id, file_id, original_filename, file_size_display, upload_date FROM files")
-            files = cursor.fetchall()
-            result['tables']['files'] = {
-                'count': len(files),
-                'records': [{'user_id': f[0], 'file_id': f[1], 'filename': f[2], 'size': f[3], 'upload_date': str(f[4])} for f in files]
-            }
-        except Error:
-            result['tables']['files'] = {'count': 0, 'records': [], 'error': 'Table not found'}
+        # Row counts come from table statistics (estimates for InnoDB, none for views)
+        counts = timed_probe(timings, 'table_stats', lambda: estimated_row_counts(cursor, table_names))
         
-        # Check book table
-        try:
-            cursor.execute("SELECT username, book_title, size, last_read FROM book")
-            books = cursor.fetchall()
-            result['tables']['book'] = {
-                'count': len(books),
-                'records': [{'username': b[0], 'title': b[1], 'size': b[2], 'last_read': str(b[3])} for b in books]
-            }
-        except Error:
-            result['tables']['book'] = {'count': 0, 'records': [], 'error': 'Table not found'}
+        for table_name in table_names:
+            query, format_row = DIAGNOSTIC_SAMPLES[table_name]
+            
+            def sample():
+                cursor.execute(query, (limit, offset))
+                return cursor.fetchall()
+            
+            try:
+                rows = timed_probe(timings, table_name, sample)
+                result['tables'][table_name] = {
+                    'count': counts.get(table_name),
+                    'count_source': 'table_statistics',
+                    'records': [format_row(row) for row in rows]
+                }
+            except Error:
+                result['tables'][table_name] = {'count': 0, 'records': [], 'error': 'Table not found or inaccessible'}
         
         cursor.close()
         connection.close()
@@ -965,11 +2508,10 @@ def view_book(file_id):
 
 @app.route('/api/book/<file_id>/pages')
 @login_required
+@rate_limited('pages')
 def get_book_pages(file_id):
     """Get total pages count for a PDF"""
     try:
-          # You'll need: pip install PyMuPDF
-        
         connection = get_db_connection()
         if connection is None:
             return jsonify({'error': 'Database connection failed'}), 500
@@ -978,26 +2520,28 @@ def get_book_pages(file_id):
         
         # Get stored filename
         cursor.execute(
-            '''SELECT stored_filename FROM files 
+            '''SELECT stored_filename, status FROM files 
                WHERE file_id = %s AND user_id = %s''',
             (file_id, session['user_id'])
         )
         file_info = cursor.fetchone()
+        cursor.close()
+        connection.close()
         
         if not file_info:
             return jsonify({'error': 'File not found'}), 404
-        
-        cursor.close()
-        connection.close()
+        if file_info[1] in UNREADABLE_STATUSES:
+            quarantined_files.add(file_id)
+            return quarantined_response(file_info[1])
         
         # Open PDF and get page count
-        pdf_path = os.path.join(app.config['UPLOAD_FOLDER'], file_info[0])
-        if not os.path.exists(pdf_path):
+        pdf_path = blob_storage.local_path(file_info[0])
+        if not os.path.isfile(pdf_path):
             return jsonify({'error': 'PDF file not found on disk'}), 404
         
-        pdf_doc = fitz.open(pdf_path)
-        total_pages = pdf_doc.page_count
-        pdf_doc.close()
+        total_pages = read_cached_page_count(file_id)
+        if total_pages is None:
+            total_pages, _ = run_render_job('info', file_id, pdf_path)
         
         return jsonify({
             'success': True,
@@ -1005,71 +2549,778 @@ def get_book_pages(file_id):
             'file_id': file_id
         })
         
+    except RenderFailedError as e:
+        return jsonify({'error': f'Failed to read PDF: {str(e)}'}), 422
     except Exception as e:
         return jsonify({'error': f'Failed to get page count: {str(e)}'}), 500
 
-@app.route('/api/book/<file_id>/page/<int:page_num>')
+@app.route('/api/book/<file_id>/page/<int:page_num>')
+@login_required
+@rate_limited('page')
+def get_book_page(file_id, page_num):
+    """Get a specific page as base64 image"""
+    try:
+        import base64
+        
+        connection = get_db_connection()
+        if connection is None:
+            return jsonify({'error': 'Database connection failed'}), 500
+        
+        cursor = connection.cursor()
+        
+        # Get stored filename
+        cursor.execute(
+            '''SELECT stored_filename, status FROM files 
+               WHERE file_id = %s AND user_id = %s''',
+            (file_id, session['user_id'])
+        )
+        file_info = cursor.fetchone()
+        cursor.close()
+        connection.close()
+        
+        if not file_info:
+            return jsonify({'error': 'File not found'}), 404
+        if file_info[1] in UNREADABLE_STATUSES:
+            quarantined_files.add(file_id)
+            return quarantined_response(file_info[1])
+        
+        # Open PDF and get page
+        pdf_path = blob_storage.local_path(file_info[0])
+        if not os.path.isfile(pdf_path):
+            return jsonify({'error': 'PDF file not found on disk'}), 404
+        
+        # Admins can ask for a cProfile dump of this single render (?profile=1),
+        # rendered in the sandbox like any other page
+        profile_path = None
+        if request.args.get('profile') == '1' and app.config['RENDER_PROFILING_ENABLED'] and is_admin():
+            os.makedirs(app.config['PROFILE_FOLDER'], exist_ok=True)
+            profile_path = os.path.join(
+                app.config['PROFILE_FOLDER'], f"{file_id}_page{page_num}_{int(time.time())}.prof"
+            )
+        
+        user_render_slots.acquire(session['user_id'])
+        try:
+            if profile_path:
+                img_data, total_pages, profile_record = run_render_job(
+                    'profile', file_id, pdf_path, page_num, RENDER_ZOOM, file_id, profile_path
+                )
+            else:
+                img_data, total_pages = render_cached_page(pdf_path, page_num, file_id)
+        finally:
+            user_render_slots.release(session['user_id'])
+        
+        # Validate page number
+        if img_data is None:
+            return jsonify({'error': 'Invalid page number'}), 400
+        
+        # Convert to base64
+        img_base64 = base64.b64encode(img_data).decode()
+        
+        result = {
+            'success': True,
+            'page_num': page_num,
+            'image': f"data:image/png;base64,{img_base64}",
+            'total_pages': total_pages
+        }
+        if profile_path:
+            result['profile'] = os.path.basename(profile_path)
+            result['profile_stats'] = profile_record
+        
+        return jsonify(result)
+        
+    except RenderFailedError as e:
+        return jsonify({'error': f'Failed to render page: {str(e)}'}), 422
+    except RenderBusyError as e:
+        response = jsonify({'error': str(e)})
+        response.headers['Retry-After'] = '2'
+        return response, 503
+    except Exception as e:
+        return jsonify({'error': f'Failed to get page: {str(e)}'}), 500
+
+@app.route('/api/book/<file_id>/raw')
+@login_required
+def get_book_raw(file_id):
+    """Serve the original PDF with Range, ETag and conditional GET support (for pdf.js)"""
+    try:
+        connection = get_db_connection()
+        if connection is None:
+            return jsonify({'error': 'Database connection failed'}), 500
+        
+        cursor = connection.cursor()
+        
+        cursor.execute(
+            '''SELECT original_filename, stored_filename, status FROM files 
+               WHERE file_id = %s AND user_id = %s''',
+            (file_id, session['user_id'])
+        )
+        file_info = cursor.fetchone()
+        
+        cursor.close()
+        connection.close()
+        
+        if not file_info:
+            return jsonify({'error': 'File not found'}), 404
+        # pdf.js renders in the browser, so only validated files are handed out
+        if file_info[2] in UNREADABLE_STATUSES:
+            return quarantined_response(file_info[2])
+        if file_info[2] == 'pending':
+            response = jsonify({'error': 'This file is still being checked', 'status': 'pending'})
+            response.headers['Retry-After'] = '2'
+            return response, 409
+        
+        pdf_path = blob_storage.local_path(file_info[1])
+        if not os.path.isfile(pdf_path):
+            return jsonify({'error': 'PDF file not found on disk'}), 404
+        
+        # Let nginx serve the bytes (sendfile, ranges, ETag) when configured
+        accel_prefix = app.config['RAW_ACCEL_REDIRECT_PREFIX']
+        if accel_prefix and blob_storage.is_local:
+            response = Response(mimetype='application/pdf')
+            response.headers['X-Accel-Redirect'] = accel_prefix + quote(file_info[1])
+            response.headers['Content-Disposition'] = f"inline; filename*=UTF-8''{quote(file_info[0])}"
+            return response
+        
+        # send_file handles Range/If-Range/If-None-Match and uses the server's
+        # wsgi.file_wrapper (sendfile under gunicorn) for the body
+        response = send_file(
+            os.path.abspath(pdf_path),
+            mimetype='application/pdf',
+            download_name=file_info[0],
+            conditional=True,
+            etag=True
+        )
+        response.cache_control.private = True
+        # pdf.js only switches to range loading when the first response advertises it
+        response.headers['Accept-Ranges'] = 'bytes'
+        return response
+        
+    except Exception as e:
+        return jsonify({'error': f'Failed to stream PDF: {str(e)}'}), 500
+
+# Reading progress (write-behind)
+#
+# Page positions and last_read dates are kept in memory, coalesced per
+# (user, file), and written in batched multi-row statements by a background
+# thread, so flipping pages never waits on MySQL.
+PROGRESS_FLUSH_INTERVAL = 5  # seconds
+PROGRESS_FLUSH_BATCH_SIZE = 500  # rows per INSERT statement
+
+class ReadingProgressBuffer:
+    """Buffers reading positions and flushes them to the database in batches"""
+    def __init__(self, flush_interval=PROGRESS_FLUSH_INTERVAL):
+        self.flush_interval = flush_interval
+        self._pages = {}  # (user_id, file_id) -> (page_number, updated_at)
+        self._last_read = {}  # file_id -> date
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+    
+    def start(self):
+        """Start the flush thread (once) and flush again at shutdown"""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='progress-flush', daemon=True)
+            self._thread.start()
+        atexit.register(self.stop)
+    
+    def stop(self):
+        self._stop.set()
+        self.flush()
+    
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+    
+    def record_page(self, user_id, file_id, page_number):
+        """Remember the current page of a reader (the newest position wins)"""
+        self.start()
+        with self._lock:
+            self._pages[(user_id, file_id)] = (page_number, datetime.now())
+    
+    def mark_read(self, file_id):
+        """Set files.last_read to today in the next flush"""
+        self.start()
+        with self._lock:
+            self._last_read[file_id] = datetime.now().date()
+    
+    def get_page(self, user_id, file_id):
+        """Unflushed page for a reader, if any"""
+        with self._lock:
+            pending = self._pages.get((user_id, file_id))
+        return pending[0] if pending else None
+    
+    def flush(self):
+        """Write all buffered updates, returns the number of rows written"""
+        with self._flush_lock:
+            with self._lock:
+                pages, self._pages = self._pages, {}
+                last_read, self._last_read = self._last_read, {}
+            if not pages and not last_read:
+                return 0
+            
+            connection = get_db_connection()
+            if connection is None:
+                self._requeue(pages, last_read)
+                return 0
+            try:
+                cursor = connection.cursor()
+                rows = [(user_id, file_id, page, updated_at)
+                        for (user_id, file_id), (page, updated_at) in pages.items()]
+                for start in range(0, len(rows), PROGRESS_FLUSH_BATCH_SIZE):
+                    batch = rows[start:start + PROGRESS_FLUSH_BATCH_SIZE]
+                    placeholders = ', '.join(['(%s, %s, %s, %s)'] * len(batch))
+                    cursor.execute(
+                        f'''INSERT INTO reading_progress (user_id, file_id, page_number, updated_at)
+                           VALUES {placeholders}
+                           ON DUPLICATE KEY UPDATE page_number = VALUES(page_number),
+                           updated_at = VALUES(updated_at)''',
+                        [value for row in batch for value in row]
+                    )
+                
+                # One UPDATE per distinct date (normally just today)
+                by_date = {}
+                for file_id, read_date in last_read.items():
+                    by_date.setdefault(read_date, []).append(file_id)
+                for read_date, file_ids in by_date.items():
+                    for start in range(0, len(file_ids), PROGRESS_FLUSH_BATCH_SIZE):
+                        batch = file_ids[start:start + PROGRESS_FLUSH_BATCH_SIZE]
+                        placeholders = ', '.join(['%s'] * len(batch))
+                        cursor.execute(
+                            f'UPDATE files SET last_read = %s WHERE file_id IN ({placeholders})',
+                            [read_date] + batch
+                        )
+                
+                connection.commit()
+                cursor.close()
+                return len(rows) + len(last_read)
+            except Error as e:
+                print(f"⚠️  Warning: Could not flush reading progress: {e}")
+                connection.rollback()
+                self._requeue(pages, last_read)
+                return 0
+            finally:
+                connection.close()
+    
+    def _requeue(self, pages, last_read):
+        """Put back updates that failed to flush, unless newer ones arrived"""
+        with self._lock:
+            for key, value in pages.items():
+                self._pages.setdefault(key, value)
+            for file_id, read_date in last_read.items():
+                self._last_read.setdefault(file_id, read_date)
+
+reading_progress = ReadingProgressBuffer()
+
+# Reading analytics (append-only event log)
+#
+# Reader events (open, flip, goto, close) are buffered in memory and appended
+# as JSON lines to per-process segment files, one segment per rollup window,
+# so navigation never touches the database. A background rollup folds sealed
+# segments into the reading_stats_daily summary table, recording each segment
+# in event_log_segments in the same transaction so none is counted twice, and
+# moves them into the archive folder. Every worker process runs a rollup; a
+# file lock per segment decides which one handles it. The stats endpoints
+# only read summaries.
+EVENT_KINDS = ('open', 'flip', 'goto', 'close')
+
+class ReadingEventLog:
+    """Buffers reader events, appends them to segment files and rolls them up"""
+    def __init__(self, folder=None, flush_interval=EVENT_LOG_FLUSH_INTERVAL,
+                 rollup_interval=EVENT_ROLLUP_INTERVAL):
+        self._folder = folder  # None: app.config['EVENT_LOG_FOLDER']
+        self.flush_interval = flush_interval
+        self.rollup_interval = rollup_interval
+        self._events = []
+        self._last_event = {}  # (user_id, file_id) -> time of the reader's previous event
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._rollup_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._next_rollup = 0
+    
+    def start(self):
+        """Start the flush/rollup thread (once) and flush again at shutdown"""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='event-log', daemon=True)
+            self._thread.start()
+        atexit.register(self.stop)
+    
+    @property
+    def folder(self):
+        return self._folder or app.config['EVENT_LOG_FOLDER']
+    
+    def stop(self):
+        self._stop.set()
+        self.flush()
+    
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+                if time.time() >= self._next_rollup:
+                    self._next_rollup = time.time() + self.rollup_interval
+                    self.rollup()
+            except Exception as e:
+                print(f"⚠️  Warning: Reading event log error: {e}")
+    
+    def record(self, kind, user_id, file_id, page_number=None, pages_shown=0):
+        """Queue an event. The time since the reader's previous event (capped at
+        EVENT_DWELL_CAP, for readers who walked away) is counted as reading time."""
+        self.start()
+        now = time.time()
+        key = (user_id, file_id)
+        with self._lock:
+            previous = self._last_event.pop(key, None) if kind == 'close' else self._last_event.get(key)
+            if kind != 'close':
+                self._last_event[key] = now
+            dwell = min(now - previous, EVENT_DWELL_CAP) if previous and kind != 'open' else 0
+            self._events.append({
+                't': round(now, 3), 'kind': kind, 'user_id': user_id, 'file_id': file_id,
+                'page': page_number, 'pages': pages_shown, 'dwell': round(dwell, 1)
+            })
+            full = len(self._events) >= EVENT_LOG_BUFFER_EVENTS
+        if full:
+            self.flush()
+    
+    def _window(self, timestamp):
+        return int(timestamp // self.rollup_interval) * self.rollup_interval
+    
+    def segment_path(self, timestamp):
+        """Segment file this process appends to during the window of timestamp"""
+        stamp = datetime.fromtimestamp(self._window(timestamp)).strftime('%Y%m%d-%H%M%S')
+        return os.path.join(self.folder, f'events-{stamp}-{os.getpid()}.jsonl')
+    
+    def flush(self):
+        """Append buffered events to the current segment, returns the number written"""
+        with self._flush_lock:
+            with self._lock:
+                events, self._events = self._events, []
+                # Forget readers who left without a close event
+                idle = time.time() - EVENT_DWELL_CAP
+                self._last_event = {key: t for key, t in self._last_event.items() if t > idle}
+            if not events:
+                return 0
+            try:
+                os.makedirs(self.folder, exist_ok=True)
+                with open(self.segment_path(time.time()), 'a', encoding='utf-8') as segment:
+                    segment.write(''.join(json.dumps(event, separators=(',', ':')) + '\n' for event in events))
+                return len(events)
+            except OSError as e:
+                print(f"⚠️  Warning: Could not write reading events: {e}")
+                with self._lock:
+                    self._events[:0] = events
+                return 0
+    
+    def sealed_segments(self):
+        """Segments of finished windows (with a grace period for late flushes), oldest first"""
+        current = self._window(time.time() - 2 * self.flush_interval)
+        try:
+            names = sorted(name for name in os.listdir(self.folder)
+                           if name.startswith('events-') and name.endswith('.jsonl'))
+        except FileNotFoundError:
+            return []
+        sealed = []
+        for name in names:
+            try:
+                window = datetime.strptime('-'.join(name.split('-')[1:3]), '%Y%m%d-%H%M%S').timestamp()
+            except ValueError:
+                continue
+            if window < current:
+                sealed.append(name)
+        return sealed
+    
+    def rollup(self):
+        """Fold sealed segments into reading_stats_daily, returns the number of events rolled up"""
+        with self._rollup_lock:
+            total = 0
+            for name in self.sealed_segments():
+                rolled = self._rollup_segment(name)
+                if rolled is None:
+                    break
+                total += rolled
+            if total:
+                print(f"✅ Rolled up {total} reading events")
+            return total
+    
+    def _rollup_segment(self, name):
+        path = os.path.join(self.folder, name)
+        try:
+            segment = open(path, encoding='utf-8')
+        except FileNotFoundError:
+            return 0  # archived by another process
+        with segment:
+            # Every worker process scans the shared folder; the lock makes one of them own the segment
+            try:
+                fcntl.flock(segment, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return 0
+            if not os.path.exists(path):
+                return 0  # archived between our open() and flock()
+            
+            summary = {}  # (user_id, file_id, day) -> [opens, flips, gotos, pages_viewed, seconds_read]
+            events = 0
+            for line in segment:
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    continue  # a torn final line from a crash
+                events += 1
+                day = datetime.fromtimestamp(event['t']).date()
+                row = summary.setdefault((event['user_id'], event['file_id'], day), [0, 0, 0, 0, 0.0])
+                if event['kind'] in ('open', 'flip', 'goto'):
+                    row[EVENT_KINDS.index(event['kind'])] += 1
+                row[3] += event.get('pages') or 0
+                row[4] += event.get('dwell') or 0
+            
+            # Sorted, so concurrent rollups lock summary rows in the same order
+            rows = sorted((user_id, file_id, day, *counts) for (user_id, file_id, day), counts in summary.items())
+            for attempt in range(EVENT_ROLLUP_RETRIES):
+                recorded = self._record_rollup(name, rows, events)
+                if recorded != 'retry':
+                    break
+            if recorded in (None, 'retry'):
+                return None
+            
+            archive = os.path.join(self.folder, 'archive')
+            os.makedirs(archive, exist_ok=True)
+            os.replace(path, os.path.join(archive, name))
+            return recorded
+    
+    def _record_rollup(self, name, rows, events):
+        """Add a segment's summary rows in one transaction, returns the events counted,
+        None on failure or 'retry' after a deadlock"""
+        connection = get_db_connection()
+        if connection is None:
+            return None
+        try:
+            connection.start_transaction()
+            cursor = connection.cursor()
+            # Claim the segment first; a duplicate key means it was rolled up before
+            cursor.execute(
+                'INSERT INTO event_log_segments (segment, events, rolled_up_at) VALUES (%s, %s, %s)',
+                (name, events, datetime.now())
+            )
+            for start in range(0, len(rows), PROGRESS_FLUSH_BATCH_SIZE):
+                cursor.executemany(
+                    '''INSERT INTO reading_stats_daily (user_id, file_id, day, opens, flips, gotos,
+                       pages_viewed, seconds_read) VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+                       ON DUPLICATE KEY UPDATE opens = opens + VALUES(opens), flips = flips + VALUES(flips),
+                       gotos = gotos + VALUES(gotos), pages_viewed = pages_viewed + VALUES(pages_viewed),
+                       seconds_read = seconds_read + VALUES(seconds_read)''',
+                    rows[start:start + PROGRESS_FLUSH_BATCH_SIZE]
+                )
+            connection.commit()
+            cursor.close()
+            return events
+        except mysql.connector.IntegrityError:
+            connection.rollback()
+            return 0  # rolled up before, only the archive move failed
+        except Error as e:
+            connection.rollback()
+            if e.errno in (1205, 1213):  # lock wait timeout, deadlock
+                return 'retry'
+            print(f"⚠️  Warning: Could not roll up {name}: {e}")
+            return None
+        finally:
+            connection.close()
+
+reading_events = ReadingEventLog()
+
+def shown_pages(pdf_list):
+    """Number of pages in a reader's current spread (1 or 2)"""
+    return sum(1 for page in pdf_list.get_current_spread() if page)
+
+def reading_stats_summary(where, params, days):
+    """Totals from reading_stats_daily over the last days days"""
+    connection = get_db_connection()
+    if connection is None:
+        raise Error('Database connection failed')
+    try:
+        cursor = connection.cursor()
+        since = datetime.now().date() - timedelta(days=days - 1)
+        cursor.execute(
+            f'''SELECT COALESCE(SUM(opens), 0), COALESCE(SUM(flips), 0), COALESCE(SUM(gotos), 0),
+                       COALESCE(SUM(pages_viewed), 0), COALESCE(SUM(seconds_read), 0)
+                FROM reading_stats_daily WHERE {where} AND day >= %s''',
+            (*params, since)
+        )
+        opens, flips, gotos, pages_viewed, seconds_read = cursor.fetchone()
+        cursor.close()
+    finally:
+        connection.close()
+    return {
+        'opens': int(opens),
+        'flips': int(flips),
+        'gotos': int(gotos),
+        'pages_viewed': int(pages_viewed),
+        'seconds_read': round(float(seconds_read)),
+        'seconds_per_page': round(float(seconds_read) / pages_viewed, 1) if pages_viewed else None
+    }
+
+def stats_days():
+    return max(1, min(request.args.get('days', 30, type=int) or 30, 366))
+
+@app.route('/api/stats/me')
 @login_required
-def get_book_page(file_id, page_num):
-    """Get a specific page as base64 image"""
+def get_my_reading_stats():
+    """The current user's reading totals and most read books over ?days=30"""
     try:
-        import fitz
-        import base64
+        days = stats_days()
+        totals = reading_stats_summary('user_id = %s', (session['user_id'],), days)
         
         connection = get_db_connection()
         if connection is None:
             return jsonify({'error': 'Database connection failed'}), 500
-        
         cursor = connection.cursor()
-        
-        # Get stored filename
         cursor.execute(
-            '''SELECT stored_filename FROM files 
-               WHERE file_id = %s AND user_id = %s''',
-            (file_id, session['user_id'])
+            '''SELECT s.file_id, f.original_filename, SUM(s.seconds_read), SUM(s.pages_viewed)
+               FROM reading_stats_daily s JOIN files f ON f.file_id = s.file_id
+               WHERE s.user_id = %s AND s.day >= %s
+               GROUP BY s.file_id, f.original_filename ORDER BY SUM(s.seconds_read) DESC LIMIT 10''',
+            (session['user_id'], datetime.now().date() - timedelta(days=days - 1))
         )
-        file_info = cursor.fetchone()
-        
-        if not file_info:
-            return jsonify({'error': 'File not found'}), 404
-        
+        books = [{'file_id': file_id, 'filename': filename, 'seconds_read': round(float(seconds)),
+                  'pages_viewed': int(pages)} for file_id, filename, seconds, pages in cursor.fetchall()]
         cursor.close()
         connection.close()
         
-        # Open PDF and get page
-        pdf_path = os.path.join(app.config['UPLOAD_FOLDER'], file_info[0])
-        if not os.path.exists(pdf_path):
-            return jsonify({'error': 'PDF file not found on disk'}), 404
-        
-        pdf_doc = fitz.open(pdf_path)
-        
-        # Validate page number
-        if page_num < 1 or page_num > pdf_doc.page_count:
-            pdf_doc.close()
-            return jsonify({'error': 'Invalid page number'}), 400
-        
-        # Get page (0-indexed)
-        page = pdf_doc.load_page(page_num - 1)
-        
-        # Render page to image (higher quality)
-        mat = fitz.Matrix(2.0, 2.0)  # 2x zoom for better quality
-        pix = page.get_pixmap(matrix=mat)
-        img_data = pix.tobytes("png")
+        return jsonify({'success': True, 'days': days, 'totals': totals, 'books': books})
         
-        # Convert to base64
-        img_base64 = base64.b64encode(img_data).decode()
+    except Error as e:
+        return jsonify({'error': f'Database error: {str(e)}'}), 500
+
+@app.route('/api/stats/books/<file_id>')
+@login_required
+def get_book_reading_stats(file_id):
+    """Reading totals for one of the current user's books over ?days=30"""
+    try:
+        totals = reading_stats_summary('user_id = %s AND file_id = %s', (session['user_id'], file_id), stats_days())
+        return jsonify({'success': True, 'file_id': file_id, 'totals': totals})
+    except Error as e:
+        return jsonify({'error': f'Database error: {str(e)}'}), 500
+
+@app.route('/admin/stats/popular')
+@admin_required
+def get_popular_books():
+    """Books with the most readers and reading time over ?days=30"""
+    try:
+        connection = get_db_connection()
+        if connection is None:
+            return jsonify({'error': 'Database connection failed'}), 500
+        cursor = connection.cursor()
+        cursor.execute(
+            '''SELECT s.file_id, f.original_filename, COUNT(DISTINCT s.user_id), SUM(s.seconds_read),
+                      SUM(s.pages_viewed)
+               FROM reading_stats_daily s JOIN files f ON f.file_id = s.file_id
+               WHERE s.day >= %s
+               GROUP BY s.file_id, f.original_filename
+               ORDER BY COUNT(DISTINCT s.user_id) DESC, SUM(s.seconds_read) DESC LIMIT 50''',
+            (datetime.now().date() - timedelta(days=stats_days() - 1),)
+        )
+        books = [{'file_id': file_id, 'filename': filename, 'readers': readers,
+                  'seconds_read': round(float(seconds)), 'pages_viewed': int(pages)}
+                 for file_id, filename, readers, seconds, pages in cursor.fetchall()]
+        cursor.close()
+        connection.close()
+        return jsonify({'success': True, 'books': books})
+    except Error as e:
+        return jsonify({'error': f'Database error: {str(e)}'}), 500
+
+# Thumbnails
+#
+# Every page is rendered at THUMBNAIL_WIDTH and packed into sprite sheets
+# (WebP when Pillow is installed, JPEG otherwise) with a JSON index of each
+# page's sheet and position, so a page strip showing hundreds of pages costs
+# a few small requests instead of hundreds of full renders. Long documents
+# get several sheets, each under THUMBNAIL_SHEET_MAX_SIDE and RENDER_MAX_BYTES.
+thumbnail_builds = {}  # file_id -> Future of a running build
+thumbnail_builds_lock = threading.Lock()
+# Builds run in the render sandbox; this thread only waits on them and keeps
+# sheet builds from holding more than one render worker
+thumbnail_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='thumbnails')
+
+def thumbnail_paths(file_id):
+    """Index and sprite sheet files that may exist for a document (index first)"""
+    base = os.path.join(app.config['THUMBNAIL_FOLDER'], secure_filename(file_id))
+    return [f"{base}.json", f"{base}.webp", f"{base}.jpg"] + glob.glob(f"{glob.escape(base)}.[0-9]*.*")
+
+def thumbnail_sheet_path(index_path, sheet, image_format):
+    return f"{os.path.splitext(index_path)[0]}.{sheet}.{image_format}"
+
+def build_thumbnail_sheet(pdf_path, index_path, thumb_width=THUMBNAIL_WIDTH, quality=THUMBNAIL_QUALITY):
+    """Render all pages as thumbnails into sprite sheets (runs in a render worker)"""
+    import fitz
+    
+    image_format = 'webp' if importlib.util.find_spec('PIL') else 'jpg'
+    pdf_doc = fitz.open(pdf_path)
+    try:
+        cell_height = thumb_width * 2  # tall pages are scaled down to fit
+        sizes = []
+        for page in pdf_doc:
+            zoom = min(thumb_width / page.rect.width, cell_height / page.rect.height)
+            sizes.append(zoom)
+        total_pages = len(sizes)
+        cell_height = max(
+            (math.ceil(page.rect.height * zoom) for page, zoom in zip(pdf_doc, sizes)), default=1
+        )
         
+        # Roughly square sheets, split once a sheet would pass the size limits
+        columns = max(1, min(math.ceil(math.sqrt(total_pages * cell_height / thumb_width)),
+                             THUMBNAIL_SHEET_MAX_SIDE // thumb_width))
+        max_rows = max(1, min(THUMBNAIL_SHEET_MAX_SIDE // cell_height,
+                              RENDER_MAX_BYTES // (columns * thumb_width * cell_height * 3)))
+        per_sheet = columns * max_rows
+        
+        sheets = []
+        pages = []
+        for first in range(0, max(total_pages, 1), per_sheet):
+            count = min(per_sheet, total_pages - first)
+            rows = max(1, math.ceil(count / columns))
+            sheet = fitz.Pixmap(fitz.csRGB, fitz.IRect(0, 0, columns * thumb_width, rows * cell_height), False)
+            sheet.clear_with(255)
+            for offset in range(count):
+                page_index = first + offset
+                zoom = sizes[page_index]
+                x = (offset % columns) * thumb_width
+                y = (offset // columns) * cell_height
+                pix = pdf_doc[page_index].get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False,
+                                                     colorspace=fitz.csRGB)
+                pix.set_origin(x, y)
+                sheet.copy(pix, pix.irect)
+                pages.append([len(sheets), x, y, pix.width, pix.height])
+            
+            if image_format == 'webp':
+                image_data = sheet.pil_tobytes(format='WEBP', quality=quality)
+            else:
+                image_data = sheet.tobytes('jpg', jpg_quality=quality)
+            with open(thumbnail_sheet_path(index_path, len(sheets), image_format), 'wb') as f:
+                f.write(image_data)
+            sheets.append([sheet.width, sheet.height])
+            del sheet
+    finally:
         pdf_doc.close()
-        
-        return jsonify({
+    
+    index = {
+        'format': image_format,
+        'total_pages': total_pages,
+        'sheets': sheets,  # [width, height] per sheet
+        'pages': pages  # [sheet, x, y, width, height] per page, in page order
+    }
+    # Index is written last, its presence means the sheet is complete
+    with open(f"{index_path}.tmp", 'w') as f:
+        json.dump(index, f)
+    os.replace(f"{index_path}.tmp", index_path)
+    return index
+
+def schedule_thumbnail_sheet(file_id, pdf_path):
+    """Build a document's thumbnail sheet in the background (once at a time)"""
+    with thumbnail_builds_lock:
+        future = thumbnail_builds.get(file_id)
+        if future and not future.done():
+            return future
+        os.makedirs(app.config['THUMBNAIL_FOLDER'], exist_ok=True)
+        future = thumbnail_executor.submit(run_render_job, 'thumbnails', file_id, pdf_path,
+                                           thumbnail_paths(file_id)[0], timeout=THUMBNAIL_TIMEOUT)
+        thumbnail_builds[file_id] = future
+    
+    def finished(f):
+        with thumbnail_builds_lock:
+            if thumbnail_builds.get(file_id) is f:
+                del thumbnail_builds[file_id]
+        if f.exception():
+            print(f"⚠️  Warning: Could not build thumbnails for {file_id}: {f.exception()}")
+    
+    future.add_done_callback(finished)
+    return future
+
+def get_owned_pdf_path(file_id):
+    """Path and status of a PDF owned by the current user, (None, None) if unknown"""
+    connection = get_db_connection()
+    if connection is None:
+        raise Error('Database connection failed')
+    cursor = connection.cursor()
+    cursor.execute(
+        '''SELECT stored_filename, status FROM files 
+           WHERE file_id = %s AND user_id = %s''',
+        (file_id, session['user_id'])
+    )
+    file_info = cursor.fetchone()
+    cursor.close()
+    connection.close()
+    if not file_info:
+        return None, None
+    return blob_storage.local_path(file_info[0]), file_info[1]
+
+@app.route('/api/book/<file_id>/thumbnails')
+@login_required
+def get_thumbnail_index(file_id):
+    """Thumbnail sheet index (page positions), building the sheet if needed"""
+    try:
+        pdf_path, status = get_owned_pdf_path(file_id)
+        if not pdf_path:
+            return jsonify({'error': 'File not found'}), 404
+        if status in UNREADABLE_STATUSES:
+            quarantined_files.add(file_id)
+            return quarantined_response(status)
+        
+        index_path = thumbnail_paths(file_id)[0]
+        index = None
+        if os.path.exists(index_path):
+            with open(index_path) as f:
+                index = json.load(f)
+        if index is None or 'sheets' not in index:  # missing, or a single-sheet index from before
+            if not os.path.isfile(pdf_path):
+                return jsonify({'error': 'PDF file not found on disk'}), 404
+            future = schedule_thumbnail_sheet(file_id, pdf_path)
+            if future.done() and future.exception():
+                return jsonify({'error': f'Failed to build thumbnails: {future.exception()}'}), 500
+            response = jsonify({'success': False, 'pending': True, 'message': 'Thumbnails are being generated'})
+            response.headers['Retry-After'] = '2'
+            return response, 202
+        
+        version = int(os.path.getmtime(index_path))
+        index.update({
             'success': True,
-            'page_num': page_num,
-            'image': f"data:image/png;base64,{img_base64}",
-            'total_pages': pdf_doc.page_count
+            'file_id': file_id,
+            'thumbnail_width': THUMBNAIL_WIDTH,
+            'sprite_urls': [url_for('get_thumbnail_sprite', file_id=file_id, sheet=sheet, v=version)
+                            for sheet in range(len(index['sheets']))]
         })
+        return jsonify(index)
         
     except Exception as e:
-        return jsonify({'error': f'Failed to get page: {str(e)}'}), 500
+        return jsonify({'error': f'Failed to get thumbnails: {str(e)}'}), 500
+
+@app.route('/api/book/<file_id>/thumbnails/sprite')
+@login_required
+def get_thumbnail_sprite(file_id):
+    """One thumbnail sprite sheet (?sheet=n, cacheable, the URL carries the sheet version)"""
+    try:
+        pdf_path, status = get_owned_pdf_path(file_id)
+        if not pdf_path:
+            return jsonify({'error': 'File not found'}), 404
+        if status in UNREADABLE_STATUSES:
+            return quarantined_response(status)
+        
+        index_path = thumbnail_paths(file_id)[0]
+        sheet = request.args.get('sheet', 0, type=int)
+        for image_format, mimetype in (('webp', 'image/webp'), ('jpg', 'image/jpeg')):
+            sprite_path = thumbnail_sheet_path(index_path, sheet, image_format)
+            if os.path.exists(index_path) and os.path.exists(sprite_path):
+                response = send_file(os.path.abspath(sprite_path), mimetype=mimetype, conditional=True,
+                                     etag=True, max_age=7 * 24 * 3600)
+                response.cache_control.public = False
+                response.cache_control.private = True
+                return response
+        return jsonify({'error': 'Thumbnails not generated yet'}), 404
+        
+    except Exception as e:
+        return jsonify({'error': f'Failed to get thumbnails: {str(e)}'}), 500
 
 # Add this to handle file selection from library
 @app.route('/select-file/<file_id>', methods=['POST'])
@@ -1091,18 +3342,14 @@ def select_file(file_id):
         )
         file_info = cursor.fetchone()
         
+        cursor.close()
+        connection.close()
+        
         if not file_info:
             return jsonify({'error': 'File not found'}), 404
         
-        # Update last_read timestamp
-        cursor.execute(
-            'UPDATE files SET last_read = %s WHERE file_id = %s',
-            (datetime.now().date(), file_id)
-        )
-        
-        connection.commit()
-        cursor.close()
-        connection.close()
+        # Update last_read timestamp (written behind in the next batch)
+        reading_progress.mark_read(file_id)
         
         return jsonify({
             'success': True,
@@ -1135,6 +3382,16 @@ class PDFLinkedList:
         self.current = None
         self.total_pages = total_pages
         self.page_nodes = {}  # Dictionary for O(1) page access
+        self.loaded_bytes = 0  # size of the rendered page data held
+        self._loaded_order = OrderedDict()  # loaded page numbers, least recently used first
+        self._lock = threading.RLock()
+        self.stored_filename = None  # blob key of the PDF, used for background prefetch
+        self.toc_pages = []  # pages the outline points to
+        self.history = deque(maxlen=NAVIGATION_HISTORY_SIZE)  # recent moves: 'next', 'prev', 'goto'
+        self.navigation_generation = 0  # bumped by every move, renders for older moves are dropped
+        self._prefetched = set()  # pages rendered ahead of use, not shown yet
+        self.prefetch_stats = {'issued': 0, 'hits': 0, 'wasted': 0}
+        self.annotations = {}  # page number -> annotations, for pages read so far
         self._initialize_list()
     
     def _initialize_list(self):
@@ -1157,13 +3414,58 @@ class PDFLinkedList:
         return self.page_nodes.get(page_number)
     
     def load_page_data(self, page_number, page_data):
-        """Load data for a specific page"""
+        """Load data for a specific page (None leaves it unloaded so it is retried)"""
         node = self.get_page_node(page_number)
-        if node:
-            node.page_data = page_data
-            node.is_loaded = True
-            return True
-        return False
+        if not node:
+            return False
+        with self._lock:
+            self._release(node)
+            if page_data is not None:
+                node.page_data = page_data
+                node.is_loaded = True
+                self.loaded_bytes += len(page_data)
+                self._loaded_order[page_number] = None
+        return True
+    
+    def touch_page(self, page_number):
+        """Mark a loaded page as recently used"""
+        with self._lock:
+            if page_number in self._loaded_order:
+                self._loaded_order.move_to_end(page_number)
+    
+    def unload_page(self, page_number):
+        """Drop the rendered data of a page and return the bytes freed"""
+        node = self.get_page_node(page_number)
+        if not node:
+            return 0
+        with self._lock:
+            if page_number in self._prefetched:
+                # Rendered ahead but never shown
+                self._prefetched.discard(page_number)
+                self.prefetch_stats['wasted'] += 1
+                prefetch_totals.add('wasted')
+            return self._release(node)
+    
+    def _release(self, node):
+        if not node.is_loaded:
+            return 0
+        freed = len(node.page_data or '')
+        node.page_data = None
+        node.is_loaded = False
+        self.loaded_bytes -= freed
+        self._loaded_order.pop(node.page_number, None)
+        return freed
+    
+    def evict_pages(self, bytes_needed, keep=()):
+        """Unload least recently used pages (except keep) until bytes_needed are freed"""
+        freed = 0
+        with self._lock:
+            for page_number in list(self._loaded_order):
+                if freed >= bytes_needed:
+                    break
+                if page_number not in keep:
+                    freed += self.unload_page(page_number)
+        return freed
     
     def get_current_spread(self):
         """Get current two-page spread for book view"""
@@ -1202,9 +3504,214 @@ class PDFLinkedList:
             self.current = node
             return True
         return False
+    
+    # Navigation history and predictive prefetch
+    
+    def record_navigation(self, move):
+        """Remember a move ('next', 'prev' or 'goto') for the prefetch policy"""
+        with self._lock:
+            self.history.append(move)
+            self.navigation_generation += 1
+    
+    def superseded_check(self):
+        """A function telling whether the reader has moved on since it was created"""
+        generation = self.navigation_generation
+        return lambda: self.navigation_generation != generation
+    
+    def access_pattern(self):
+        """'sequential', 'backward' or 'jumping' judged from recent moves ('new' without any)"""
+        if not self.history:
+            return 'new'
+        counts = {move: self.history.count(move) for move in ('next', 'prev', 'goto')}
+        if counts['goto'] > counts['next'] + counts['prev']:
+            return 'jumping'
+        return 'backward' if counts['prev'] > counts['next'] else 'sequential'
+    
+    def prefetch_plan(self):
+        """Page numbers worth rendering ahead of the reader, most likely first.
+        
+        Sequential readers get a read-ahead that grows with their streak of
+        flips in the same direction; jumpers get the next spread and the
+        nearest table of contents targets instead.
+        """
+        left_page, right_page = self.get_current_spread()
+        if not left_page:
+            return []
+        edge_after = right_page or left_page
+        pattern = self.access_pattern()
+        
+        streak = 0
+        for move in reversed(self.history):
+            if move != self.history[-1]:
+                break
+            streak += 1
+        depth = min(max(2, 2 * streak), PREFETCH_MAX_PAGES)
+        
+        pages = []
+        if pattern == 'backward':
+            node = left_page.prev
+            for _ in range(depth):
+                if node is None:
+                    break
+                pages.append(node.page_number)
+                node = node.prev
+        else:
+            node = edge_after.next
+            for _ in range(2 if pattern == 'jumping' else depth):
+                if node is None:
+                    break
+                pages.append(node.page_number)
+                node = node.next
+        
+        if pattern == 'jumping':
+            here = left_page.page_number
+            targets = sorted((page for page in self.toc_pages if page not in (here, edge_after.page_number)),
+                             key=lambda page: abs(page - here))
+            pages.extend(targets[:PREFETCH_TOC_TARGETS])
+        
+        return [page for page in dict.fromkeys(pages) if not self.page_nodes[page].is_loaded]
+    
+    # Annotation cache (see spread_annotations)
+    
+    def cache_annotations(self, annotations_by_page):
+        """Store the annotations of pages read from the database"""
+        with self._lock:
+            self.annotations.update(annotations_by_page)
+    
+    def put_annotation(self, annotation):
+        """Add or replace an annotation on pages whose annotations are cached"""
+        with self._lock:
+            self.remove_annotation(annotation['id'])
+            if annotation['page'] in self.annotations:
+                self.annotations[annotation['page']].append(annotation)
+    
+    def remove_annotation(self, annotation_id):
+        with self._lock:
+            for page, annotations in self.annotations.items():
+                self.annotations[page] = [a for a in annotations if a['id'] != annotation_id]
+    
+    def note_prefetched(self, page_number):
+        """Count a page rendered ahead of use"""
+        with self._lock:
+            if page_number not in self._prefetched:
+                self._prefetched.add(page_number)
+                self.prefetch_stats['issued'] += 1
+                prefetch_totals.add('issued')
+    
+    def mark_viewed(self, page_numbers):
+        """Count prefetched pages that were actually shown"""
+        with self._lock:
+            for page_number in page_numbers:
+                if page_number in self._prefetched:
+                    self._prefetched.discard(page_number)
+                    self.prefetch_stats['hits'] += 1
+                    prefetch_totals.add('hits')
+
+class PrefetchTotals:
+    """Prefetch counters across all reader sessions"""
+    def __init__(self):
+        self.counts = {'issued': 0, 'hits': 0, 'wasted': 0}
+        self._lock = threading.Lock()
+    
+    def add(self, name):
+        with self._lock:
+            self.counts[name] += 1
+    
+    def report(self):
+        with self._lock:
+            counts = dict(self.counts)
+        return prefetch_report(counts)
+
+def prefetch_report(counts):
+    """Counters plus hit and waste rates (shares of issued prefetches)"""
+    issued = counts['issued']
+    return dict(counts,
+                hit_rate=round(counts['hits'] / issued, 3) if issued else None,
+                waste_rate=round(counts['wasted'] / issued, 3) if issued else None)
+
+prefetch_totals = PrefetchTotals()
 
-# Global dictionary to store PDF linked lists for each user session
-pdf_sessions = {}
+class PDFSessionStore:
+    """Open PDF linked lists keyed by session key, with per-user limits.
+    
+    A user may have several books open (one per tab). Each user keeps at most
+    MAX_READER_SESSIONS_PER_USER books and READER_MEMORY_BUDGET_PER_USER bytes
+    of rendered pages (read from app.config); past that the least recently
+    used pages, then books, are dropped.
+    """
+    def __init__(self):
+        self._sessions = OrderedDict()  # session_key -> (user_id, file_id, pdf_list), LRU first
+        self._lock = threading.RLock()
+    
+    def get(self, session_key):
+        """Return the linked list for a session (or None) and mark it recently used"""
+        with self._lock:
+            entry = self._sessions.get(session_key)
+            if entry is None:
+                return None
+            self._sessions.move_to_end(session_key)
+            return entry[2]
+    
+    def __contains__(self, session_key):
+        return session_key in self._sessions
+    
+    def __delitem__(self, session_key):
+        with self._lock:
+            del self._sessions[session_key]
+    
+    def put(self, user_id, file_id, pdf_list):
+        """Register a session, closing the user's oldest books beyond the quota"""
+        evicted = []
+        with self._lock:
+            self._sessions[get_pdf_session_key(user_id, file_id)] = (user_id, file_id, pdf_list)
+            user_keys = [key for key, entry in self._sessions.items() if entry[0] == user_id]
+            for key in user_keys[:max(0, len(user_keys) - app.config['MAX_READER_SESSIONS_PER_USER'])]:
+                evicted.append(self._sessions.pop(key)[1])
+        for old_file_id in evicted:
+            close_reader_channels(user_id, old_file_id)
+        return pdf_list
+    
+    def enforce_memory_budget(self, user_id):
+        """Unload the user's least recently used pages until they fit the budget.
+        
+        The current spread of every open book is kept, so a tab never loses
+        the pages it is showing.
+        """
+        with self._lock:
+            user_lists = [entry[2] for entry in self._sessions.values() if entry[0] == user_id]
+        over = sum(pdf_list.loaded_bytes for pdf_list in user_lists) - app.config['READER_MEMORY_BUDGET_PER_USER']
+        for pdf_list in user_lists:
+            if over <= 0:
+                break
+            keep = {node.page_number for node in pdf_list.get_current_spread() if node}
+            over -= pdf_list.evict_pages(over, keep)
+    
+    def user_sessions(self, user_id):
+        """Describe the books a user has open, most recently used first"""
+        with self._lock:
+            entries = [entry for entry in self._sessions.values() if entry[0] == user_id]
+        return [{
+            'file_id': file_id,
+            'total_pages': pdf_list.total_pages,
+            'current_page': pdf_list.current.page_number if pdf_list.current else 1,
+            'loaded_pages': len(pdf_list._loaded_order),
+            'loaded_bytes': pdf_list.loaded_bytes,
+            'access_pattern': pdf_list.access_pattern(),
+            'prefetch': prefetch_report(pdf_list.prefetch_stats)
+        } for _, file_id, pdf_list in reversed(entries)]
+    
+    def pattern_counts(self):
+        """Number of open sessions per access pattern"""
+        with self._lock:
+            lists = [entry[2] for entry in self._sessions.values()]
+        counts = {}
+        for pdf_list in lists:
+            pattern = pdf_list.access_pattern()
+            counts[pattern] = counts.get(pattern, 0) + 1
+        return counts
+
+# PDF linked lists for every open reader session
+pdf_sessions = PDFSessionStore()
 
 def get_pdf_session_key(user_id, file_id):
     """Generate session key for PDF linked list"""
@@ -1214,11 +3721,10 @@ def get_pdf_session_key(user_id, file_id):
 
 @app.route('/api/book/<file_id>/initialize')
 @login_required
+@rate_limited('initialize')
 def initialize_pdf_linkedlist(file_id):
-    """Initialize PDF with linked list structure"""
+    """Initialize PDF with linked list structure (reuses an open session for the same book)"""
     try:
-        import fitz
-        
         connection = get_db_connection()
         if connection is None:
             return jsonify({'error': 'Database connection failed'}), 500
@@ -1227,45 +3733,83 @@ def initialize_pdf_linkedlist(file_id):
         
         # Get stored filename
         cursor.execute(
-            '''SELECT stored_filename FROM files 
+            '''SELECT stored_filename, status FROM files 
                WHERE file_id = %s AND user_id = %s''',
             (file_id, session['user_id'])
         )
         file_info = cursor.fetchone()
         
-        if not file_info:
-            return jsonify({'error': 'File not found'}), 404
+        if not file_info or file_info[1] in UNREADABLE_STATUSES:
+            cursor.close()
+            connection.close()
+            if not file_info:
+                return jsonify({'error': 'File not found'}), 404
+            quarantined_files.add(file_id)
+            return quarantined_response(file_info[1])
+        
+        # Page to resume at (unflushed progress wins over the saved row)
+        saved_page = reading_progress.get_page(session['user_id'], file_id)
+        if saved_page is None:
+            cursor.execute(
+                'SELECT page_number FROM reading_progress WHERE user_id = %s AND file_id = %s',
+                (session['user_id'], file_id)
+            )
+            progress = cursor.fetchone()
+            saved_page = progress[0] if progress else None
         
         cursor.close()
         connection.close()
         
         # Open PDF and get page count
-        pdf_path = os.path.join(app.config['UPLOAD_FOLDER'], file_info[0])
-        if not os.path.exists(pdf_path):
+        pdf_path = blob_storage.local_path(file_info[0])
+        if not os.path.isfile(pdf_path):
             return jsonify({'error': 'PDF file not found on disk'}), 404
         
-        pdf_doc = fitz.open(pdf_path)
-        total_pages = pdf_doc.page_count
-        pdf_doc.close()
-        
-        # Create linked list for this PDF session
+        # Another tab (or a reload) may already have this book open; keep its
+        # position and rendered pages instead of starting from scratch
         session_key = get_pdf_session_key(session['user_id'], file_id)
-        pdf_sessions[session_key] = PDFLinkedList(total_pages)
+        pdf_list = pdf_sessions.get(session_key)
+        reused = pdf_list is not None
+        if not reused:
+            total_pages, toc_pages = run_render_job('info', file_id, pdf_path)
+            
+            pdf_list = PDFLinkedList(total_pages)
+            pdf_list.toc_pages = toc_pages
+            if saved_page:
+                pdf_list.go_to_page(saved_page)
+            pdf_sessions.put(session['user_id'], file_id, pdf_list)
+        pdf_list.stored_filename = file_info[0]
+        total_pages = pdf_list.total_pages
+        reading_events.record('open', session['user_id'], file_id,
+                              pdf_list.current.page_number if pdf_list.current else 1, shown_pages(pdf_list))
+        
+        # Event stream channel for this reader (see /stream)
+        stream_token = open_reader_channel(session['user_id'], file_id, pdf_path)
         
         return jsonify({
             'success': True,
             'total_pages': total_pages,
             'file_id': file_id,
-            'session_key': session_key
+            'session_key': session_key,
+            'stream_token': stream_token,
+            'current_page': pdf_list.current.page_number if pdf_list.current else 1,
+            'reused': reused
         })
         
+    except RenderFailedError as e:
+        return jsonify({'error': f'Failed to open PDF: {str(e)}'}), 422
     except Exception as e:
         return jsonify({'error': f'Failed to initialize PDF: {str(e)}'}), 500
 
 @app.route('/api/book/<file_id>/current-spread')
 @login_required
 def get_current_spread(file_id):
-    """Get current two-page spread using linked list"""
+    """Get current two-page spread using linked list.
+    
+    Clients list the pages they already hold in ?have=3,4,5; those come back
+    with image_data null and cached true instead of being sent again.
+    total_pages is static and comes from /initialize.
+    """
     try:
         session_key = get_pdf_session_key(session['user_id'], file_id)
         pdf_list = pdf_sessions.get(session_key)
@@ -1273,46 +3817,60 @@ def get_current_spread(file_id):
         if not pdf_list:
             return jsonify({'error': 'PDF session not found. Please refresh the page.'}), 404
         
+        superseded = pdf_list.superseded_check()
         left_page, right_page = pdf_list.get_current_spread()
+        have = {int(n) for n in request.args.get('have', '').split(',') if n.strip().isdigit()}
         
         # Load page data if not already loaded
         result = {
             'success': True,
             'left_page': None,
             'right_page': None,
-            'current_page_num': left_page.page_number if left_page else 1,
-            'total_pages': pdf_list.total_pages
+            'current_page_num': left_page.page_number if left_page else 1
         }
         
-        if left_page:
-            if not left_page.is_loaded:
-                # Remove 'await' and call synchronously
-                left_page.page_data = load_page_from_pdf(file_id, left_page.page_number)
-                left_page.is_loaded = True
-            
-            result['left_page'] = {
-                'page_number': left_page.page_number,
-                'image_data': left_page.page_data
-            }
-        
-        if right_page:
-            if not right_page.is_loaded:
-                # Remove 'await' and call synchronously
-                right_page.page_data = load_page_from_pdf(file_id, right_page.page_number)
-                right_page.is_loaded = True
-            
-            result['right_page'] = {
-                'page_number': right_page.page_number,
-                'image_data': right_page.page_data
-            }
+        for page in (left_page, right_page):
+            if not page or page.page_number in have:
+                continue
+            if page.is_loaded:
+                pdf_list.touch_page(page.page_number)
+            elif superseded():
+                return superseded_response()  # a newer navigation moved the reader on, skip the render
+            else:
+                pdf_list.load_page_data(page.page_number, load_page_from_pdf(file_id, page.page_number, superseded))
+        pdf_list.mark_viewed(page.page_number for page in (left_page, right_page) if page)
+        pdf_sessions.enforce_memory_budget(session['user_id'])
+        schedule_prefetch(pdf_list, file_id, session['user_id'])
+        
+        for key, page in (('left_page', left_page), ('right_page', right_page)):
+            if page:
+                cached = page.page_number in have
+                result[key] = {
+                    'page_number': page.page_number,
+                    'image_data': None if cached else page.page_data,
+                    'cached': cached
+                }
+        result['annotations'] = spread_annotations(
+            pdf_list, session['user_id'], file_id, [page.page_number for page in (left_page, right_page) if page]
+        )
         
         return jsonify(result)
         
+    except RenderSupersededError:
+        return superseded_response()
+    except RenderBusyError as e:
+        response = jsonify({'error': str(e)})
+        response.headers['Retry-After'] = '2'
+        return response, 503
     except Exception as e:
         return jsonify({'error': f'Failed to get current spread: {str(e)}'}), 500
 
+def superseded_response():
+    return jsonify({'success': False, 'superseded': True, 'error': 'Replaced by a newer navigation'}), 409
+
 @app.route('/api/book/<file_id>/navigate/<direction>')
 @login_required
+@rate_limited('navigate')
 def navigate_pdf(file_id, direction):
     """Navigate PDF using linked list (next/prev)"""
     try:
@@ -1330,6 +3888,11 @@ def navigate_pdf(file_id, direction):
         
         if not success:
             return jsonify({'error': f'Cannot navigate {direction}'}), 400
+        pdf_list.record_navigation(direction)
+        
+        reading_progress.record_page(session['user_id'], file_id, pdf_list.current.page_number)
+        reading_events.record('flip', session['user_id'], file_id, pdf_list.current.page_number,
+                              shown_pages(pdf_list))
         
         # Return current spread after navigation
         return get_current_spread(file_id)
@@ -1337,32 +3900,564 @@ def navigate_pdf(file_id, direction):
     except Exception as e:
         return jsonify({'error': f'Failed to navigate: {str(e)}'}), 500
 
-@app.route('/api/book/<file_id>/goto/<int:page_number>')
-@login_required
-def goto_page(file_id, page_number):
-    """Go to a specific page using linked list"""
+@app.route('/api/book/<file_id>/goto/<int:page_number>')
+@login_required
+@rate_limited('navigate')
+def goto_page(file_id, page_number):
+    """Go to a specific page using linked list"""
+    try:
+        session_key = get_pdf_session_key(session['user_id'], file_id)
+        pdf_list = pdf_sessions.get(session_key)
+        
+        if not pdf_list:
+            return jsonify({'error': 'PDF session not found. Please refresh the page.'}), 404
+        
+        if not pdf_list.go_to_page(page_number):
+            return jsonify({'error': 'Invalid page number'}), 400
+        pdf_list.record_navigation('goto')
+        
+        reading_progress.record_page(session['user_id'], file_id, page_number)
+        reading_events.record('goto', session['user_id'], file_id, page_number,
+                              shown_pages(pdf_list))
+        
+        # Return current spread after navigation
+        return get_current_spread(file_id)
+        
+    except Exception as e:
+        return jsonify({'error': f'Failed to go to page: {str(e)}'}), 500
+
+# Annotations (highlights, notes and bookmarks)
+#
+# Readers queue their edits and send them in batches, applied in a single
+# transaction. Reads fetch a whole spread in one query and are cached on the
+# reader session, so overlays arrive together with the pages.
+
+def annotation_to_dict(row):
+    annotation_id, page_number, kind, data, updated_at = row
+    return {
+        'id': annotation_id,
+        'page': page_number,
+        'kind': kind,
+        'data': json.loads(data) if data else {},
+        'updated_at': updated_at.isoformat() if updated_at else None
+    }
+
+def fetch_annotations(user_id, file_id, pages=None):
+    """Annotations of a book, on the given pages only if pages is set, as {page: [annotation, ...]}"""
+    result = {page: [] for page in pages or ()}
+    if pages is not None and not pages:
+        return result
+    connection = get_db_connection()
+    if connection is None:
+        raise Error('Database connection failed')
+    try:
+        cursor = connection.cursor()
+        query = '''SELECT annotation_id, page_number, kind, data, updated_at FROM annotations
+                   WHERE user_id = %s AND file_id = %s'''
+        params = [user_id, file_id]
+        if pages is not None:
+            query += f" AND page_number IN ({', '.join(['%s'] * len(pages))})"
+            params.extend(pages)
+        cursor.execute(query + ' ORDER BY page_number, created_at', params)
+        for row in cursor.fetchall():
+            result.setdefault(row[1], []).append(annotation_to_dict(row))
+        cursor.close()
+    finally:
+        connection.close()
+    return result
+
+def spread_annotations(pdf_list, user_id, file_id, pages):
+    """Annotations for a spread's pages keyed by page number, cached on the reader session"""
+    missing = [page for page in pages if page not in pdf_list.annotations]
+    if missing:
+        try:
+            pdf_list.cache_annotations(fetch_annotations(user_id, file_id, missing))
+        except Error as e:
+            print(f"⚠️  Warning: Could not load annotations: {e}")
+    return {str(page): pdf_list.annotations.get(page, []) for page in pages}
+
+def parse_annotation_ops(ops):
+    """Validate a batch of annotation operations, returns (upserts, deleted ids) or raises ValueError"""
+    if not isinstance(ops, list) or not ops:
+        raise ValueError('ops must be a non-empty list')
+    if len(ops) > ANNOTATION_BATCH_MAX:
+        raise ValueError(f'At most {ANNOTATION_BATCH_MAX} operations per batch')
+    
+    upserts = {}
+    deletes = set()
+    for op in ops:
+        annotation_id = op.get('id') if isinstance(op, dict) else None
+        if not isinstance(annotation_id, str) or not 0 < len(annotation_id) <= 36:
+            raise ValueError('Every operation needs an id of up to 36 characters')
+        if op.get('op') == 'delete':
+            upserts.pop(annotation_id, None)
+            deletes.add(annotation_id)
+        elif op.get('op') == 'upsert':
+            page = op.get('page')
+            if not isinstance(page, int) or page < 1:
+                raise ValueError('page must be a positive integer')
+            if op.get('kind') not in ANNOTATION_KINDS:
+                raise ValueError(f"kind must be one of {', '.join(sorted(ANNOTATION_KINDS))}")
+            data = json.dumps(op.get('data') or {})
+            if len(data) > ANNOTATION_MAX_BYTES:
+                raise ValueError(f'Annotation data is limited to {ANNOTATION_MAX_BYTES} bytes')
+            deletes.discard(annotation_id)
+            upserts[annotation_id] = (annotation_id, page, op['kind'], data)  # the last write wins
+        else:
+            raise ValueError("op must be 'upsert' or 'delete'")
+    return list(upserts.values()), deletes
+
+@app.route('/api/book/<file_id>/annotations')
+@login_required
+def get_annotations(file_id):
+    """Annotations of a book, or only of ?pages=3,4"""
+    try:
+        pages = request.args.get('pages')
+        if pages is None:
+            annotations = fetch_annotations(session['user_id'], file_id)
+            return jsonify({'success': True, 'annotations': {str(k): v for k, v in annotations.items()}})
+        
+        pages = sorted({int(n) for n in pages.split(',') if n.strip().isdigit()})[:ANNOTATION_BATCH_MAX]
+        pdf_list = pdf_sessions.get(get_pdf_session_key(session['user_id'], file_id))
+        if pdf_list:
+            annotations = spread_annotations(pdf_list, session['user_id'], file_id, pages)
+        else:
+            annotations = {str(k): v for k, v in fetch_annotations(session['user_id'], file_id, pages).items()}
+        return jsonify({'success': True, 'annotations': annotations})
+        
+    except Error as e:
+        return jsonify({'error': f'Database error: {str(e)}'}), 500
+
+@app.route('/api/book/<file_id>/annotations/batch', methods=['POST'])
+@login_required
+@rate_limited('annotations')
+def write_annotations(file_id):
+    """Apply a batch of annotation upserts and deletes in one transaction.
+    
+    Body: {"ops": [{"op": "upsert", "id": "<uuid>", "page": 3, "kind": "note",
+    "data": {...}}, {"op": "delete", "id": "<uuid>"}]}. Ids are chosen by the
+    client, so a batch can safely be sent again.
+    """
+    try:
+        data = request.get_json(silent=True) or {}
+        try:
+            upserts, deletes = parse_annotation_ops(data.get('ops'))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        connection = get_db_connection()
+        if connection is None:
+            return jsonify({'error': 'Database connection failed'}), 500
+        
+        user_id = session['user_id']
+        try:
+            # The ownership check runs in the same transaction as the writes
+            connection.start_transaction()
+            cursor = connection.cursor()
+            cursor.execute('SELECT 1 FROM files WHERE file_id = %s AND user_id = %s', (file_id, user_id))
+            if cursor.fetchone() is None:
+                cursor.close()
+                connection.rollback()
+                return jsonify({'error': 'File not found'}), 404
+            
+            now = datetime.now()
+            if upserts:
+                cursor.executemany(
+                    '''INSERT INTO annotations (user_id, annotation_id, file_id, page_number, kind, data,
+                       created_at, updated_at) VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+                       ON DUPLICATE KEY UPDATE page_number = VALUES(page_number), kind = VALUES(kind),
+                       data = VALUES(data), updated_at = VALUES(updated_at)''',
+                    [(user_id, annotation_id, file_id, page, kind, annotation_data, now, now)
+                     for annotation_id, page, kind, annotation_data in upserts]
+                )
+            if deletes:
+                placeholders = ', '.join(['%s'] * len(deletes))
+                cursor.execute(
+                    f'DELETE FROM annotations WHERE user_id = %s AND file_id = %s AND annotation_id IN ({placeholders})',
+                    [user_id, file_id, *deletes]
+                )
+            connection.commit()
+            cursor.close()
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            connection.close()
+        
+        # Keep the reader session's cache in step
+        pdf_list = pdf_sessions.get(get_pdf_session_key(user_id, file_id))
+        if pdf_list:
+            for annotation_id in deletes:
+                pdf_list.remove_annotation(annotation_id)
+            for annotation_id, page, kind, annotation_data in upserts:
+                pdf_list.put_annotation(annotation_to_dict((annotation_id, page, kind, annotation_data, now)))
+        
+        return jsonify({'success': True, 'upserted': len(upserts), 'deleted': len(deletes)})
+        
+    except Error as e:
+        return jsonify({'error': f'Database error: {str(e)}'}), 500
+
+# Reader event streams
+#
+# Instead of one request per flip that re-sends the whole spread, a reader
+# opens a server-sent event stream once and posts small navigation intents.
+# The server pushes spread metadata straight away and page images as they
+# finish rendering. Intents are authenticated by the stream token handed out
+# by /initialize, so they need no database lookups. Page events only keep the
+# page number; the image is read from the reader session when the event is
+# sent, and a page evicted in between goes out without one (the client
+# fetches it from /page instead).
+READER_CHANNEL_BACKLOG = 32  # events kept for clients reconnecting with Last-Event-ID
+READER_CHANNEL_HEARTBEAT = 15  # seconds between keepalive comments
+READER_CHANNEL_IDLE_TIMEOUT = 30 * 60  # drop channels unused for this long
+READER_CHANNEL_SWEEP_INTERVAL = 60  # seconds between sweeps for idle channels
+READER_RENDER_WORKERS = 4
+READER_RENDER_QUEUE_PER_USER = 32  # queued background renders per user, oldest dropped beyond
+
+class ReaderChannel:
+    """Server-sent event channel for one open book"""
+    def __init__(self, token, user_id, file_id, pdf_path):
+        self.token = token
+        self.user_id = user_id
+        self.file_id = file_id
+        self.pdf_path = pdf_path
+        self.events = deque(maxlen=READER_CHANNEL_BACKLOG)
+        self.last_event_id = 0
+        self.last_seen = time.time()
+        self.closed = False
+        self._condition = threading.Condition()
+        self._waiters = set()  # callbacks run on publish (used by the ASGI stream)
+    
+    def publish(self, event, data):
+        """Queue an event for the stream"""
+        with self._condition:
+            self.last_event_id += 1
+            self.events.append((self.last_event_id, event, data))
+            self._condition.notify_all()
+            waiters = list(self._waiters)
+        for notify in waiters:
+            notify()
+    
+    def events_after(self, last_id):
+        """Events newer than last_id"""
+        with self._condition:
+            return [e for e in self.events if e[0] > last_id]
+    
+    def wait(self, last_id, timeout):
+        """Block until there are events newer than last_id (or timeout)"""
+        with self._condition:
+            self._condition.wait_for(lambda: self.closed or self.last_event_id > last_id, timeout)
+            return [e for e in self.events if e[0] > last_id]
+    
+    def add_waiter(self, notify):
+        with self._condition:
+            self._waiters.add(notify)
+    
+    def remove_waiter(self, notify):
+        with self._condition:
+            self._waiters.discard(notify)
+    
+    def close(self):
+        with self._condition:
+            self.closed = True
+            self._condition.notify_all()
+            waiters = list(self._waiters)
+        for notify in waiters:
+            notify()
+    
+    def format_event(self, event_id, event, data):
+        """Encode a queued event, adding the page image if the session still holds it"""
+        if event == 'page':
+            pdf_list = pdf_sessions.get(get_pdf_session_key(self.user_id, self.file_id))
+            node = pdf_list.get_page_node(data['page_number']) if pdf_list else None
+            image_data = node.page_data if node and node.is_loaded else None
+            if image_data is not None:
+                data = dict(data, image_data=image_data)
+        return format_sse(event_id, event, data)
+
+# Stream token -> ReaderChannel
+reader_channels = {}
+reader_channels_lock = threading.Lock()
+reader_channel_sweeper = None
+
+class FairRenderScheduler:
+    """Background render queue served round-robin across users.
+    
+    Every user has their own queue and the workers take one job from each
+    user in turn, so one reader queueing hundreds of pages only delays their
+    own renders. Jobs belong to a group (a reader tab, or a book's prefetch
+    plan); cancel(group) drops the group's jobs that have not started, which
+    is how renders for spreads the reader already left are skipped.
+    """
+    def __init__(self, workers, max_pending_per_user):
+        self.workers = workers
+        self.max_pending_per_user = max_pending_per_user
+        self.cancelled = 0
+        self._queues = OrderedDict()  # user_id -> deque of (group, function, args), next user first
+        self._condition = threading.Condition()
+        self._threads = []
+    
+    def _start(self):
+        if not self._threads:
+            for n in range(self.workers):
+                thread = threading.Thread(target=self._run, name=f'reader-render-{n}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+    
+    def submit(self, user_id, group, function, *args):
+        with self._condition:
+            self._start()
+            jobs = self._queues.setdefault(user_id, deque())
+            if len(jobs) >= self.max_pending_per_user:
+                jobs.popleft()  # the oldest request is the least likely to still be wanted
+                self.cancelled += 1
+            jobs.append((group, function, args))
+            self._condition.notify()
+    
+    def cancel(self, group):
+        """Drop queued jobs of a group, returns how many were dropped"""
+        with self._condition:
+            dropped = 0
+            for user_id, jobs in list(self._queues.items()):
+                kept = deque(job for job in jobs if job[0] != group)
+                dropped += len(jobs) - len(kept)
+                if kept:
+                    self._queues[user_id] = kept
+                else:
+                    del self._queues[user_id]
+            self.cancelled += dropped
+            return dropped
+    
+    def pending(self):
+        with self._condition:
+            return {user_id: len(jobs) for user_id, jobs in self._queues.items()}
+    
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._queues:
+                    self._condition.wait()
+                user_id, jobs = self._queues.popitem(last=False)
+                _, function, args = jobs.popleft()
+                if jobs:
+                    self._queues[user_id] = jobs  # back of the line
+            try:
+                function(*args)
+            except Exception as e:
+                print(f"Error in background render: {e}")
+
+reader_renders = FairRenderScheduler(READER_RENDER_WORKERS, READER_RENDER_QUEUE_PER_USER)
+
+def open_reader_channel(user_id, file_id, pdf_path):
+    """Create a channel for a reader session and return its token.
+    
+    Other tabs on the same book keep their channels; idle ones are closed by
+    a background sweep.
+    """
+    global reader_channel_sweeper
+    token = secrets.token_urlsafe(24)
+    with reader_channels_lock:
+        reader_channels[token] = ReaderChannel(token, user_id, file_id, pdf_path)
+        if reader_channel_sweeper is None:
+            reader_channel_sweeper = threading.Thread(target=_sweep_reader_channels,
+                                                      name='reader-channel-sweep', daemon=True)
+            reader_channel_sweeper.start()
+    return token
+
+def _sweep_reader_channels():
+    """Close channels unused for READER_CHANNEL_IDLE_TIMEOUT, every READER_CHANNEL_SWEEP_INTERVAL"""
+    while True:
+        time.sleep(READER_CHANNEL_SWEEP_INTERVAL)
+        now = time.time()
+        with reader_channels_lock:
+            for token, channel in list(reader_channels.items()):
+                if now - channel.last_seen > READER_CHANNEL_IDLE_TIMEOUT:
+                    channel.close()
+                    del reader_channels[token]
+
+def close_reader_channels(user_id, file_id):
+    """Close the channels of a reader session"""
+    with reader_channels_lock:
+        for token, channel in list(reader_channels.items()):
+            if channel.user_id == user_id and channel.file_id == file_id:
+                channel.close()
+                del reader_channels[token]
+
+def close_reader_session(user_id, file_id):
+    """Drop a book's reader session, its channels and queued prefetch renders (cleanup, delete)"""
+    try:
+        del pdf_sessions[get_pdf_session_key(user_id, file_id)]
+    except KeyError:
+        pass
+    close_reader_channels(user_id, file_id)
+    reader_renders.cancel(('prefetch', user_id, file_id))
+
+def close_reader_channel(token, file_id):
+    """Close a single channel (one tab) and return whether it existed"""
+    with reader_channels_lock:
+        channel = reader_channels.get(token or '')
+        if channel is None or channel.file_id != file_id:
+            return False
+        channel.close()
+        del reader_channels[token]
+    return True
+
+def get_reader_channel(token, file_id):
+    """Look up an open channel by its token"""
+    channel = reader_channels.get(token or '')
+    if channel is None or channel.closed or channel.file_id != file_id:
+        return None
+    channel.last_seen = time.time()
+    return channel
+
+def format_sse(event_id, event, data):
+    """Encode one server-sent event"""
+    return f"id: {event_id}\nevent: {event}\ndata: {json.dumps(data)}\n\n"
+
+def push_current_spread(channel, pdf_list):
+    """Publish the current spread, then its page images as they are rendered"""
+    reader_renders.cancel(channel.token)  # renders queued for the spread the reader left
+    superseded = pdf_list.superseded_check()
+    left_page, right_page = pdf_list.get_current_spread()
+    channel.publish('spread', {
+        'current_page_num': left_page.page_number if left_page else 1,
+        'left_page_number': left_page.page_number if left_page else None,
+        'right_page_number': right_page.page_number if right_page else None,
+        'total_pages': pdf_list.total_pages,
+        'annotations': spread_annotations(pdf_list, channel.user_id, channel.file_id,
+                                          [node.page_number for node in (left_page, right_page) if node])
+    })
+    
+    # Pages the reader is likely to open next are pushed too (see prefetch_plan)
+    shown = [node for node in (left_page, right_page) if node]
+    pdf_list.mark_viewed(node.page_number for node in shown if node.is_loaded)
+    wanted = shown + [pdf_list.get_page_node(page) for page in pdf_list.prefetch_plan()]
+    
+    for node in wanted:
+        prefetch = node not in shown
+        if node.is_loaded and node.page_data is not None:
+            pdf_list.touch_page(node.page_number)
+            channel.publish('page', {'page_number': node.page_number, 'prefetch': prefetch})
+        else:
+            reader_renders.submit(channel.user_id, channel.token, _render_for_channel, channel, pdf_list,
+                                  node.page_number, prefetch, superseded)
+
+def _render_for_channel(channel, pdf_list, page_number, prefetch, superseded):
+    """Render a page in the background and push it to the channel"""
+    try:
+        if channel.closed or superseded():
+            return
+        node = pdf_list.get_page_node(page_number)
+        image_data = node.page_data
+        if not node.is_loaded or image_data is None:
+            image_data = render_page_data_uri(channel.pdf_path, page_number, channel.file_id)
+            pdf_list.load_page_data(page_number, image_data)
+            if prefetch:
+                pdf_list.note_prefetched(page_number)
+            else:
+                pdf_list.mark_viewed([page_number])
+            pdf_sessions.enforce_memory_budget(channel.user_id)
+        channel.publish('page', {'page_number': page_number, 'prefetch': prefetch})
+    except Exception as e:
+        print(f"Error rendering page {page_number} for stream: {e}")
+        channel.publish('page_error', {'page_number': page_number, 'error': str(e)})
+
+def schedule_prefetch(pdf_list, file_id, user_id):
+    """Render the pages prefetch_plan() picks in the background (non-streaming readers)"""
+    if not pdf_list.stored_filename:
+        return
+    group = ('prefetch', user_id, file_id)
+    reader_renders.cancel(group)  # the plan for the previous spread
+    for page_number in pdf_list.prefetch_plan():
+        reader_renders.submit(user_id, group, _prefetch_page, pdf_list, file_id, user_id, page_number,
+                              pdf_list.superseded_check())
+
+def _prefetch_page(pdf_list, file_id, user_id, page_number, superseded):
+    try:
+        if superseded() or pdf_list.get_page_node(page_number).is_loaded:
+            return
+        pdf_path = blob_storage.local_path(pdf_list.stored_filename)
+        image_data = render_page_data_uri(pdf_path, page_number, file_id)
+        if image_data is not None and not pdf_list.get_page_node(page_number).is_loaded:
+            pdf_list.load_page_data(page_number, image_data)
+            pdf_list.note_prefetched(page_number)
+            pdf_sessions.enforce_memory_budget(user_id)
+    except Exception as e:
+        print(f"Error prefetching page {page_number}: {e}")
+
+@app.route('/api/book/<file_id>/stream')
+def stream_reader_events(file_id):
+    """Server-sent event stream for a reader session (token from /initialize)"""
+    channel = get_reader_channel(request.args.get('token'), file_id)
+    if channel is None:
+        return jsonify({'error': 'Stream not found. Please refresh the page.'}), 404
+    
+    last_id = request.headers.get('Last-Event-ID', type=int) or 0
+    
+    def generate():
+        nonlocal last_id
+        while not channel.closed:
+            events = channel.wait(last_id, READER_CHANNEL_HEARTBEAT)
+            if not events:
+                yield ': keepalive\n\n'
+                continue
+            for event_id, event, data in events:
+                last_id = event_id
+                yield channel.format_event(event_id, event, data)
+    
+    return Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+@app.route('/api/book/<file_id>/stream/intent', methods=['POST'])
+@rate_limited('navigate')
+def reader_intent(file_id):
+    """Apply a navigation intent (next/prev/goto/current) sent by a streaming reader"""
     try:
-        session_key = get_pdf_session_key(session['user_id'], file_id)
-        pdf_list = pdf_sessions.get(session_key)
+        data = request.get_json(silent=True) or {}
+        channel = get_reader_channel(data.get('token'), file_id)
+        if channel is None:
+            return jsonify({'error': 'Stream not found. Please refresh the page.'}), 404
         
+        pdf_list = pdf_sessions.get(get_pdf_session_key(channel.user_id, file_id))
         if not pdf_list:
             return jsonify({'error': 'PDF session not found. Please refresh the page.'}), 404
         
-        if not pdf_list.go_to_page(page_number):
-            return jsonify({'error': 'Invalid page number'}), 400
+        action = data.get('action')
+        if action == 'next':
+            success = pdf_list.next_spread()
+        elif action == 'prev':
+            success = pdf_list.prev_spread()
+        elif action == 'goto':
+            success = pdf_list.go_to_page(data.get('page'))
+        elif action == 'current':
+            success = True
+        else:
+            return jsonify({'error': f'Unknown action: {action}'}), 400
         
-        # Return current spread after navigation
-        return get_current_spread(file_id)
+        if not success:
+            return jsonify({'success': False, 'error': f'Cannot navigate {action}'}), 400
+        
+        if action != 'current':
+            pdf_list.record_navigation(action)
+            reading_progress.record_page(channel.user_id, file_id, pdf_list.current.page_number)
+            reading_events.record('flip' if action in ('next', 'prev') else 'goto', channel.user_id, file_id,
+                                  pdf_list.current.page_number, shown_pages(pdf_list))
+        
+        push_current_spread(channel, pdf_list)
+        return jsonify({'success': True})
         
     except Exception as e:
-        return jsonify({'error': f'Failed to go to page: {str(e)}'}), 500
+        return jsonify({'error': f'Failed to navigate: {str(e)}'}), 500
 
-def load_page_from_pdf(file_id, page_num):
-    """Helper function to load page data from PDF file"""
+def load_page_from_pdf(file_id, page_num, superseded=None):
+    """Helper function to load page data from PDF file.
+    
+    superseded (see PDFLinkedList.superseded_check) is asked again once a
+    render slot is free, a request that waited behind others may be stale.
+    """
     try:
-        import fitz
-        import base64
-        
         connection = get_db_connection()
         if connection is None:
             return None
@@ -1371,81 +4466,1202 @@ def load_page_from_pdf(file_id, page_num):
         
         # Get stored filename
         cursor.execute(
-            '''SELECT stored_filename FROM files 
+            '''SELECT stored_filename, status FROM files 
                WHERE file_id = %s AND user_id = %s''',
             (file_id, session['user_id'])
         )
         file_info = cursor.fetchone()
-        
-        if not file_info:
-            return None
-        
         cursor.close()
         connection.close()
         
+        if not file_info or file_info[1] in UNREADABLE_STATUSES:
+            return None
+        
         # Open PDF and get page
-        pdf_path = os.path.join(app.config['UPLOAD_FOLDER'], file_info[0])
-        if not os.path.exists(pdf_path):
+        pdf_path = blob_storage.local_path(file_info[0])
+        if not os.path.isfile(pdf_path):
             return None
         
+        user_render_slots.acquire(session['user_id'])
+        try:
+            if superseded and superseded():
+                raise RenderSupersededError()
+            return render_page_data_uri(pdf_path, page_num, file_id)
+        finally:
+            user_render_slots.release(session['user_id'])
+        
+    except (RenderBusyError, RenderSupersededError):
+        raise
+    except Exception as e:
+        print(f"Error loading page {page_num}: {e}")    
+        return None
+
+def render_page_data_uri(pdf_path, page_num, file_id=None):
+    """Render a page and return it as a base64 data URI (None for invalid pages)"""
+    import base64
+    
+    if file_id:
+        img_data, _ = render_cached_page(pdf_path, page_num, file_id)
+    else:
+        img_data, _ = render_pdf_page(pdf_path, page_num)
+    if img_data is None:
+        return None
+    return f"data:image/png;base64,{base64.b64encode(img_data).decode()}"
+
+# Page cache
+#
+# Rendered pages are kept on disk as page_cache/<file_id>/<zoom>x/<page>.png
+# next to a page_count file, so a page is rendered once per zoom level no
+# matter how many readers open it. `python main.py --prerender` fills it ahead
+# of time. A page's mtime doubles as its last use, and page_cache_budget
+# deletes the least recently used pages once the cache grows past
+# PAGE_CACHE_MAX_BYTES.
+
+def page_cache_dir(file_id):
+    return os.path.join(app.config['PAGE_CACHE_FOLDER'], secure_filename(file_id))
+
+def page_cache_path(file_id, page_num, zoom=RENDER_ZOOM):
+    return os.path.join(page_cache_dir(file_id), f"{zoom:g}x", f"{page_num}.png")
+
+def write_cache_file(path, data):
+    """Write a cache file atomically; failures only cost a later re-render"""
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"⚠️  Warning: Could not write cache file {path}: {e}")
+
+class PageCacheBudget:
+    """Keeps the page cache under max_bytes by pruning the least recently used pages"""
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.used = None  # bytes on disk, unknown until the first prune scans the cache
+        self.pruned = 0
+        self._lock = threading.Lock()
+        self._pruning = False
+    
+    def added(self, nbytes):
+        """Count a page written to the cache, pruning in the background when over budget"""
+        with self._lock:
+            if self.used is not None:
+                self.used += nbytes
+                if self.used <= self.max_bytes:
+                    return
+            if self._pruning:
+                return
+            self._pruning = True
+        threading.Thread(target=self.prune, name='page-cache-prune', daemon=True).start()
+    
+    def prune(self):
+        """Scan the cache and delete the oldest pages until it is under PAGE_CACHE_PRUNE_TO of the budget"""
+        try:
+            pages = []
+            for root, _, files in os.walk(app.config['PAGE_CACHE_FOLDER']):
+                for name in files:
+                    if not name.endswith('.png'):
+                        continue
+                    path = os.path.join(root, name)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue  # removed while scanning
+                    pages.append((stat.st_mtime, stat.st_size, path))
+            used = sum(size for _, size, _ in pages)
+            pruned = 0
+            if used > self.max_bytes:
+                pages.sort()
+                for _, size, path in pages:
+                    if used <= self.max_bytes * PAGE_CACHE_PRUNE_TO:
+                        break
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        continue
+                    used -= size
+                    pruned += 1
+                print(f"ℹ️  Pruned {pruned} pages from the page cache")
+            with self._lock:
+                self.used = used
+                self.pruned += pruned
+            return pruned
+        finally:
+            with self._lock:
+                self._pruning = False
+
+page_cache_budget = PageCacheBudget(PAGE_CACHE_MAX_BYTES)
+
+def read_cached_page_count(file_id):
+    try:
+        with open(os.path.join(page_cache_dir(file_id), 'page_count')) as f:
+            return int(f.read())
+    except (OSError, ValueError):
+        return None
+
+def render_cached_page(pdf_path, page_num, file_id, zoom=RENDER_ZOOM):
+    """Like render_pdf_page, but served from (and stored into) the page cache"""
+    total_pages = read_cached_page_count(file_id)
+    path = page_cache_path(file_id, page_num, zoom)
+    if total_pages is not None:
+        if page_num < 1 or page_num > total_pages:
+            return None, total_pages
+        try:
+            with open(path, 'rb') as f:
+                if time.time() - os.fstat(f.fileno()).st_mtime > PAGE_CACHE_TOUCH_INTERVAL:
+                    os.utime(f.fileno())  # mark it recently used for page_cache_budget
+                return f.read(), total_pages
+        except OSError:
+            pass
+    
+    img_data, total_pages = run_render_job('render', file_id, pdf_path, page_num, zoom, file_id)
+    if img_data is not None:
+        write_cache_file(path, img_data)
+        page_cache_budget.added(len(img_data))
+    if read_cached_page_count(file_id) is None:
+        write_cache_file(os.path.join(page_cache_dir(file_id), 'page_count'), str(total_pages).encode())
+    return img_data, total_pages
+
+# Render budget
+#
+# Output size is known before rendering (page rect x zoom), so oversized
+# pages (posters, CAD exports) get a lower zoom instead of a huge pixmap.
+# Pages whose pixmap is still big are rendered in horizontal bands and
+# streamed into the PNG encoder, and render_memory caps the pixmap bytes all
+# renders in this process hold at once.
+
+class RenderBusyError(Exception):
+    """Raised when a render waited too long for memory under RENDER_MEMORY_CEILING"""
+
+class RenderSupersededError(Exception):
+    """Raised when the reader navigated elsewhere before a render could start"""
+
+class UserRenderSlots:
+    """Caps the renders one user runs at once in request threads, so a burst of
+    page requests from one reader cannot occupy every render worker"""
+    def __init__(self, per_user, wait):
+        self.per_user = per_user
+        self.wait = wait
+        self._active = {}  # user_id -> renders running
+        self._condition = threading.Condition()
+    
+    def acquire(self, user_id):
+        deadline = time.monotonic() + self.wait
+        with self._condition:
+            while self._active.get(user_id, 0) >= self.per_user:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise RenderBusyError('Too many renders in progress for this account')
+                self._condition.wait(remaining)
+            self._active[user_id] = self._active.get(user_id, 0) + 1
+    
+    def release(self, user_id):
+        with self._condition:
+            self._active[user_id] -= 1
+            if not self._active[user_id]:
+                del self._active[user_id]
+            self._condition.notify_all()
+
+user_render_slots = UserRenderSlots(RENDER_SLOTS_PER_USER, RENDER_SLOT_WAIT)
+
+class RenderMemoryGovernor:
+    """Counts the pixmap bytes of renders running in this process"""
+    def __init__(self, ceiling):
+        self.ceiling = ceiling
+        self.in_use = 0
+        self._condition = threading.Condition()
+    
+    def acquire(self, nbytes, timeout):
+        """Reserve nbytes (at most the whole ceiling), returns the amount reserved"""
+        nbytes = min(nbytes, self.ceiling)
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while self.in_use and self.in_use + nbytes > self.ceiling:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise RenderBusyError('Too many large renders in progress')
+                self._condition.wait(remaining)
+            self.in_use += nbytes
+        return nbytes
+    
+    def release(self, nbytes):
+        with self._condition:
+            self.in_use -= nbytes
+            self._condition.notify_all()
+
+render_memory = RenderMemoryGovernor(RENDER_MEMORY_CEILING)
+
+def clamp_render_zoom(page_rect, zoom):
+    """Largest zoom up to `zoom` whose RGB pixmap fits RENDER_MAX_PIXELS and RENDER_MAX_BYTES"""
+    area = max(page_rect.width * page_rect.height, 1)
+    max_pixels = min(RENDER_MAX_PIXELS, RENDER_MAX_BYTES // 3)
+    if area * zoom * zoom > max_pixels:
+        zoom = math.sqrt(max_pixels / area)
+    return zoom
+
+def _png_chunk(tag, data):
+    return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff)
+
+def render_png_in_bands(page, matrix, band_rows):
+    """Render a page to PNG band by band, so only one band's pixmap is in memory"""
+    import fitz
+    
+    full = (page.rect * matrix).irect
+    width, height = full.width, full.height
+    inverse = ~matrix
+    display_list = page.get_displaylist()  # the page is interpreted once for all bands
+    compressor = zlib.compressobj(6)
+    idat = []
+    blank_row = b'\x00' + b'\xff' * (width * 3)
+    next_row = full.y0
+    for band_top in range(full.y0, full.y1, band_rows):
+        clip = fitz.Rect(full.x0, band_top, full.x1, min(band_top + band_rows, full.y1)) * inverse
+        pix = display_list.get_pixmap(matrix=matrix, colorspace=fitz.csRGB, alpha=False, clip=clip)
+        samples = pix.samples
+        row_bytes = min(pix.width, width) * 3
+        for row in range(pix.height):
+            y = pix.y + row
+            if y < next_row or y >= full.y1:
+                continue  # bands may overlap by a row after rounding
+            while next_row < y:
+                idat.append(compressor.compress(blank_row))
+                next_row += 1
+            start = row * pix.stride
+            line = samples[start:start + row_bytes].ljust(width * 3, b'\xff')
+            idat.append(compressor.compress(b'\x00' + line))
+            next_row = y + 1
+        del pix, samples
+    while next_row < full.y1:
+        idat.append(compressor.compress(blank_row))
+        next_row += 1
+    idat.append(compressor.flush())
+    
+    header = struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)  # 8-bit RGB
+    return (b'\x89PNG\r\n\x1a\n' + _png_chunk(b'IHDR', header)
+            + _png_chunk(b'IDAT', b''.join(idat)) + _png_chunk(b'IEND', b''))
+
+def render_pdf_page(pdf_path, page_num, zoom=RENDER_ZOOM, file_id=None):
+    """Render a single PDF page to PNG bytes, returns (png_bytes, total_pages)
+    
+    png_bytes is None when page_num is out of range. The zoom is clamped and
+    large pages are rendered in bands to stay within the render budget. With render profiling
+    enabled the render (including opening the document) is timed and recorded in
+    render_profiler.
+    """
+    return _render_pdf_page(pdf_path, page_num, zoom, file_id)[:2]
+
+def profile_pdf_page(pdf_path, page_num, zoom, file_id, profile_path):
+    """render_pdf_page plus a cProfile dump written to profile_path, returns (png_bytes, total_pages, record)
+    
+    record holds the render's timing and memory figures (None for an out of
+    range page). Runs as the 'profile' job, so it is sandboxed like any render.
+    """
+    return _render_pdf_page(pdf_path, page_num, zoom, file_id, profile_path)
+
+def _render_pdf_page(pdf_path, page_num, zoom, file_id, profile_path=None):
+    """Shared body of render_pdf_page and profile_pdf_page, returns (png_bytes, total_pages, record)
+    
+    Peak memory is only measured inside a render worker, which runs one job at a
+    time; tracemalloc is process-wide, so in the server process the pixmap
+    reservation is recorded instead and peak_memory_measured is False.
+    """
+    import fitz
+    
+    profiling = app.config['RENDER_PROFILING_ENABLED']
+    measure_memory = profiling and _in_render_worker and not tracemalloc.is_tracing()
+    if measure_memory:
+        tracemalloc.start()
+    started = time.perf_counter()
+    
+    try:
         pdf_doc = fitz.open(pdf_path)
+    except Exception:
+        if measure_memory:
+            tracemalloc.stop()
+        raise
+    try:
+        total_pages = pdf_doc.page_count
         
         # Validate page number
-        if page_num < 1 or page_num > pdf_doc.page_count:
-            pdf_doc.close()
-            return None
-        
-        # Get page (0-indexed)
-        page = pdf_doc.load_page(page_num - 1)
+        if page_num < 1 or page_num > total_pages:
+            return None, total_pages, None
         
-        # Render page to image (higher quality)
-        mat = fitz.Matrix(2.0, 2.0)  # 2x zoom for better quality
-        pix = page.get_pixmap(matrix=mat)
-        img_data = pix.tobytes("png")
+        profiler = cProfile.Profile() if profile_path else None
+        if profiler:
+            profiler.enable()
         
-        # Convert to base64
-        img_base64 = f"data:image/png;base64,{base64.b64encode(img_data).decode()}"
+        # Get page (0-indexed) and size the output before rendering anything
+        page = pdf_doc.load_page(page_num - 1)
+        effective_zoom = clamp_render_zoom(page.rect, zoom)
+        matrix = fitz.Matrix(effective_zoom, effective_zoom)
+        size = (page.rect * matrix).irect
+        pixmap_bytes = size.width * size.height * 3
+        band_rows = max(1, RENDER_BAND_BYTES // max(size.width * 3, 1))
+        banded = pixmap_bytes > RENDER_BAND_BYTES
+        
+        reserved = render_memory.acquire(band_rows * size.width * 3 if banded else pixmap_bytes,
+                                         RENDER_MEMORY_WAIT)
+        try:
+            if banded:
+                img_data = render_png_in_bands(page, matrix, band_rows)
+            else:
+                pix = page.get_pixmap(matrix=matrix)
+                img_data = pix.tobytes("png")
+                del pix
+        finally:
+            render_memory.release(reserved)
+        
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(profile_path)
+        record = None
+        if profiling:
+            render_ms = (time.perf_counter() - started) * 1000
+            # Pixmap samples live in MuPDF memory, tracemalloc only sees the Python side
+            traced_peak = tracemalloc.get_traced_memory()[1] if measure_memory else 0
+            record = {
+                'file_id': file_id or os.path.basename(pdf_path),
+                'page_num': page_num,
+                'render_ms': round(render_ms, 2),
+                'width': size.width,
+                'height': size.height,
+                'encoded_bytes': len(img_data),
+                'peak_memory_bytes': reserved + traced_peak,
+                'peak_memory_measured': measure_memory
+            }
+            render_profiler.record(record)
         
+        return img_data, total_pages, record
+    finally:
         pdf_doc.close()
+        if measure_memory:
+            tracemalloc.stop()
+
+# Render sandbox
+#
+# Malformed or hostile PDFs can make MuPDF hang or allocate without bound, so
+# reader renders (and the page count/outline read at initialize) run in a
+# small pool of worker processes. Each worker limits its own address space
+# (RLIMIT_AS); a worker that overruns RENDER_TIMEOUT is killed, and one that
+# dies or runs out of memory is replaced. Every failure is counted against
+# the document, which is quarantined after QUARANTINE_AFTER_FAILURES.
+# Workers render one job at a time, so render_memory is enforced here in the
+# server process: each job reserves its worst-case pixmap bytes before it is
+# dispatched (RENDER_JOB_MEMORY).
+
+# Worst-case pixmap bytes a job holds: renders never exceed one band (see
+# render_pdf_page), thumbnail sheets are bounded by RENDER_MAX_BYTES
+RENDER_JOB_MEMORY = {'render': RENDER_BAND_BYTES, 'profile': RENDER_BAND_BYTES, 'thumbnails': RENDER_MAX_BYTES}
+
+def process_cpu_seconds(pid):
+    """CPU time a process has used (from /proc), None where that is unavailable"""
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError):
+        return None
+
+class RenderFailedError(Exception):
+    """A sandboxed render timed out, crashed or raised"""
+    def __init__(self, message, reason):
+        super().__init__(message)
+        self.reason = reason  # 'timeout', 'crash', 'memory' or 'error'
+
+class RenderRecordCollector:
+    """Stands in for render_profiler inside render workers, records go back to the parent"""
+    def __init__(self):
+        self.records = []
+    
+    def record(self, record):
+        self.records.append(record)
+    
+    def drain(self):
+        records, self.records = self.records, []
+        return records
+
+def document_info(pdf_path):
+    """Page count and outline target pages of a PDF"""
+    import fitz
+    
+    pdf_doc = fitz.open(pdf_path)
+    try:
+        total_pages = pdf_doc.page_count
+        toc_pages = sorted({entry[2] for entry in pdf_doc.get_toc(simple=True) if 1 <= entry[2] <= total_pages})
+    finally:
+        pdf_doc.close()
+    return total_pages, toc_pages
+
+def validate_pdf(pdf_path, repaired_path):
+    """Check a PDF before it is offered to readers, saving MuPDF's repair to repaired_path if
+    it needed one. Returns (status, detail, page_count, repaired)."""
+    import fitz
+    
+    with open(pdf_path, 'rb') as pdf_file:
+        if b'%PDF-' not in pdf_file.read(PDF_HEADER_SEARCH_BYTES):
+            return 'invalid', 'Not a PDF file (no %PDF- header)', None, False
+    try:
+        pdf_doc = fitz.open(pdf_path, filetype='pdf')
+    except Exception as e:
+        return 'invalid', f'Could not open PDF: {e}', None, False
+    try:
+        if pdf_doc.needs_pass:
+            return 'encrypted', 'PDF is password protected', None, False
+        if pdf_doc.page_count == 0:
+            return 'invalid', 'PDF has no pages', 0, False
+        for page in pdf_doc:
+            page.bound()  # a broken page tree or page object fails here, not at read time
+        repaired = pdf_doc.is_repaired
+        if repaired:
+            pdf_doc.save(repaired_path, garbage=3, deflate=True)
+        return 'ok', 'Repaired on upload' if repaired else None, pdf_doc.page_count, repaired
+    except Exception as e:
+        return 'invalid', f'Damaged PDF: {e}', None, False
+    finally:
+        pdf_doc.close()
+
+# Jobs a render worker runs, by kind
+RENDER_JOBS = {'render': render_pdf_page, 'profile': profile_pdf_page, 'info': document_info,
+               'validate': validate_pdf, 'thumbnails': build_thumbnail_sheet}
+
+# True inside render workers, which run one job at a time
+_in_render_worker = False
+
+def _render_worker_main(conn, memory_limit):
+    """Render worker loop: apply the memory limit, then answer jobs until the pipe closes"""
+    global render_profiler, _in_render_worker
+    if memory_limit:
+        import resource
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+    render_profiler = RenderRecordCollector()
+    _in_render_worker = True
+    
+    while True:
+        try:
+            job = conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            return
+        kind, args, profiling = job
+        app.config['RENDER_PROFILING_ENABLED'] = profiling
+        try:
+            result = RENDER_JOBS[kind](*args)
+            conn.send(('ok', result, render_profiler.drain()))
+        except MemoryError:
+            conn.send(('memory', 'Render exceeded the worker memory limit', []))
+            return  # the heap may be unusable, let the parent start a new worker
+        except RenderBusyError as e:
+            conn.send(('busy', str(e), []))
+        except Exception as e:
+            conn.send(('error', str(e), []))
+
+class RenderWorker:
+    """Handle on one render worker process"""
+    def __init__(self, context, memory_limit):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_render_worker_main, args=(child_conn, memory_limit),
+                                       name='render-worker', daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.jobs = 0
+    
+    def kill(self):
+        self.process.kill()
+        self.process.join(1)
+        self.conn.close()
+
+class RenderSandbox:
+    """Pool of render worker processes with wall-clock and memory limits"""
+    def __init__(self, workers, timeout, memory_limit, max_jobs):
+        self.workers = workers
+        self.timeout = timeout
+        self.memory_limit = memory_limit
+        self.max_jobs = max_jobs
+        self.restarts = 0
+        self._idle = queue.Queue()
+        self._missing = 0  # workers that could not be started, retried by the next job
+        self._context = None
+        self._lock = threading.Lock()
+    
+    def _start(self):
+        """Create the pool on first use, and bring it back to full size after failed restarts"""
+        with self._lock:
+            if self._context is None:
+                methods = multiprocessing.get_all_start_methods()
+                # Never fork the threaded server itself
+                self._context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+                self._missing = self.workers
+            while self._missing:
+                try:
+                    self._idle.put(RenderWorker(self._context, self.memory_limit))
+                except Exception as e:
+                    print(f"❌ Could not start a render worker: {e}")
+                    return
+                self._missing -= 1
+    
+    def run(self, kind, *args, timeout=None):
+        """Run a job from RENDER_JOBS in a worker, killing it after timeout (default self.timeout) seconds"""
+        reserved = render_memory.acquire(RENDER_JOB_MEMORY.get(kind, 0), RENDER_MEMORY_WAIT)
+        try:
+            return self._run(kind, args, timeout or self.timeout)
+        finally:
+            render_memory.release(reserved)
+    
+    def _run(self, kind, args, timeout):
+        self._start()
+        try:
+            worker = self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise RenderBusyError('All render workers are busy')
         
-        return img_base64
-        
+        replace = True
+        try:
+            cpu_before = process_cpu_seconds(worker.process.pid)
+            try:
+                worker.conn.send((kind, args, app.config['RENDER_PROFILING_ENABLED']))
+            except OSError:
+                raise RenderBusyError('Render worker unavailable')
+            if not worker.conn.poll(timeout):
+                cpu_after = process_cpu_seconds(worker.process.pid)
+                if None not in (cpu_before, cpu_after) and \
+                        cpu_after - cpu_before < timeout * RENDER_OVERLOAD_CPU_SHARE:
+                    raise RenderBusyError(f'Render took longer than {timeout}s on a busy server')
+                raise RenderFailedError(f'Render took longer than {timeout}s', 'timeout')
+            try:
+                status, result, records = worker.conn.recv()
+            except (EOFError, OSError):
+                raise RenderFailedError('Render worker died (memory limit or crash)', 'crash')
+            
+            for record in records:
+                render_profiler.record(record)
+            worker.jobs += 1
+            replace = status == 'memory' or worker.jobs >= self.max_jobs
+            if status == 'busy':
+                raise RenderBusyError(result)
+            if status != 'ok':
+                raise RenderFailedError(result, status)
+            return result
+        finally:
+            if replace:
+                worker.kill()
+                self.restarts += 1
+                with self._lock:
+                    self._missing += 1
+                self._start()
+            else:
+                self._idle.put(worker)
+    
+    def shutdown(self):
+        while True:
+            try:
+                self._idle.get_nowait().kill()
+            except queue.Empty:
+                return
+
+render_sandbox = RenderSandbox(RENDER_SANDBOX_WORKERS, RENDER_TIMEOUT, RENDER_WORKER_MEMORY_LIMIT,
+                               RENDER_WORKER_MAX_JOBS)
+atexit.register(render_sandbox.shutdown)
+
+# Documents quarantined in this process (the files.status column is authoritative)
+quarantined_files = set()
+
+def record_render_failure(file_id, error):
+    """Count a failed render against a document and quarantine it after repeated failures"""
+    print(f"⚠️  Render failed for {file_id} ({error.reason}): {error}")
+    connection = get_db_connection()
+    if connection is None:
+        return
+    try:
+        cursor = connection.cursor()
+        # MySQL applies SET assignments left to right, status sees the new count
+        cursor.execute(
+            '''UPDATE files SET render_failures = render_failures + 1,
+               status = IF(render_failures >= %s, 'quarantined', status) WHERE file_id = %s''',
+            (QUARANTINE_AFTER_FAILURES, file_id)
+        )
+        cursor.execute('SELECT status FROM files WHERE file_id = %s', (file_id,))
+        row = cursor.fetchone()
+        connection.commit()
+        cursor.close()
+        if row and row[0] == 'quarantined' and file_id not in quarantined_files:
+            quarantined_files.add(file_id)
+            print(f"⚠️  Quarantined {file_id} after {QUARANTINE_AFTER_FAILURES} failed renders")
+    except Error as e:
+        print(f"⚠️  Warning: Could not record render failure: {e}")
+    finally:
+        connection.close()
+
+def run_render_job(kind, file_id, *args, timeout=None):
+    """Run a render job in the sandbox when enabled, counting failures against file_id"""
+    if file_id in quarantined_files:
+        raise RenderFailedError('This file failed to render repeatedly and has been quarantined', 'quarantined')
+    if not app.config['RENDER_SANDBOX_ENABLED']:
+        return RENDER_JOBS[kind](*args)
+    try:
+        return render_sandbox.run(kind, *args, timeout=timeout)
+    except RenderFailedError as e:
+        if file_id:
+            record_render_failure(file_id, e)
+        raise
+
+def quarantined_response(status='quarantined'):
+    if status == 'encrypted':
+        return jsonify({'error': 'This PDF is password protected and cannot be opened', 'status': status}), 422
+    if status == 'invalid':
+        return jsonify({'error': 'This file is not a readable PDF', 'status': status}), 422
+    return jsonify({'error': 'This file could not be rendered and has been quarantined', 'status': status}), 422
+
+@app.route('/admin/files/<file_id>/release', methods=['POST'])
+@admin_required
+def release_quarantined_file(file_id):
+    """Take a document out of quarantine (e.g. after replacing the file)"""
+    try:
+        connection = get_db_connection()
+        if connection is None:
+            return jsonify({'error': 'Database connection failed'}), 500
+        cursor = connection.cursor()
+        cursor.execute(
+            "UPDATE files SET status = 'ok', render_failures = 0 WHERE file_id = %s", (file_id,)
+        )
+        released = cursor.rowcount > 0
+        connection.commit()
+        cursor.close()
+        connection.close()
+        quarantined_files.discard(file_id)
+        if not released:
+            return jsonify({'error': 'File not found'}), 404
+        return jsonify({'success': True, 'file_id': file_id})
+    except Error as e:
+        return jsonify({'error': f'Database error: {str(e)}'}), 500
+
+# Offline pre-rendering (python main.py --prerender)
+
+def _lower_worker_priority(niceness):
+    """Process pool initializer: run renders at a lower CPU priority"""
+    if niceness and hasattr(os, 'nice'):
+        os.nice(niceness)
+
+def _wait_for_load(max_load):
+    """Sleep while the 1-minute load average is above max_load"""
+    while max_load and hasattr(os, 'getloadavg') and os.getloadavg()[0] > max_load:
+        time.sleep(1)
+
+def prerender_document(file_id, pdf_path, zoom=RENDER_ZOOM, pause=0.0, max_load=None, thumbnails=True,
+                       max_pages=PRERENDER_MAX_PAGES):
+    """Render the uncached pages (and thumbnail sheet) of one document, returns (rendered, cached, total)
+    
+    Only the first max_pages pages are warmed (all of them when None); readers
+    render the rest on demand.
+    """
+    if not os.path.isfile(pdf_path):
+        raise FileNotFoundError(f"PDF file not found: {pdf_path}")
+    total_pages = read_cached_page_count(file_id)
+    if total_pages is None:
+        total_pages, _ = run_render_job('info', file_id, pdf_path)
+    
+    rendered = cached = 0
+    last_page = min(total_pages, max_pages) if max_pages else total_pages
+    for page_num in range(1, last_page + 1):
+        if os.path.exists(page_cache_path(file_id, page_num, zoom)):
+            cached += 1
+            continue
+        _wait_for_load(max_load)
+        render_cached_page(pdf_path, page_num, file_id, zoom)
+        rendered += 1
+        if pause:
+            time.sleep(pause)
+    
+    index_path = thumbnail_paths(file_id)[0]
+    if thumbnails and not os.path.exists(index_path):
+        os.makedirs(app.config['THUMBNAIL_FOLDER'], exist_ok=True)
+        run_render_job('thumbnails', file_id, pdf_path, index_path, timeout=THUMBNAIL_TIMEOUT)
+    return rendered, cached, total_pages
+
+def prerender_library(since_days=None, workers=None, zoom=RENDER_ZOOM, pause=0.0, max_load=None,
+                      niceness=10, thumbnails=True, max_pages=PRERENDER_MAX_PAGES):
+    """Warm the page and thumbnail caches for every stored book (or those read in the last since_days)
+    
+    Documents are rendered in parallel worker processes, the first max_pages
+    pages of each. Pages already in the cache are skipped, so an interrupted
+    run continues where it stopped. The page cache is pruned back under its
+    budget at the end.
+    """
+    connection = get_db_connection()
+    if connection is None:
+        print("❌ Database connection failed")
+        return False
+    try:
+        cursor = connection.cursor()
+        unreadable = sorted(UNREADABLE_STATUSES)
+        readable = f"status NOT IN ({', '.join(['%s'] * len(unreadable))})"
+        if since_days is not None:
+            cursor.execute(
+                f'''SELECT file_id, stored_filename FROM files
+                   WHERE {readable} AND last_read >= DATE_SUB(CURDATE(), INTERVAL %s DAY)
+                   ORDER BY last_read DESC, id''',
+                (*unreadable, since_days)
+            )
+        else:
+            cursor.execute(f'SELECT file_id, stored_filename FROM files WHERE {readable} ORDER BY last_read DESC, id',
+                           unreadable)
+        documents = cursor.fetchall()
+        cursor.close()
+    except Error as e:
+        print(f"❌ Could not list files: {e}")
+        return False
+    finally:
+        connection.close()
+    
+    workers = workers or os.cpu_count() or 1
+    print(f"🔄 Pre-rendering {len(documents)} documents with {workers} workers...")
+    started = time.perf_counter()
+    rendered_total = failed = 0
+    with ProcessPoolExecutor(max_workers=workers, initializer=_lower_worker_priority,
+                             initargs=(niceness,)) as executor:
+        futures = {
+            executor.submit(prerender_document, file_id, blob_storage.local_path(stored_filename),
+                            zoom, pause, max_load, thumbnails, max_pages): file_id
+            for file_id, stored_filename in documents
+        }
+        for done, future in enumerate(as_completed(futures), 1):
+            file_id = futures[future]
+            try:
+                rendered, cached, total_pages = future.result()
+                rendered_total += rendered
+                print(f"🔄 [{done}/{len(futures)}] {file_id}: {rendered} rendered, "
+                      f"{cached} already cached ({total_pages} pages)")
+            except Exception as e:
+                failed += 1
+                print(f"⚠️  [{done}/{len(futures)}] {file_id}: {e}")
+    
+    page_cache_budget.prune()
+    elapsed = time.perf_counter() - started
+    print(f"✅ Pre-rendered {rendered_total} pages in {elapsed:.1f}s, {failed} documents failed")
+    return failed == 0
+
+class RenderProfiler:
+    """Keeps the slowest N page renders, persisted in the render_profiles table"""
+    def __init__(self, top_n=None):
+        self._top_n = top_n  # None: app.config['RENDER_PROFILE_TOP_N']
+        self.records = {}  # (file_id, page_num) -> slowest render seen
+        self._lock = threading.Lock()
+        self._loaded = False
+    
+    @property
+    def top_n(self):
+        return self._top_n or app.config['RENDER_PROFILE_TOP_N']
+    
+    def _load(self):
+        """Load persisted records the first time the profiler is used"""
+        if self._loaded:
+            return
+        self._loaded = True
+        connection = get_db_connection()
+        if connection is None:
+            return
+        try:
+            cursor = connection.cursor()
+            cursor.execute(
+                '''SELECT file_id, page_num, render_ms, width, height, encoded_bytes, peak_memory_bytes,
+                   peak_memory_measured FROM render_profiles ORDER BY render_ms DESC LIMIT %s''',
+                (self.top_n,)
+            )
+            for row in cursor.fetchall():
+                self.records[(row[0], row[1])] = {
+                    'file_id': row[0], 'page_num': row[1], 'render_ms': row[2], 'width': row[3],
+                    'height': row[4], 'encoded_bytes': row[5], 'peak_memory_bytes': row[6],
+                    'peak_memory_measured': bool(row[7])
+                }
+            cursor.close()
+        except Error as e:
+            print(f"⚠️  Warning: Could not load render profiles: {e}")
+        finally:
+            connection.close()
+    
+    def record(self, record):
+        """Keep the render if it is among the slowest N"""
+        key = (record['file_id'], record['page_num'])
+        evicted = None
+        with self._lock:
+            self._load()
+            existing = self.records.get(key)
+            if existing and existing['render_ms'] >= record['render_ms']:
+                return False
+            if not existing and len(self.records) >= self.top_n:
+                fastest = min(self.records, key=lambda k: self.records[k]['render_ms'])
+                if self.records[fastest]['render_ms'] >= record['render_ms']:
+                    return False
+                evicted = self.records.pop(fastest)
+            self.records[key] = record
+        self._persist(record, evicted)
+        return True
+    
+    def _persist(self, record, evicted):
+        """Write a new slow render and drop the one it replaced"""
+        connection = get_db_connection()
+        if connection is None:
+            return
+        try:
+            cursor = connection.cursor()
+            cursor.execute(
+                '''INSERT INTO render_profiles (file_id, page_num, render_ms, width, height,
+                   encoded_bytes, peak_memory_bytes, peak_memory_measured)
+                   VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+                   ON DUPLICATE KEY UPDATE render_ms = VALUES(render_ms), width = VALUES(width),
+                   height = VALUES(height), encoded_bytes = VALUES(encoded_bytes),
+                   peak_memory_bytes = VALUES(peak_memory_bytes),
+                   peak_memory_measured = VALUES(peak_memory_measured), recorded_at = CURRENT_TIMESTAMP''',
+                (record['file_id'], record['page_num'], record['render_ms'], record['width'],
+                 record['height'], record['encoded_bytes'], record['peak_memory_bytes'],
+                 record['peak_memory_measured'])
+            )
+            if evicted:
+                cursor.execute(
+                    'DELETE FROM render_profiles WHERE file_id = %s AND page_num = %s',
+                    (evicted['file_id'], evicted['page_num'])
+                )
+            connection.commit()
+            cursor.close()
+        except Error as e:
+            print(f"⚠️  Warning: Could not save render profile: {e}")
+        finally:
+            connection.close()
+    
+    def slowest(self, limit=None):
+        """Slowest renders first"""
+        with self._lock:
+            self._load()
+            records = sorted(self.records.values(), key=lambda r: r['render_ms'], reverse=True)
+        return records[:limit] if limit else records
+
+render_profiler = RenderProfiler()
+
+@app.route('/admin/render-profiles')
+@admin_required
+def list_render_profiles():
+    """Show the slowest page renders recorded by the render profiler"""
+    try:
+        limit = request.args.get('limit', type=int)
+        return jsonify({
+            'success': True,
+            'enabled': app.config['RENDER_PROFILING_ENABLED'],
+            'profiles': render_profiler.slowest(limit)
+        })
     except Exception as e:
-        print(f"Error loading page {page_num}: {e}")    
-        return None
+        return jsonify({'error': f'Failed to list render profiles: {str(e)}'}), 500
+
+@app.route('/admin/render-profiles/dumps/<path:filename>')
+@admin_required
+def download_render_profile(filename):
+    """Download a cProfile dump (open with snakeviz, or flameprof for a flamegraph)"""
+    return send_from_directory(os.path.abspath(app.config['PROFILE_FOLDER']), filename, as_attachment=True)
     
 # Cleanup function to remove old PDF sessions
-@app.route('/api/book/<file_id>/cleanup')
+@app.route('/api/book/<file_id>/cleanup', methods=['GET', 'POST'])
 @login_required
 def cleanup_pdf_session(file_id):
-    """Clean up PDF session when user leaves"""
+    """Clean up PDF session when user leaves.
+    
+    With a stream token only that tab's channel is closed and the session (its
+    position and rendered pages) stays warm for other tabs or a reload; the
+    per-user quota and memory budget bound what is kept. Without one, the whole
+    session is dropped.
+    """
     try:
-        session_key = get_pdf_session_key(session['user_id'], file_id)
-        if session_key in pdf_sessions:
-            del pdf_sessions[session_key]
+        token = request.args.get('token') or (request.get_json(silent=True) or {}).get('token')
+        reading_events.record('close', session['user_id'], file_id)
+        if token:
+            close_reader_channel(token, file_id)
+            return jsonify({'success': True, 'message': 'Stream closed'})
+        
+        close_reader_session(session['user_id'], file_id)
         
         return jsonify({'success': True, 'message': 'Session cleaned up'})
         
     except Exception as e:
         return jsonify({'error': f'Cleanup failed: {str(e)}'}), 500
+
+@app.route('/admin/prefetch-stats')
+@admin_required
+def get_prefetch_stats():
+    """Prefetch hit and waste rates across all readers, for tuning the policy"""
+    return jsonify({
+        'success': True,
+        'totals': prefetch_totals.report(),
+        'access_patterns': pdf_sessions.pattern_counts(),
+        'max_pages': PREFETCH_MAX_PAGES,
+        'toc_targets': PREFETCH_TOC_TARGETS,
+        'render_queue': {'pending': reader_renders.pending(), 'cancelled': reader_renders.cancelled}
+    })
+
+@app.route('/api/reader/sessions')
+@login_required
+def list_reader_sessions():
+    """Books the current user has open, with their cached page usage"""
+    sessions = pdf_sessions.user_sessions(session['user_id'])
+    return jsonify({
+        'success': True,
+        'sessions': sessions,
+        'loaded_bytes': sum(s['loaded_bytes'] for s in sessions),
+        'memory_budget': app.config['READER_MEMORY_BUDGET_PER_USER'],
+        'max_sessions': app.config['MAX_READER_SESSIONS_PER_USER']
+    })
+    
+# Async (ASGI) serving mode
+#
+# ReaderASGIApp runs the Flask views in a thread pool and streams their
+# response bodies from the event loop, so a slow client downloading a big
+# base64 page only costs a coroutine instead of a whole worker thread.
+# Serve it with any ASGI server, e.g.  uvicorn main:asgi_app  (or main.py --asgi)
+ASGI_RENDER_WORKERS = 8  # threads running views (renders, DB queries)
+ASGI_SEND_CHUNK_SIZE = 64 * 1024
+ASGI_SPOOL_MAX_SIZE = 1024 * 1024  # request bodies above this spill to disk
+READER_STREAM_PATH = re.compile(r'^/api/book/([^/]+)/stream$')
+
+class ReaderASGIApp:
+    """ASGI wrapper around the Flask app that keeps I/O off the worker threads"""
+    def __init__(self, wsgi_app, max_workers=ASGI_RENDER_WORKERS):
+        self.wsgi_app = wsgi_app
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='asgi-view')
+    
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self._http(scope, receive, send)
+    
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await asyncio.get_running_loop().run_in_executor(self.executor, startup)
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                reading_progress.flush()
+                self.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+    
+    async def _http(self, scope, receive, send):
+        loop = asyncio.get_running_loop()
+        
+        # Reader event streams are served natively so idle readers hold no thread
+        match = READER_STREAM_PATH.match(scope['path'])
+        if match and scope['method'] == 'GET':
+            await self._stream(scope, receive, send, match.group(1))
+            return
+        
+        # Read the request body without blocking a thread
+        body = tempfile.SpooledTemporaryFile(max_size=ASGI_SPOOL_MAX_SIZE)
+        more_body = True
+        while more_body:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                body.close()
+                return
+            body.write(message.get('body', b''))
+            more_body = message.get('more_body', False)
+        body_size = body.tell()
+        body.seek(0)
+        
+        environ = self._build_environ(scope, body, body_size)
+        response = {}
+        
+        def start_response(status, headers, exc_info=None):
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = [
+                (name.lower().encode('latin1'), value.encode('latin1')) for name, value in headers
+            ]
+        
+        # Run the view (DB lookups, renders) in the pool
+        result = await loop.run_in_executor(self.executor, self.wsgi_app, environ, start_response)
+        iterator = iter(result)
+        done = object()
+        try:
+            # Most views return a single buffered chunk; generators are pulled one chunk at a time
+            chunk = await loop.run_in_executor(self.executor, next, iterator, done)
+            await send({
+                'type': 'http.response.start',
+                'status': response['status'],
+                'headers': response['headers']
+            })
+            while chunk is not done:
+                for offset in range(0, len(chunk), ASGI_SEND_CHUNK_SIZE):
+                    await send({
+                        'type': 'http.response.body',
+                        'body': chunk[offset:offset + ASGI_SEND_CHUNK_SIZE],
+                        'more_body': True
+                    })
+                chunk = await loop.run_in_executor(self.executor, next, iterator, done)
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+        finally:
+            if hasattr(result, 'close'):
+                await loop.run_in_executor(self.executor, result.close)
+            body.close()
+    
+    async def _stream(self, scope, receive, send, file_id):
+        """Serve a reader event stream on the event loop"""
+        query = parse_qs(scope.get('query_string', b'').decode('latin1'))
+        channel = get_reader_channel(query.get('token', [None])[0], file_id)
+        if channel is None:
+            body = json.dumps({'error': 'Stream not found. Please refresh the page.'}).encode()
+            await send({
+                'type': 'http.response.start',
+                'status': 404,
+                'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())]
+            })
+            await send({'type': 'http.response.body', 'body': body})
+            return
+        
+        last_id = 0
+        for name, value in scope.get('headers', []):
+            if name == b'last-event-id' and value.isdigit():
+                last_id = int(value)
+        
+        loop = asyncio.get_running_loop()
+        wakeup = asyncio.Event()
+        
+        def notify():
+            try:
+                loop.call_soon_threadsafe(wakeup.set)
+            except RuntimeError:
+                pass  # event loop already closed
+        
+        channel.add_waiter(notify)
+        disconnected = asyncio.ensure_future(self._wait_for_disconnect(receive))
+        try:
+            await send({
+                'type': 'http.response.start',
+                'status': 200,
+                'headers': [(b'content-type', b'text/event-stream'), (b'cache-control', b'no-cache'),
+                            (b'x-accel-buffering', b'no')]
+            })
+            while not channel.closed and not disconnected.done():
+                wakeup.clear()
+                events = channel.events_after(last_id)
+                if events:
+                    last_id = events[-1][0]
+                    payload = ''.join(channel.format_event(*event) for event in events)
+                    await send({'type': 'http.response.body', 'body': payload.encode(), 'more_body': True})
+                    continue
+                woken = asyncio.ensure_future(wakeup.wait())
+                done, _ = await asyncio.wait({woken, disconnected}, timeout=READER_CHANNEL_HEARTBEAT,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                woken.cancel()
+                if not done:
+                    await send({'type': 'http.response.body', 'body': b': keepalive\n\n', 'more_body': True})
+            if not disconnected.done():
+                await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+        finally:
+            channel.remove_waiter(notify)
+            disconnected.cancel()
+    
+    async def _wait_for_disconnect(self, receive):
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+    
+    def _build_environ(self, scope, body, body_size):
+        """Translate an ASGI HTTP scope into a WSGI environ"""
+        server = scope.get('server') or ('localhost', 80)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', '').encode('utf8').decode('latin1'),
+            'PATH_INFO': scope['path'].encode('utf8').decode('latin1'),
+            'QUERY_STRING': scope.get('query_string', b'').decode('latin1'),
+            'SERVER_NAME': server[0],
+            'SERVER_PORT': str(server[1]),
+            'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': body,
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+            # File responses (e.g. /raw) are read in send-sized blocks
+            'wsgi.file_wrapper': lambda file, block_size=8192: FileWrapper(file, ASGI_SEND_CHUNK_SIZE)
+        }
+        if scope.get('client'):
+            environ['REMOTE_ADDR'] = scope['client'][0]
+        for name, value in scope.get('headers', []):
+            name = name.decode('latin1')
+            value = value.decode('latin1')
+            if name == 'content-type':
+                key = 'CONTENT_TYPE'
+            elif name == 'content-length':
+                key = 'CONTENT_LENGTH'
+            else:
+                key = 'HTTP_' + name.upper().replace('-', '_')
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+        # The body is fully buffered, so its length is known even for chunked uploads
+        environ['CONTENT_LENGTH'] = str(body_size)
+        return environ
+
+asgi_app = ReaderASGIApp(app)
     
 if __name__ == '__main__':
-    # Initialize database and test connection on startup
-    print("🔄 Initializing database...")
-    if init_db():
-        print("🔄 Testing database connection...")
-        if test_database_connection():  # Use the non-Flask function for startup
-            print("🔄 Running migration check...")
-            migrate_user_table()
-            print("✅ Ready to start Flask server!")
-        else:
-            print("❌ Database connection failed. Please check your configuration.")
-            print("Update the DB_CONFIG dictionary with your MySQL credentials.")
-    else:
-        print("❌ Database initialization failed.")
+    parser = argparse.ArgumentParser(description='BookFlip server')
+    parser.add_argument('--asgi', action='store_true',
+                        help='serve through the async ASGI app (requires uvicorn)')
+    parser.add_argument('--check', action='store_true',
+                        help='run full database setup, migrations and diagnostics, then exit')
+    parser.add_argument('--bench-auth', action='store_true',
+                        help='benchmark credential checks and session decoding, then exit')
+    parser.add_argument('--bench-json', action='store_true',
+                        help='benchmark JSON serialization and response compression, then exit')
+    parser.add_argument('--migrate-uploads', action='store_true',
+                        help='move flat-layout uploads into sharded directories, then exit (resumable)')
+    parser.add_argument('--batch-size', type=int, default=UPLOAD_MIGRATION_BATCH_SIZE,
+                        help='rows per batch for --migrate-uploads and --validate')
+    parser.add_argument('--prerender', action='store_true',
+                        help='render pages and thumbnails of stored books into the caches, then exit (resumable)')
+    parser.add_argument('--since-days', type=int, default=None,
+                        help='with --prerender, only books read within this many days')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='worker processes for --prerender (default: all cores)')
+    parser.add_argument('--max-pages', type=int, default=PRERENDER_MAX_PAGES,
+                        help='with --prerender, pages to warm per book (0 for all)')
+    parser.add_argument('--max-load', type=float, default=None,
+                        help='with --prerender, wait while the load average is above this')
+    parser.add_argument('--validate', action='store_true',
+                        help='validate stored PDFs that were never checked, then exit (resumable)')
+    parser.add_argument('--rollup-events', action='store_true',
+                        help='roll sealed reading event segments up into the stats tables, then exit')
+    parser.add_argument('--pause', type=float, default=0.0,
+                        help='seconds to sleep between --migrate-uploads batches or --prerender pages')
+    args = parser.parse_args()
     
-    # Create upload folder on startup
-    create_upload_folder()
+    if args.bench_auth:
+        benchmark_credential_checks()
+        sys.exit(0)
+    
+    if args.bench_json:
+        benchmark_json_payloads()
+        sys.exit(0)
+    
+    if args.check:
+        sys.exit(0 if run_startup_checks() else 1)
+    
+    if args.migrate_uploads:
+        sys.exit(0 if migrate_uploads_to_sharded_layout(args.batch_size, args.pause) else 1)
+    
+    if args.validate:
+        sys.exit(0 if validate_library(args.batch_size, args.pause) else 1)
+    
+    if args.rollup_events:
+        reading_events.rollup()
+        sys.exit(0)
+    
+    if args.prerender:
+        sys.exit(0 if prerender_library(args.since_days, args.workers, pause=args.pause,
+                                        max_load=args.max_load, max_pages=args.max_pages) else 1)
+    
+    startup()
     print(f"Upload folder: {os.path.abspath(UPLOAD_FOLDER)}")
-    print("Starting Flask server...")
-    app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
+    if args.asgi:
+        import uvicorn
+        print("Starting ASGI server...")
+        uvicorn.run(asgi_app, host='0.0.0.0', port=5000)
+    else:
+        print("Starting Flask server...")
+        app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
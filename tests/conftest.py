@@ -0,0 +1,53 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+
+class FakeCursor:
+    """Cursor returning queued rows from fetchone()/fetchall()"""
+    def __init__(self, rows):
+        self.rows = rows
+        self.executed = []
+    
+    def execute(self, query, params=None):
+        self.executed.append((query, params))
+    
+    def fetchone(self):
+        return self.rows.pop(0) if self.rows else None
+    
+    def fetchall(self):
+        rows, self.rows[:] = list(self.rows), []
+        return rows
+    
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    def __init__(self, rows=()):
+        self.rows = list(rows)
+        self.closed = False
+    
+    def cursor(self, **kwargs):
+        return FakeCursor(self.rows)
+    
+    def commit(self):
+        pass
+    
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def fake_db(monkeypatch):
+    """Point get_db_connection at a fake connection returning the given rows"""
+    def install(*rows):
+        connection = FakeConnection(rows)
+        monkeypatch.setattr(main, 'get_db_connection', lambda: connection)
+        return connection
+    return install
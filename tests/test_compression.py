@@ -0,0 +1,43 @@
+import pytest
+from werkzeug.http import parse_accept_header
+
+import main
+
+
+@pytest.fixture
+def with_brotli(monkeypatch):
+    monkeypatch.setattr(main, 'brotli', object())
+
+
+@pytest.fixture
+def without_brotli(monkeypatch):
+    monkeypatch.setattr(main, 'brotli', None)
+
+
+def negotiate(header):
+    return main.negotiate_encoding(parse_accept_header(header))
+
+
+def test_brotli_preferred_when_installed(with_brotli):
+    assert negotiate('gzip, deflate, br') == 'br'
+
+
+def test_client_quality_wins(with_brotli):
+    assert negotiate('br;q=0.5, gzip') == 'gzip'
+
+
+def test_gzip_only_without_brotli(without_brotli):
+    assert negotiate('gzip, deflate, br') == 'gzip'
+    assert negotiate('br') is None
+
+
+def test_no_compression_unless_accepted(with_brotli):
+    assert negotiate('') is None
+    assert negotiate('identity') is None
+    assert negotiate('gzip;q=0') is None
+
+
+def test_gzip_body_round_trips(without_brotli):
+    import gzip
+    data = b'{"pages": []}' * 100
+    assert gzip.decompress(main.compress_body(data, 'gzip')) == data
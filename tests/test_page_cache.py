@@ -0,0 +1,70 @@
+import os
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def cache_folder(tmp_path, monkeypatch):
+    monkeypatch.setitem(main.app.config, 'PAGE_CACHE_FOLDER', str(tmp_path))
+    return tmp_path
+
+
+def write_page(folder, page_num, size, mtime):
+    path = folder / 'book' / '2x' / f'{page_num}.png'
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(b'x' * size)
+    os.utime(path, (mtime, mtime))
+    return path
+
+
+def test_prune_removes_least_recently_used_pages(cache_folder):
+    pages = [write_page(cache_folder, n, 100, 1000 + n) for n in range(1, 11)]
+    (cache_folder / 'book' / 'page_count').write_text('10')
+    budget = main.PageCacheBudget(500)
+    
+    assert budget.prune() == 6
+    assert [page.exists() for page in pages] == [False] * 6 + [True] * 4
+    assert budget.used == 400
+    assert (cache_folder / 'book' / 'page_count').exists()
+
+
+def test_prune_keeps_cache_under_budget(cache_folder):
+    pages = [write_page(cache_folder, n, 100, 1000 + n) for n in range(1, 4)]
+    budget = main.PageCacheBudget(500)
+    
+    assert budget.prune() == 0
+    assert all(page.exists() for page in pages)
+    assert budget.used == 300
+
+
+def test_added_counts_bytes_without_pruning_under_budget(cache_folder, monkeypatch):
+    budget = main.PageCacheBudget(500)
+    budget.prune()
+    
+    def no_prune(**kwargs):
+        pytest.fail('prune started under budget')
+    
+    monkeypatch.setattr(main.threading, 'Thread', no_prune)
+    budget.added(200)
+    assert budget.used == 200
+
+
+def test_added_over_budget_starts_one_prune(cache_folder, monkeypatch):
+    budget = main.PageCacheBudget(500)
+    budget.prune()
+    
+    class FakeThread:
+        started = 0
+        
+        def __init__(self, target, name, daemon):
+            self.target = target
+        
+        def start(self):
+            FakeThread.started += 1
+    
+    monkeypatch.setattr(main.threading, 'Thread', FakeThread)
+    budget.added(600)
+    budget.added(100)  # a prune is already pending
+    assert FakeThread.started == 1
@@ -0,0 +1,54 @@
+import pytest
+
+import main
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Controllable time.monotonic() for main"""
+    now = [1000.0]
+    monkeypatch.setattr(main.time, 'monotonic', lambda: now[0])
+    return now
+
+
+def test_bucket_starts_full_and_runs_out(clock):
+    bucket = main.TokenBucket(rate=1, capacity=3)
+    assert [bucket.consume() for _ in range(4)] == [True, True, True, False]
+
+
+def test_bucket_refills_at_rate(clock):
+    bucket = main.TokenBucket(rate=2, capacity=4)
+    for _ in range(4):
+        bucket.consume()
+    clock[0] += 0.5
+    assert bucket.consume()
+    assert not bucket.consume()
+
+
+def test_bucket_never_exceeds_capacity(clock):
+    bucket = main.TokenBucket(rate=10, capacity=2)
+    clock[0] += 60
+    assert bucket.consume(2)
+    assert not bucket.consume()
+
+
+def test_bucket_refuses_more_than_available(clock):
+    bucket = main.TokenBucket(rate=1, capacity=5)
+    assert not bucket.consume(6)
+    assert bucket.tokens == 5
+
+
+def test_memory_store_reports_wait(clock):
+    store = main.MemoryRateLimitStore()
+    assert store.consume('user:1', rate=2, capacity=1) == 0
+    assert store.consume('user:1', rate=2, capacity=1) == pytest.approx(0.5)
+    assert store.consume('user:2', rate=2, capacity=1) == 0
+
+
+def test_memory_store_drops_least_recently_used_keys(clock):
+    store = main.MemoryRateLimitStore(max_keys=2)
+    store.consume('a', 1, 1)
+    store.consume('b', 1, 1)
+    store.consume('a', 1, 1)
+    store.consume('c', 1, 1)
+    assert list(store._buckets) == ['a', 'c']
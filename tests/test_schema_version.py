@@ -0,0 +1,49 @@
+import main
+
+
+def test_schema_version_is_the_newest_migration():
+    versions = [value for name, value in vars(main).items()
+                if name.startswith('SCHEMA_VERSION_') and isinstance(value, int)]
+    assert main.SCHEMA_VERSION == max(versions)
+    assert len(set(versions)) == len(versions)
+
+
+def test_schema_is_current_reads_the_version_row(fake_db):
+    connection = fake_db((main.SCHEMA_VERSION,))
+    assert main.schema_is_current()
+    assert connection.closed
+
+
+def test_schema_behind_is_not_current(fake_db):
+    fake_db((main.SCHEMA_VERSION - 1,))
+    assert not main.schema_is_current()
+
+
+def test_schema_without_version_row_is_not_current(fake_db):
+    fake_db()
+    assert not main.schema_is_current()
+
+
+def test_no_database_is_not_current(monkeypatch):
+    monkeypatch.setattr(main, 'get_db_connection', lambda: None)
+    assert not main.schema_is_current()
+
+
+def _startup(monkeypatch):
+    calls = []
+    monkeypatch.setattr(main, 'startup_done', False)
+    monkeypatch.setattr(main, 'setup_database', lambda: calls.append('setup') or True)
+    monkeypatch.setattr(main, 'create_upload_folder', lambda: None)
+    main.startup()
+    return calls
+
+
+def test_startup_skips_setup_when_schema_is_current(monkeypatch, fake_db):
+    fake_db((main.SCHEMA_VERSION,))
+    assert _startup(monkeypatch) == []
+
+
+def test_startup_runs_setup_when_schema_is_behind(monkeypatch, fake_db):
+    # e.g. a database created before render_profiles.peak_memory_measured
+    fake_db((main.SCHEMA_VERSION_INGEST_VALIDATION,))
+    assert _startup(monkeypatch) == ['setup']